@@ -7,7 +7,6 @@ try:
 except:
     pass
 
-from srwpy import srwl_bl
 from srwpy import srwlib
 from srwpy import srwlpy
 import math
@@ -504,11 +503,10 @@ varParam = [
 ]
 
 
-_BEAM_TMP_DIR = 'beams'
 _DATASET_DIR = 'datasets'
-_PARAM_TMP_DIR = 'parameters'
 _SRW_OUT_DIR = 'data_files'
-_TMP_DIRS = [_BEAM_TMP_DIR, _DATASET_DIR, _PARAM_TMP_DIR, _SRW_OUT_DIR]
+_TMP_DIRS = [_DATASET_DIR, _SRW_OUT_DIR]
+_PARAM_NAMES = ['Aperture_horizontalSize','Aperture_verticalSize',]
 
 def _apply_rotation(angle, norms):
     rx = numpy.array([[1, 0, 0], [0, numpy.cos(angle[0]), -numpy.sin(angle[0])], [0, numpy.sin(angle[0]), numpy.cos(angle[0])]])
@@ -529,29 +527,17 @@ def _get_beamline_param(vp, srw_prefix, sirepo_name):
 
 
 def _read_srw_file(filename):
-    from srwpy import uti_plot_com
-    """ This function takes in an srw file and returns the beam data. This was adapted from srwl_uti_dataProcess.py file"""
-    data, mode, ranges, labels, units = uti_plot_com.file_load(filename)
-    data = numpy.array(data).reshape((ranges[8], ranges[5]), order='C')
-    '''
-    return {'data': data,
-            'shape': data.shape,
-            'mean': numpy.mean(data),
-            'photon_energy': ranges[0],
-            'horizontal_extent': ranges[3:5],
-            'vertical_extent': ranges[6:8],
-            'labels': labels,
-            'units': units}
-    '''
-    return data
-
-
-def _rsopt_run(filename):
+    from deep_beamline_simulation.srw_io import read_srw_intensity
+    """ This function takes in an srw file and returns the beam data as a (vertical, horizontal) float32 array."""
+    return read_srw_intensity(filename)
+
+
+def _rsopt_run(filename, task_timeout_seconds=None, max_attempts=3):
     from pykern import pkio
-#    from sirepo.template import template_common
-    import h5py
-    import multiprocessing
     import time
+    from deep_beamline_simulation.disk_cache import canonical_hash
+    from deep_beamline_simulation.srw_runner import TaskFailed, default_worker_count, run_tasks
+    from deep_beamline_simulation.sweep import SweepJournal, SweepWriter
 
     # create temporary directories
     for d in _TMP_DIRS:
@@ -566,92 +552,70 @@ def _rsopt_run(filename):
         tasks = tasks.reshape(len(tasks), -1)
     n_runs = len(tasks)
 
-    n_processes = min(n_runs, multiprocessing.cpu_count() - 1)
+    # at least one process, even on a single CPU or with a single task
+    n_processes = default_worker_count(n_runs)
     pkdlog(f'Number of processes available: {n_processes}')
 
-    ####################### splits up the number of tasks to be done evenly across the number of processes available and assigns a task cut to each process
-    processes = []
-    split = n_runs // n_processes
-    idx0 = 0
-    for j in range(n_processes):
-        idx1 = n_runs if j == n_processes - 1 else idx0 + split
-        p = multiprocessing.Process(target=_rsopt_run_set, args=(tasks, idx0, idx1, j))
-        processes.append(p)
-        p.start()
-        idx0 += split
-
-    pkdlog('Processes started')
-
-    ####################### must join all processes to end multiprocess thread
-    for p in processes:
-        pkdlog(f'joining {p}...')
-        p.join()
-        pkdlog(f'joined {p}')
+    ###### the journal records finished tasks so an interrupted run starts where it stopped
+    sweep_journal = SweepJournal(
+        f'{_DATASET_DIR}/results.journal',
+        sweep_key=canonical_hash({'params': _PARAM_NAMES, 'paramVals': tasks.tolist()}),
+        sample_count=n_runs,
+    )
+    with sweep_journal:
+        if sweep_journal.resumed:
+            if not os.path.exists(f'{_DATASET_DIR}/results.h5'):
+                raise RuntimeError(f'{_DATASET_DIR}/results.h5 is missing, delete {_DATASET_DIR}/results.journal to start again')
+            pkdlog(f'Resuming with {len(sweep_journal.completed_samples)} of {n_runs} tasks completed')
+
+        ###### workers send each beam back to this process, which writes it straight into results.h5
+        with SweepWriter(
+            f'{_DATASET_DIR}/results.h5',
+            _PARAM_NAMES,
+            n_runs,
+            resume=sweep_journal.resumed,
+        ) as sweep_writer:
+            pending_tasks = sweep_journal.pending_samples(max_attempts)
+            while pending_tasks:
+                ####################### each process takes the next task as soon as it finishes one, so slow tasks do not hold up the others
+                for pending_task_i, task_result in run_tasks(
+                    _rsopt_run_single,
+                    [(tasks[task_num], task_num) for task_num in pending_tasks],
+                    max_workers=min(n_processes, len(pending_tasks)),
+                    task_timeout_seconds=task_timeout_seconds,
+                    progress_callback=lambda task_progress: pkdlog(f'{task_progress}'),
+                    return_exceptions=True,
+                ):
+                    task_num = pending_tasks[pending_task_i]
+                    if isinstance(task_result, TaskFailed):
+                        pkdlog(f'{task_result}')
+                        sweep_journal.record_failed(task_num, task_result)
+                        continue
+                    sweep_writer.write(task_num, tasks[task_num], task_result)
+                    sweep_writer.flush()
+                    sweep_journal.record_completed(task_num)
+                pending_tasks = sweep_journal.pending_samples(max_attempts)
+
+        failed_tasks = sweep_journal.failed_samples(max_attempts)
+        if failed_tasks:
+            pkdlog(f'{len(failed_tasks)} tasks failed {max_attempts} times and are left empty in results.h5: {failed_tasks}')
 
     end_time = time.time()
     pkdlog(f'Time to run {n_runs} simulations with {n_processes} processes: {numpy.round((end_time - start_time) / 60, 4)}m')
 
-    ###### reads in the temporary storage folder info to create one input and one output file for ML
-    beam_arrays = []
-    task_arrays = []
-    for i in range(n_runs):
-        beam_arrays.append(numpy.load(f'{_BEAM_TMP_DIR}/beam_{i}.npy'))
-        task_arrays.append(numpy.load(f'{_PARAM_TMP_DIR}/values_{i}.npy'))
-
-    beams_all = numpy.concatenate(beam_arrays, axis=0)
-    params_all = numpy.concatenate(task_arrays, axis=0)
-
-    with h5py.File(f'{_DATASET_DIR}/results.h5', 'w') as f:
-        f.create_dataset('params', data=['Aperture_horizontalSize','Aperture_verticalSize',])
-        f.create_dataset('paramVals', data=params_all.tolist())
-        f.create_dataset('beamIntensities', data=beams_all.tolist())
-'''
-    ###### consolidated input and output file used for ML
-    template_common.write_dict_to_h5(
-        {
-            'params': ['Aperture_horizontalSize','Aperture_verticalSize',],
-            'paramVals': params_all.tolist(),
-            'beamIntensities': beams_all.tolist(),
-        },
-        f'{_DATASET_DIR}/results.h5'
-    )
-'''
-
-def _rsopt_run_set(param_arr, start, end, proc_num):
-    pkdlog(f'Process {proc_num} to complete {end - start} tasks')
-    task_num = start
-    param_set = param_arr[start:end]
-    for vals in param_set:
-        _rsopt_run_single(vals, proc_num, task_num)
-        task_num += 1
 
+def _rsopt_run_single(param_vals, task_num):
+    from deep_beamline_simulation.srw_runner import calc_srw_intensity
 
-def _rsopt_run_single(param_vals, proc_num, task_num):
     vp = _rsopt_set_params(*param_vals)
-    f = _get_beamline_param(
-        vp,
-        'ws_fni',
-        'file name for saving propagated single-e intensity distribution vs horizontal and vertical position'
-    )
-    f[2] = f'{_SRW_OUT_DIR}/res_int_se_{task_num}.dat'
-    v = srwl_bl.srwl_uti_parse_options(srwl_bl.srwl_uti_ext_options(vp), use_sys_argv=False)
     names = ['Fixed_Mask','Fixed_Mask_M1A','M1A','M1A_Watchpoint','Watchpoint','M2A_VDM','M2A_VDM_Grating','Grating','Grating_Aperture','Aperture','Watchpoint2','M3A_HFM','M3A_HFM_Watchpoint3','Watchpoint3','Pinhole','Watchpoint4','Watchpoint4_Sample','Sample']
-    op = set_optics(v, names, True)
-    v.ws = True
-    v.ss = False
-    v.sm = False
-    v.pw = False
-    v.si = False
-    v.tr = False
-    srwl_bl.SRWLBeamline(_name=v.name).calc_all(v, op)
-
-    beam = _read_srw_file(f[2])
-    h = beam.shape[0]
-    w = beam.shape[1]
-    beam = beam.reshape(1, h, w)
-    numpy.save(f'{_BEAM_TMP_DIR}/beam_{task_num}.npy', beam)
-    numpy.save(f'{_PARAM_TMP_DIR}/values_{task_num}.npy', [param_vals])
-    pkdlog(f'Process {proc_num} finished task {task_num}')
+    intensity_file_name = calc_srw_intensity(
+        vp, set_optics, names, intensity_file_name=f'{_SRW_OUT_DIR}/res_int_se_{task_num}.dat'
+    )
+
+    beam = _read_srw_file(intensity_file_name)
+    pkdlog(f'Process {os.getpid()} finished task {task_num}')
+    return beam
 
 
 # This function actually sets the data
@@ -669,10 +633,10 @@ def _rsopt_set_params(Aperture_horizontalSize,Aperture_verticalSize,):
 def main():
     import sys
     args = sys.argv[1:]
-    if len(args) < 2 or args[0] != 'rsopt_run':
-        sys.exit(f'usage: python {sys.argv[0]} rsopt_run <filename>')
+    if len(args) not in (2, 3) or args[0] != 'rsopt_run':
+        sys.exit(f'usage: python {sys.argv[0]} rsopt_run <filename> [task timeout seconds]')
     del sys.argv[1:]
-    _rsopt_run(args[1])
+    _rsopt_run(args[1], task_timeout_seconds=float(args[2]) if len(args) == 3 else None)
 
 if __name__ == "__main__":
     main()
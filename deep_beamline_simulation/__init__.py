@@ -1,5 +1,8 @@
+import copy
+import importlib
 import logging
 import time as ttime
+import uuid
 
 from contextlib import ContextDecorator
 from urllib.parse import urlparse
@@ -7,13 +10,43 @@ from urllib.parse import urlparse
 import requests
 
 from ._version import get_versions
+from .polling import (  # noqa: F401
+    DeadlinePolling,
+    ExponentialBackoffPolling,
+    FixedPolling,
+    PollingStrategy,
+    ServerHintedPolling,
+    SimulationStats,
+    default_polling_strategy,
+)
+from .metadata_cache import SirepoMetadataCache
+from .simulation_cache import SimulationResultCache, simulation_cache_key  # noqa: F401
 
 __version__ = get_versions()["version"]
 del get_versions
 
 
+class SirepoSimulationError(Exception):
+    """
+    Raised when Sirepo reports that a simulation failed.
+    """
+
+
+class SirepoSimulationTimeout(SirepoSimulationError, TimeoutError):
+    """
+    Raised when a simulation does not complete within the limits set by the caller.
+    """
+
+
 class SirepoGuestSession(ContextDecorator):
-    def __init__(self, sirepo_server_url, simulation_type):
+    def __init__(
+        self,
+        sirepo_server_url,
+        simulation_type,
+        polling_strategy=None,
+        result_cache=None,
+        metadata_cache=None,
+    ):
         """
         Parameters
         ----------
@@ -21,6 +54,15 @@ class SirepoGuestSession(ContextDecorator):
           URI specifying host and port, eg. "http://localhost:8000"
         simulation_type: str
           "srw" or "shadow"
+        polling_strategy: PollingStrategy, optional
+          decides when to make run-status calls, by default ExponentialBackoffPolling()
+        result_cache: SimulationResultCache, optional
+          if specified, completed simulations are stored in this cache and
+          `run_simulation` returns a stored result instead of running a simulation again
+        metadata_cache: SirepoMetadataCache, optional
+          cache for the guest login, simulation list, and simulation data; by default
+          each session has its own cache, pass one SirepoMetadataCache to many sessions
+          to share one guest login and avoid repeating requests
         """
         log = logging.getLogger(self.__class__.__name__)
 
@@ -28,6 +70,15 @@ class SirepoGuestSession(ContextDecorator):
         self._server_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
         log.debug(f"self._server_uri: '%s'", self._server_url)
         self.simulation_type = simulation_type.lower()
+        if polling_strategy is None:
+            self.polling_strategy = default_polling_strategy()
+        else:
+            self.polling_strategy = polling_strategy
+        self.result_cache = result_cache
+        if metadata_cache is None:
+            self.metadata_cache = SirepoMetadataCache()
+        else:
+            self.metadata_cache = metadata_cache
 
         self._session = None
         self._response_auth_guest_login = None
@@ -45,6 +96,14 @@ class SirepoGuestSession(ContextDecorator):
 
         self._session = requests.Session()
 
+        login_key = SirepoMetadataCache.login_key(self._server_url, self.simulation_type)
+        cached_login = self.metadata_cache.get(login_key)
+        if cached_login is not None and cached_login[2]:
+            log.debug("reusing cached guest login to '%s'", self._server_url)
+            cached_cookies, _, _ = cached_login
+            self._session.cookies.update(cached_cookies)
+            return
+
         # get cookies by calling simulation-list
         response_simulation_list = self._post_to_sirepo(
             f"{self._server_url}/simulation-list",
@@ -60,6 +119,14 @@ class SirepoGuestSession(ContextDecorator):
         )
         log.debug("response_auth_guest_login: '%s'", self._response_auth_guest_login)
 
+        # the guest user owns the simulations in the first simulation list
+        self.metadata_cache.invalidate_prefix("simulation", self._server_url, self.simulation_type)
+        self._cache_response(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type),
+            response_simulation_list,
+        )
+        self.metadata_cache.put(login_key, requests.utils.dict_from_cookiejar(self._session.cookies))
+
     def logout(self):
         """Close the HTTP session.
 
@@ -68,6 +135,62 @@ class SirepoGuestSession(ContextDecorator):
         """
         self._session.close()
 
+    def invalidate_simulation_list(self):
+        """
+        Remove the simulation list from the metadata cache so the next call to `simulation_list` asks Sirepo.
+        """
+        self.metadata_cache.invalidate(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type)
+        )
+
+    def invalidate_simulation_data(self, simulation_id=None):
+        """
+        Remove simulation data for one simulation, or for all simulations if simulation_id is None,
+        from the metadata cache.
+        """
+        if simulation_id is None:
+            self.metadata_cache.invalidate_prefix("simulation", self._server_url, self.simulation_type)
+        else:
+            self.metadata_cache.invalidate(
+                SirepoMetadataCache.simulation_data_key(self._server_url, self.simulation_type, simulation_id)
+            )
+
+    def _cached_request(self, metadata_cache_key, request_method, sirepo_request_url, refresh, **kwargs):
+        """
+        Return the JSON for a request, using the metadata cache when possible.
+
+        A stale cache entry with an ETag is revalidated with an If-None-Match request.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        cached_entry = self.metadata_cache.get(metadata_cache_key)
+        if cached_entry is not None:
+            cached_value, cached_etag, cached_entry_is_fresh = cached_entry
+            if cached_entry_is_fresh and not refresh:
+                log.debug("metadata cache hit for '%s'", sirepo_request_url)
+                return cached_value
+            if cached_etag is not None:
+                kwargs["headers"] = dict(kwargs.get("headers", {}), **{"If-None-Match": cached_etag})
+
+        if request_method == "GET":
+            sirepo_response = self._session.get(sirepo_request_url, **kwargs)
+        else:
+            sirepo_response = self._post_to_sirepo(sirepo_request_url, **kwargs)
+
+        if sirepo_response.status_code == 304 and cached_entry is not None:
+            log.debug("metadata cache entry for '%s' is not modified", sirepo_request_url)
+            self.metadata_cache.revalidate(metadata_cache_key)
+            return cached_value
+        return self._cache_response(metadata_cache_key, sirepo_response)
+
+    def _cache_response(self, metadata_cache_key, sirepo_response):
+        sirepo_response_json = sirepo_response.json()
+        if sirepo_response.ok:
+            self.metadata_cache.put(
+                metadata_cache_key, sirepo_response_json, etag=sirepo_response.headers.get("ETag")
+            )
+        return sirepo_response_json
+
     def __enter__(self):
         self.login()
         return self
@@ -88,12 +211,14 @@ class SirepoGuestSession(ContextDecorator):
         )
         return sirepo_response
 
-    def simulation_list(self):
+    def simulation_list(self, refresh=False):
         """Return results from Sirepo's `simulation-list` endpoint.
 
         Despite the name this method returns a dictionary, which
         is how the endpoint works so this seems reasonable.
 
+        The result comes from the metadata cache if it is fresh, unless `refresh` is True.
+
         Returns
         -------
         dictionary of simulation "folders", "names", and ids:
@@ -114,42 +239,83 @@ class SirepoGuestSession(ContextDecorator):
             ...
         }
         """
-        response_sim_list = self._post_to_sirepo(
+        sim_list_results = self._cached_request(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type),
+            "POST",
             f"{self._server_url}/simulation-list",
+            refresh=refresh,
             json={"simulationType": self.simulation_type},
         )
-        sim_list_results = response_sim_list.json()
+        return _simulation_folder_name_to_id(sim_list_results)
 
-        # build a dictionary from the simulation list results
-        # sim_folder_name_to_id means "folder" -> "name" -> simulation id
-        sim_folder_name_to_id = {}
-        for sim_details in sorted(
-            sim_list_results, key=lambda sim_details_: sim_details_["folder"]
-        ):
-            simulation_folder = sim_details["folder"]
-            if simulation_folder not in sim_folder_name_to_id:
-                sim_folder_name_to_id[simulation_folder] = {}
-            sim_folder_name_to_id[simulation_folder][sim_details["name"]] = sim_details[
-                "simulationId"
-            ]
+    def simulation_data(self, simulation_id, refresh=False):
+        """
+        Request simulation data for the specified simulation id.
 
-        return sim_folder_name_to_id
+        The result comes from the metadata cache if it is fresh, unless `refresh` is True.
+        The caller gets its own copy, so changing it does not change the cached simulation data.
+        """
+        simulation_data = self._cached_request(
+            SirepoMetadataCache.simulation_data_key(self._server_url, self.simulation_type, simulation_id),
+            "GET",
+            f"{self._server_url}/simulation/{self.simulation_type}/{simulation_id}/0",
+            refresh=refresh,
+        )
+        return copy.deepcopy(simulation_data)
 
-    def simulation_data(self, simulation_id):
+    def copy_simulation(self, simulation_id, name, folder):
         """
-        Request simulation data for the specified simulation id.
+        Copy the specified simulation and return the simulation data of the copy.
+
+        The simulation id of the copy is simulation_data["models"]["simulation"]["simulationId"].
+        """
+        response_copy_simulation = self._post_to_sirepo(
+            f"{self._server_url}/copy-simulation",
+            json={
+                "folder": folder,
+                "name": name,
+                "simulationId": simulation_id,
+                "simulationType": self.simulation_type,
+            },
+        )
+        self.invalidate_simulation_list()
+        return response_copy_simulation.json()
+
+    def delete_simulation(self, simulation_id):
+        """
+        Delete the specified simulation.
         """
-        response_simulation_data = self._session.get(
-            f"{self._server_url}/simulation/{self.simulation_type}/{simulation_id}/0"
+        response_delete_simulation = self._post_to_sirepo(
+            f"{self._server_url}/delete-simulation",
+            json={
+                "simulationId": simulation_id,
+                "simulationType": self.simulation_type,
+            },
         )
-        return response_simulation_data.json()
+        self.invalidate_simulation_list()
+        self.invalidate_simulation_data(simulation_id)
+        return response_delete_simulation.json()
 
-    def run_simulation(self, simulation_id, simulation_data, simulation_report=None):
+    def run_simulation(self, simulation_id, simulation_data, simulation_report=None, bypass_cache=False):
         """
         Start a simulation but do not wait for it to complete.
+
+        The returned response has a `simulation_stats` attribute, a SimulationStats
+        that is updated by `wait_for_simulation`.
+
+        If the session has a result cache and the same simulation has been run before,
+        a completed response with `from_cache` True is returned without contacting Sirepo.
+        Set `bypass_cache` to run the simulation anyway; the new result replaces the cached one.
         """
         log = logging.getLogger(self.__class__.__name__)
 
+        if not bypass_cache:
+            cached_run_status_response = self._cached_run_status_response(simulation_data, simulation_report)
+            if cached_run_status_response is not None:
+                log.info("using cached result for simulation '%s'", simulation_id)
+                return cached_run_status_response
+
+        simulation_stats = SimulationStats()
         simulation_data_copy = simulation_data.copy()
         simulation_data_copy["simulationId"] = simulation_id
         if simulation_report:
@@ -157,47 +323,431 @@ class SirepoGuestSession(ContextDecorator):
         run_simulation_response = self._session.post(
             f"{self._server_url}/run-simulation", json=simulation_data_copy
         )
+        run_simulation_response.simulation_stats = simulation_stats
+        run_simulation_response.from_cache = False
+        if self.result_cache is not None:
+            run_simulation_response.result_cache_key = simulation_cache_key(
+                simulation_data, simulation_data_copy.get("report"), self.simulation_type
+            )
         log.debug(
             "run-simulation response: state '%s', nextRequest: '%s', nextRequestSeconds '%s'",
             run_simulation_response.json()["state"],
-            run_simulation_response.json()["nextRequest"],
-            run_simulation_response.json()["nextRequestSeconds"],
+            run_simulation_response.json().get("nextRequest"),
+            run_simulation_response.json().get("nextRequestSeconds"),
         )
         return run_simulation_response
 
-    def wait_for_simulation(self, run_simulation_response, max_status_calls=100):
+    def wait_for_simulation(self, run_simulation_response, max_status_calls=100, polling_strategy=None):
         """
         Wait for a running simulation to complete and return the final run-status response.
+
+        Parameters
+        ----------
+        run_simulation_response: requests.Response
+          the response returned by `run_simulation`
+        max_status_calls: int
+          raise SirepoSimulationTimeout if the simulation has not completed after this many run-status calls
+        polling_strategy: PollingStrategy, optional
+          overrides the session's polling strategy for this simulation
+
+        Returns
+        -------
+        requests.Response
+          the final run-status response, with a `simulation_stats` attribute holding
+          the run-status call count and timing for the simulation, and a `from_cache`
+          attribute that is True if the result came from the session's result cache
+
+        Raises
+        ------
+        SirepoSimulationError
+          if the simulation fails
+        SirepoSimulationTimeout
+          if the simulation does not complete within the limits of max_status_calls and the polling strategy
         """
         log = logging.getLogger(self.__class__.__name__)
 
-        simulation_id = run_simulation_response.json()["nextRequest"]["simulationId"]
+        if polling_strategy is None:
+            polling_strategy = self.polling_strategy
+        simulation_stats = getattr(run_simulation_response, "simulation_stats", None)
+        if simulation_stats is None:
+            simulation_stats = SimulationStats()
 
         run_status_response = run_simulation_response
         run_status = run_status_response.json()
-        for status_call_i in range(max_status_calls):
-            run_state = run_status["state"]
-            if run_state == "completed":
-                log.info("simulation '%s' completed", simulation_id)
-                break
-            elif run_state == "error":
-                log.error("simulation failed with an error")
-                raise Exception()
-            else:
-                log.debug("making run-status call %d", status_call_i)
-                next_request_seconds = run_status["nextRequestSeconds"]
-                log.debug("sleeping for '%s' second(s)", next_request_seconds)
-                ttime.sleep(next_request_seconds)
-                run_status_response = self._session.post(
-                    f"{self._server_url}/run-status", json=run_status["nextRequest"]
-                )
-                run_status = run_status_response.json()
-                log.debug("run_status.json: %s", run_status)
+        while not _simulation_completed(run_status):
+            next_request_seconds = _next_request_delay(
+                polling_strategy, simulation_stats, run_status, max_status_calls
+            )
+            log.debug("sleeping for '%s' second(s)", next_request_seconds)
+            ttime.sleep(next_request_seconds)
+            simulation_stats.record_sleep(next_request_seconds)
+
+            log.debug("making run-status call %d", simulation_stats.status_call_count)
+            run_status_call_start_time = ttime.monotonic()
+            run_status_response = self._run_status(run_status)
+            simulation_stats.record_status_call(ttime.monotonic() - run_status_call_start_time)
+            run_status = run_status_response.json()
+            log.debug("run_status.json: %s", run_status)
 
         # the simulation completed successfully
+        simulation_stats.finish()
+        run_status_response.simulation_stats = simulation_stats
+        run_status_response.from_cache = getattr(run_simulation_response, "from_cache", False)
+        self._store_in_result_cache(run_simulation_response, run_status_response)
+        log.info("simulation completed: %s", simulation_stats)
         log.debug(
             "after successful completion run_status_response: %s\n  json:\n %s",
             run_status_response,
             run_status_response.json(),
         )
         return run_status_response
+
+    def run_simulations(
+        self,
+        simulation_id,
+        simulation_data_list,
+        simulation_report=None,
+        max_concurrent_simulations=4,
+        max_status_calls=100,
+        polling_strategy=None,
+        bypass_cache=False,
+        return_exceptions=False,
+    ):
+        """Run many parameterized versions of one simulation concurrently.
+
+        Sirepo runs at most one job per simulation id and report, so this method
+        makes up to `max_concurrent_simulations` scratch copies of the simulation,
+        submits one job to each copy, and polls all outstanding jobs from a single
+        scheduler loop. A copy is reused for the next job as soon as its current
+        job completes. The scratch copies are deleted when the generator is exhausted
+        or closed. Results found in the session's result cache are yielded without
+        running a simulation.
+
+        Parameters
+        ----------
+        simulation_id: str
+          id of the simulation to copy
+        simulation_data_list: iterable of dict
+          simulation data, for example modified copies of the result of `simulation_data`
+        simulation_report: str, optional
+          report to run for each simulation, eg. "watchpointReport6"
+        max_concurrent_simulations: int
+          maximum number of jobs running on the Sirepo server at the same time
+        max_status_calls: int
+          maximum number of run-status calls for each job
+        polling_strategy: PollingStrategy, optional
+          overrides the session's polling strategy for these simulations
+        bypass_cache: bool
+          if True run every simulation even if its result is cached, see `run_simulation`
+        return_exceptions: bool
+          if True a simulation that fails or times out yields its SirepoSimulationError
+          in place of a response and the remaining simulations keep running,
+          otherwise the SirepoSimulationError is raised
+
+        Yields
+        ------
+        (int, requests.Response)
+          the index into `simulation_data_list` and the final run-status response,
+          in order of completion rather than in order of submission, with a
+          `simulation_stats` attribute as described in `wait_for_simulation`
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        if max_concurrent_simulations < 1:
+            raise ValueError(
+                f"max_concurrent_simulations must be at least 1, not {max_concurrent_simulations}"
+            )
+        if polling_strategy is None:
+            polling_strategy = self.polling_strategy
+
+        # in_flight_simulations maps scratch simulation id -> _InFlightSimulation
+        in_flight_simulations = {}
+        idle_simulation_ids = []
+        scratch_simulation_ids = []
+        pending_simulation_data = enumerate(simulation_data_list)
+        pending_simulation_data_exhausted = False
+        try:
+            while True:
+                # fill every free slot before polling
+                while (
+                    not pending_simulation_data_exhausted
+                    and len(in_flight_simulations) < max_concurrent_simulations
+                ):
+                    try:
+                        simulation_i, simulation_data = next(pending_simulation_data)
+                    except StopIteration:
+                        pending_simulation_data_exhausted = True
+                        break
+
+                    if not bypass_cache:
+                        cached_run_status_response = self._cached_run_status_response(
+                            simulation_data, simulation_report
+                        )
+                        if cached_run_status_response is not None:
+                            yield simulation_i, cached_run_status_response
+                            continue
+
+                    if idle_simulation_ids:
+                        scratch_simulation_id = idle_simulation_ids.pop()
+                    else:
+                        scratch_simulation_id = self._copy_scratch_simulation(
+                            simulation_id, simulation_data
+                        )
+                        scratch_simulation_ids.append(scratch_simulation_id)
+
+                    run_simulation_response = self.run_simulation(
+                        simulation_id=scratch_simulation_id,
+                        simulation_data=_with_simulation_id(
+                            simulation_data, scratch_simulation_id
+                        ),
+                        simulation_report=simulation_report,
+                        # the cache was checked above
+                        bypass_cache=True,
+                    )
+                    try:
+                        in_flight_simulations[scratch_simulation_id] = _InFlightSimulation(
+                            simulation_i=simulation_i,
+                            run_simulation_response=run_simulation_response,
+                            polling_strategy=polling_strategy,
+                            max_status_calls=max_status_calls,
+                        )
+                    except SirepoSimulationError as simulation_error:
+                        if not return_exceptions:
+                            raise
+                        idle_simulation_ids.append(scratch_simulation_id)
+                        yield simulation_i, simulation_error
+
+                if len(in_flight_simulations) == 0:
+                    break
+
+                # poll the job that is due soonest
+                scratch_simulation_id, in_flight_simulation = min(
+                    in_flight_simulations.items(),
+                    key=lambda item: item[1].next_request_time,
+                )
+                if in_flight_simulation.completed:
+                    log.info(
+                        "simulation %d completed: %s",
+                        in_flight_simulation.simulation_i,
+                        in_flight_simulation.simulation_stats,
+                    )
+                    del in_flight_simulations[scratch_simulation_id]
+                    idle_simulation_ids.append(scratch_simulation_id)
+                    self._store_in_result_cache(
+                        in_flight_simulation.run_simulation_response,
+                        in_flight_simulation.run_status_response,
+                    )
+                    yield in_flight_simulation.simulation_i, in_flight_simulation.run_status_response
+                else:
+                    sleep_seconds = in_flight_simulation.next_request_time - ttime.monotonic()
+                    if sleep_seconds > 0:
+                        log.debug("sleeping for '%s' second(s)", sleep_seconds)
+                        ttime.sleep(sleep_seconds)
+                    run_status_call_start_time = ttime.monotonic()
+                    run_status_response = self._run_status(in_flight_simulation.run_status_response.json())
+                    try:
+                        in_flight_simulation.update(
+                            run_status_response,
+                            status_call_seconds=ttime.monotonic() - run_status_call_start_time,
+                        )
+                    except SirepoSimulationError as simulation_error:
+                        if not return_exceptions:
+                            raise
+                        log.warning(
+                            "simulation %d failed: %s", in_flight_simulation.simulation_i, simulation_error
+                        )
+                        del in_flight_simulations[scratch_simulation_id]
+                        idle_simulation_ids.append(scratch_simulation_id)
+                        yield in_flight_simulation.simulation_i, simulation_error
+        finally:
+            for scratch_simulation_id in scratch_simulation_ids:
+                log.debug("deleting scratch simulation '%s'", scratch_simulation_id)
+                self.delete_simulation(scratch_simulation_id)
+
+    def _copy_scratch_simulation(self, simulation_id, simulation_data):
+        simulation_model = simulation_data["models"]["simulation"]
+        scratch_simulation_data = self.copy_simulation(
+            simulation_id=simulation_id,
+            name=f"{simulation_model['name']} {uuid.uuid4().hex[:8]}",
+            folder=simulation_model["folder"],
+        )
+        return scratch_simulation_data["models"]["simulation"]["simulationId"]
+
+    def _run_status(self, run_status):
+        return self._session.post(
+            f"{self._server_url}/run-status", json=run_status["nextRequest"]
+        )
+
+    def _cached_run_status_response(self, simulation_data, simulation_report):
+        """
+        Return a _CachedRunStatusResponse if the result of this simulation is cached, otherwise None.
+        """
+        if self.result_cache is None:
+            return None
+        run_status = self.result_cache.get(
+            simulation_cache_key(
+                simulation_data, simulation_report or simulation_data.get("report"), self.simulation_type
+            )
+        )
+        if run_status is None:
+            return None
+        cached_run_status_response = _CachedRunStatusResponse(run_status)
+        cached_run_status_response.simulation_stats.finish()
+        return cached_run_status_response
+
+    def _store_in_result_cache(self, run_simulation_response, run_status_response):
+        result_cache_key = getattr(run_simulation_response, "result_cache_key", None)
+        if self.result_cache is not None and result_cache_key is not None:
+            self.result_cache.put(result_cache_key, run_status_response.json())
+
+
+class _CachedRunStatusResponse:
+    """
+    Stands in for the requests.Response of a completed run-status call when the result is cached.
+    """
+
+    status_code = 200
+    ok = True
+    from_cache = True
+
+    def __init__(self, run_status):
+        self._run_status = run_status
+        self.simulation_stats = SimulationStats()
+
+    def json(self):
+        return self._run_status
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} [{self.status_code}]>"
+
+
+class _InFlightSimulation:
+    """
+    Bookkeeping for one job started by `SirepoGuestSession.run_simulations`.
+    """
+
+    def __init__(self, simulation_i, run_simulation_response, polling_strategy, max_status_calls):
+        self.simulation_i = simulation_i
+        self.polling_strategy = polling_strategy
+        self.max_status_calls = max_status_calls
+        self.run_simulation_response = run_simulation_response
+        self.simulation_stats = run_simulation_response.simulation_stats
+        self.run_status_response = None
+        self.completed = False
+        self.next_request_time = None
+        self._set_run_status_response(run_simulation_response)
+
+    def update(self, run_status_response, status_call_seconds):
+        self.simulation_stats.record_status_call(status_call_seconds)
+        self._set_run_status_response(run_status_response)
+
+    def _set_run_status_response(self, run_status_response):
+        self.run_status_response = run_status_response
+        run_status = run_status_response.json()
+        if _simulation_completed(run_status):
+            self.completed = True
+            # completed simulations are handled before any run-status call
+            self.next_request_time = float("-inf")
+            self.simulation_stats.finish()
+            run_status_response.simulation_stats = self.simulation_stats
+            run_status_response.from_cache = False
+        else:
+            next_request_seconds = _next_request_delay(
+                self.polling_strategy, self.simulation_stats, run_status, self.max_status_calls
+            )
+            self.simulation_stats.record_sleep(next_request_seconds)
+            self.next_request_time = ttime.monotonic() + next_request_seconds
+
+
+def _simulation_folder_name_to_id(sim_list_results):
+    """
+    Build a dictionary of simulation folder -> simulation name -> simulation id
+    from the results of Sirepo's `simulation-list` endpoint.
+    """
+    # sim_folder_name_to_id means "folder" -> "name" -> simulation id
+    sim_folder_name_to_id = {}
+    for sim_details in sorted(
+        sim_list_results, key=lambda sim_details_: sim_details_["folder"]
+    ):
+        simulation_folder = sim_details["folder"]
+        if simulation_folder not in sim_folder_name_to_id:
+            sim_folder_name_to_id[simulation_folder] = {}
+        sim_folder_name_to_id[simulation_folder][sim_details["name"]] = sim_details[
+            "simulationId"
+        ]
+
+    return sim_folder_name_to_id
+
+
+def _simulation_completed(run_status):
+    """
+    Return True if the run-status indicates a completed simulation, False if it is still running.
+
+    Raise SirepoSimulationError if the simulation failed or was canceled.
+    """
+    log = logging.getLogger("deep_beamline_simulation")
+
+    run_state = run_status["state"]
+    if run_state == "completed":
+        return True
+    elif run_state in ("error", "canceled"):
+        log.error("simulation %s: %s", run_state, run_status.get("error"))
+        raise SirepoSimulationError(
+            f"simulation {run_state}: {run_status.get('error', 'no error message')}"
+        )
+    else:
+        return False
+
+
+def _next_request_delay(polling_strategy, simulation_stats, run_status, max_status_calls):
+    """
+    Return the number of seconds to wait before the next run-status call.
+
+    Raise SirepoSimulationTimeout if there should not be another run-status call.
+    """
+    if simulation_stats.status_call_count >= max_status_calls:
+        raise SirepoSimulationTimeout(
+            f"simulation did not complete after {max_status_calls} run-status calls"
+        )
+    next_request_seconds = polling_strategy.next_delay(
+        simulation_stats.status_call_count,
+        simulation_stats.elapsed_seconds,
+        run_status.get("nextRequestSeconds"),
+    )
+    if next_request_seconds is None:
+        raise SirepoSimulationTimeout(
+            f"simulation did not complete in {simulation_stats.elapsed_seconds:.1f}s "
+            f"with polling strategy {polling_strategy!r}"
+        )
+    return next_request_seconds
+
+
+def _with_simulation_id(simulation_data, simulation_id):
+    """
+    Return a shallow copy of simulation_data with every reference to the simulation id replaced.
+    """
+    simulation_data_copy = simulation_data.copy()
+    simulation_data_copy["simulationId"] = simulation_id
+    models_copy = simulation_data_copy["models"].copy()
+    models_copy["simulation"] = dict(models_copy["simulation"], simulationId=simulation_id)
+    simulation_data_copy["models"] = models_copy
+    return simulation_data_copy
+
+
+# names imported from submodules when first used, so importing this package
+# does not import their dependencies, like aiohttp for AsyncSirepoGuestSession
+_LAZY_ATTRIBUTE_MODULES = {
+    "AsyncSirepoGuestSession": "deep_beamline_simulation.async_session",
+    "SirepoServerUnavailable": "deep_beamline_simulation.session_pool",
+    "SirepoSessionPool": "deep_beamline_simulation.session_pool",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTE_MODULES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTE_MODULES[name]), name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTE_MODULES))
@@ -0,0 +1,483 @@
+import asyncio
+import copy
+import logging
+import time as ttime
+import uuid
+
+from urllib.parse import urlparse
+
+import aiohttp
+import yarl
+
+from deep_beamline_simulation import (
+    SirepoSimulationError,
+    _next_request_delay,
+    _simulation_completed,
+    _simulation_folder_name_to_id,
+    _with_simulation_id,
+)
+from deep_beamline_simulation.metadata_cache import SirepoMetadataCache
+from deep_beamline_simulation.polling import SimulationStats, default_polling_strategy
+from deep_beamline_simulation.simulation_cache import simulation_cache_key
+
+
+class RunStatus(dict):
+    """
+    Run-simulation or run-status JSON with `simulation_stats`, `from_cache`, and `result_cache_key` attributes.
+    """
+
+    def __init__(self, run_status_json, simulation_stats, from_cache=False, result_cache_key=None):
+        super().__init__(run_status_json)
+        self.simulation_stats = simulation_stats
+        self.from_cache = from_cache
+        self.result_cache_key = result_cache_key
+
+
+class AsyncSirepoGuestSession:
+    def __init__(
+        self,
+        sirepo_server_url,
+        simulation_type,
+        connection_limit=100,
+        polling_strategy=None,
+        result_cache=None,
+        metadata_cache=None,
+    ):
+        """
+        An asyncio counterpart to SirepoGuestSession.
+
+        All requests share one aiohttp connection pool and waiting for a simulation
+        does not block the event loop. Methods that return Sirepo responses return
+        the decoded JSON rather than a response object.
+
+        Parameters
+        ----------
+        sirepo_server_url: str
+          URI specifying host and port, eg. "http://localhost:8000"
+        simulation_type: str
+          "srw" or "shadow"
+        connection_limit: int
+          maximum number of simultaneous connections to the Sirepo server
+        polling_strategy: PollingStrategy, optional
+          decides when to make run-status calls, by default ExponentialBackoffPolling()
+        result_cache: SimulationResultCache, optional
+          see SirepoGuestSession
+        metadata_cache: SirepoMetadataCache, optional
+          see SirepoGuestSession
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        parsed_url = urlparse(sirepo_server_url)
+        self._server_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        log.debug("self._server_uri: '%s'", self._server_url)
+        self.simulation_type = simulation_type.lower()
+        self.connection_limit = connection_limit
+        if polling_strategy is None:
+            self.polling_strategy = default_polling_strategy()
+        else:
+            self.polling_strategy = polling_strategy
+        self.result_cache = result_cache
+        if metadata_cache is None:
+            self.metadata_cache = SirepoMetadataCache()
+        else:
+            self.metadata_cache = metadata_cache
+
+        self._session = None
+        self._response_auth_guest_login = None
+
+    async def login(self):
+        """Take the necessary steps to log in to sirepo as a guest.
+
+        Client code should prefer the async context manager protocol to calling this method directly,
+        for example:
+
+            async with AsyncSirepoGuestSession(
+                sirepo_server_url="http://localhost", simulation_type="srw"
+            ) as sirepo_session:
+                ...
+
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connection_limit),
+            # Sirepo is often addressed by IP, eg. "http://10.10.10.10:8000",
+            # and by default aiohttp ignores cookies from IP addresses
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+        )
+
+        login_key = SirepoMetadataCache.login_key(self._server_url, self.simulation_type)
+        cached_login = self.metadata_cache.get(login_key)
+        if cached_login is not None and cached_login[2]:
+            log.debug("reusing cached guest login to '%s'", self._server_url)
+            cached_cookies, _, _ = cached_login
+            self._session.cookie_jar.update_cookies(cached_cookies, response_url=yarl.URL(self._server_url))
+            return
+
+        # get cookies by calling simulation-list
+        status, etag, response_simulation_list = await self._request_sirepo(
+            "POST",
+            f"{self._server_url}/simulation-list",
+            json={"simulationType": self.simulation_type},
+        )
+        log.debug("response_simulation_list: %s", response_simulation_list)
+
+        log.debug("logging in as guest to '%s'", self._server_url)
+        # store the response for troubleshooting and automatic tests
+        self._response_auth_guest_login = await self._post_to_sirepo(
+            f"{self._server_url}/auth-guest-login/{self.simulation_type}"
+        )
+        log.debug("response_auth_guest_login: '%s'", self._response_auth_guest_login)
+
+        # the guest user owns the simulations in the first simulation list
+        self.metadata_cache.invalidate_prefix("simulation", self._server_url, self.simulation_type)
+        self.metadata_cache.put(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type),
+            response_simulation_list,
+            etag=etag,
+        )
+        self.metadata_cache.put(
+            login_key, {cookie.key: cookie.value for cookie in self._session.cookie_jar}
+        )
+
+    async def logout(self):
+        """Close the HTTP session.
+
+        This is the counterpart to `login`. Client code should prefer the async context manager protocol.
+
+        """
+        await self._session.close()
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.logout()
+        return False
+
+    async def _request_sirepo(self, request_method, sirepo_request_url, **kwargs):
+        """
+        Return the status, ETag header, and JSON of a Sirepo response.
+
+        The JSON is None for a "304 Not Modified" response.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        log.debug("%s url: '%s', kwargs: '%s'", request_method, sirepo_request_url, dict(kwargs))
+        async with self._session.request(request_method, sirepo_request_url, **kwargs) as sirepo_response:
+            sirepo_response.raise_for_status()
+            if sirepo_response.status == 304:
+                sirepo_response_json = None
+            else:
+                # Sirepo does not always send a JSON content type
+                sirepo_response_json = await sirepo_response.json(content_type=None)
+        log.debug("response: '%s'", sirepo_response)
+        return sirepo_response.status, sirepo_response.headers.get("ETag"), sirepo_response_json
+
+    async def _post_to_sirepo(self, sirepo_request_url, **kwargs):
+        _, _, sirepo_response_json = await self._request_sirepo("POST", sirepo_request_url, **kwargs)
+        return sirepo_response_json
+
+    async def _cached_request(self, metadata_cache_key, request_method, sirepo_request_url, refresh, **kwargs):
+        """
+        Return the JSON for a request, using the metadata cache when possible.
+
+        See SirepoGuestSession._cached_request.
+        """
+        cached_entry = self.metadata_cache.get(metadata_cache_key)
+        if cached_entry is not None:
+            cached_value, cached_etag, cached_entry_is_fresh = cached_entry
+            if cached_entry_is_fresh and not refresh:
+                return cached_value
+            if cached_etag is not None:
+                kwargs["headers"] = dict(kwargs.get("headers", {}), **{"If-None-Match": cached_etag})
+
+        status, etag, sirepo_response_json = await self._request_sirepo(
+            request_method, sirepo_request_url, **kwargs
+        )
+        if status == 304 and cached_entry is not None:
+            self.metadata_cache.revalidate(metadata_cache_key)
+            return cached_value
+        self.metadata_cache.put(metadata_cache_key, sirepo_response_json, etag=etag)
+        return sirepo_response_json
+
+    def invalidate_simulation_list(self):
+        """
+        Remove the simulation list from the metadata cache so the next call to `simulation_list` asks Sirepo.
+        """
+        self.metadata_cache.invalidate(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type)
+        )
+
+    def invalidate_simulation_data(self, simulation_id=None):
+        """
+        Remove simulation data for one simulation, or for all simulations if simulation_id is None,
+        from the metadata cache.
+        """
+        if simulation_id is None:
+            self.metadata_cache.invalidate_prefix("simulation", self._server_url, self.simulation_type)
+        else:
+            self.metadata_cache.invalidate(
+                SirepoMetadataCache.simulation_data_key(self._server_url, self.simulation_type, simulation_id)
+            )
+
+    async def simulation_list(self, refresh=False):
+        """Return results from Sirepo's `simulation-list` endpoint.
+
+        See SirepoGuestSession.simulation_list for the structure of the returned dictionary.
+        """
+        sim_list_results = await self._cached_request(
+            SirepoMetadataCache.simulation_list_key(self._server_url, self.simulation_type),
+            "POST",
+            f"{self._server_url}/simulation-list",
+            refresh=refresh,
+            json={"simulationType": self.simulation_type},
+        )
+        return _simulation_folder_name_to_id(sim_list_results)
+
+    async def simulation_data(self, simulation_id, refresh=False):
+        """
+        Request simulation data for the specified simulation id.
+
+        See SirepoGuestSession.simulation_data.
+        """
+        simulation_data = await self._cached_request(
+            SirepoMetadataCache.simulation_data_key(self._server_url, self.simulation_type, simulation_id),
+            "GET",
+            f"{self._server_url}/simulation/{self.simulation_type}/{simulation_id}/0",
+            refresh=refresh,
+        )
+        return copy.deepcopy(simulation_data)
+
+    async def copy_simulation(self, simulation_id, name, folder):
+        """
+        Copy the specified simulation and return the simulation data of the copy.
+        """
+        self.invalidate_simulation_list()
+        return await self._post_to_sirepo(
+            f"{self._server_url}/copy-simulation",
+            json={
+                "folder": folder,
+                "name": name,
+                "simulationId": simulation_id,
+                "simulationType": self.simulation_type,
+            },
+        )
+
+    async def delete_simulation(self, simulation_id):
+        """
+        Delete the specified simulation.
+        """
+        self.invalidate_simulation_list()
+        self.invalidate_simulation_data(simulation_id)
+        return await self._post_to_sirepo(
+            f"{self._server_url}/delete-simulation",
+            json={
+                "simulationId": simulation_id,
+                "simulationType": self.simulation_type,
+            },
+        )
+
+    async def run_simulation(self, simulation_id, simulation_data, simulation_report=None, bypass_cache=False):
+        """
+        Start a simulation but do not wait for it to complete.
+
+        Returns the run-simulation JSON as a RunStatus. See SirepoGuestSession.run_simulation
+        for how the result cache is used.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        if not bypass_cache:
+            cached_run_status = self._cached_run_status(simulation_data, simulation_report)
+            if cached_run_status is not None:
+                log.info("using cached result for simulation '%s'", simulation_id)
+                return cached_run_status
+
+        simulation_stats = SimulationStats()
+        simulation_data_copy = simulation_data.copy()
+        simulation_data_copy["simulationId"] = simulation_id
+        if simulation_report:
+            simulation_data_copy["report"] = simulation_report
+        run_simulation_json = await self._post_to_sirepo(
+            f"{self._server_url}/run-simulation", json=simulation_data_copy
+        )
+        log.debug(
+            "run-simulation response: state '%s', nextRequestSeconds '%s'",
+            run_simulation_json["state"],
+            run_simulation_json.get("nextRequestSeconds"),
+        )
+        result_cache_key = None
+        if self.result_cache is not None:
+            result_cache_key = simulation_cache_key(
+                simulation_data, simulation_data_copy.get("report"), self.simulation_type
+            )
+        return RunStatus(run_simulation_json, simulation_stats, result_cache_key=result_cache_key)
+
+    async def wait_for_simulation(self, run_simulation_json, max_status_calls=100, polling_strategy=None):
+        """
+        Wait for a running simulation to complete and return the final run-status JSON.
+
+        See SirepoGuestSession.wait_for_simulation for parameters and exceptions.
+        The final run-status JSON is returned as a RunStatus with a `simulation_stats` attribute.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        if polling_strategy is None:
+            polling_strategy = self.polling_strategy
+        simulation_stats = getattr(run_simulation_json, "simulation_stats", None)
+        if simulation_stats is None:
+            simulation_stats = SimulationStats()
+
+        run_status = run_simulation_json
+        while not _simulation_completed(run_status):
+            next_request_seconds = _next_request_delay(
+                polling_strategy, simulation_stats, run_status, max_status_calls
+            )
+            await asyncio.sleep(next_request_seconds)
+            simulation_stats.record_sleep(next_request_seconds)
+
+            log.debug("making run-status call %d", simulation_stats.status_call_count)
+            run_status_call_start_time = ttime.monotonic()
+            run_status = await self._run_status(run_status)
+            simulation_stats.record_status_call(ttime.monotonic() - run_status_call_start_time)
+            log.debug("run_status: %s", run_status)
+
+        simulation_stats.finish()
+        log.info("simulation completed: %s", simulation_stats)
+        result_cache_key = getattr(run_simulation_json, "result_cache_key", None)
+        if self.result_cache is not None and result_cache_key is not None:
+            self.result_cache.put(result_cache_key, run_status)
+        return RunStatus(
+            run_status,
+            simulation_stats,
+            from_cache=getattr(run_simulation_json, "from_cache", False),
+        )
+
+    async def run_simulations(
+        self,
+        simulation_id,
+        simulation_data_list,
+        simulation_report=None,
+        max_concurrent_simulations=4,
+        max_status_calls=100,
+        polling_strategy=None,
+        bypass_cache=False,
+        return_exceptions=False,
+    ):
+        """Run many parameterized versions of one simulation concurrently.
+
+        This is an async generator with the same parameters and behavior as
+        SirepoGuestSession.run_simulations, yielding (index, run-status JSON) pairs
+        as simulations complete:
+
+            async for simulation_i, run_status in sirepo_session.run_simulations(...):
+                ...
+
+        With return_exceptions=True a simulation that fails, is canceled, or times out
+        yields (index, SirepoSimulationError) and the remaining simulations keep running.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        if max_concurrent_simulations < 1:
+            raise ValueError(
+                f"max_concurrent_simulations must be at least 1, not {max_concurrent_simulations}"
+            )
+
+        pending_simulation_data = enumerate(simulation_data_list)
+        # the workers put (index, run-status), (index, SirepoSimulationError), or an exception on this queue
+        completed_simulations = asyncio.Queue()
+        scratch_simulation_ids = []
+
+        async def run_simulation_worker():
+            scratch_simulation_id = None
+            for simulation_i, simulation_data in pending_simulation_data:
+                if not bypass_cache:
+                    cached_run_status = self._cached_run_status(simulation_data, simulation_report)
+                    if cached_run_status is not None:
+                        await completed_simulations.put((simulation_i, cached_run_status))
+                        continue
+                if scratch_simulation_id is None:
+                    simulation_model = simulation_data["models"]["simulation"]
+                    scratch_simulation_data = await self.copy_simulation(
+                        simulation_id=simulation_id,
+                        name=f"{simulation_model['name']} {uuid.uuid4().hex[:8]}",
+                        folder=simulation_model["folder"],
+                    )
+                    scratch_simulation_id = scratch_simulation_data["models"]["simulation"]["simulationId"]
+                    scratch_simulation_ids.append(scratch_simulation_id)
+                try:
+                    run_simulation_json = await self.run_simulation(
+                        simulation_id=scratch_simulation_id,
+                        simulation_data=_with_simulation_id(simulation_data, scratch_simulation_id),
+                        simulation_report=simulation_report,
+                        # the cache was checked above
+                        bypass_cache=True,
+                    )
+                    run_status = await self.wait_for_simulation(
+                        run_simulation_json,
+                        max_status_calls=max_status_calls,
+                        polling_strategy=polling_strategy,
+                    )
+                except SirepoSimulationError as simulation_error:
+                    if not return_exceptions:
+                        raise
+                    log.warning("simulation %d failed: %s", simulation_i, simulation_error)
+                    await completed_simulations.put((simulation_i, simulation_error))
+                    continue
+                await completed_simulations.put((simulation_i, run_status))
+
+        async def run_simulation_worker_or_report_error():
+            try:
+                await run_simulation_worker()
+            except Exception as ex:
+                await completed_simulations.put(ex)
+            finally:
+                await completed_simulations.put(None)
+
+        workers = [
+            asyncio.ensure_future(run_simulation_worker_or_report_error())
+            for _ in range(max_concurrent_simulations)
+        ]
+        try:
+            running_worker_count = len(workers)
+            while running_worker_count > 0:
+                completed_simulation = await completed_simulations.get()
+                if completed_simulation is None:
+                    running_worker_count -= 1
+                elif isinstance(completed_simulation, Exception):
+                    raise completed_simulation
+                else:
+                    yield completed_simulation
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await asyncio.gather(
+                *[
+                    self.delete_simulation(scratch_simulation_id)
+                    for scratch_simulation_id in scratch_simulation_ids
+                ]
+            )
+
+    async def _run_status(self, run_status):
+        return await self._post_to_sirepo(
+            f"{self._server_url}/run-status", json=run_status["nextRequest"]
+        )
+
+    def _cached_run_status(self, simulation_data, simulation_report):
+        """
+        Return a completed RunStatus if the result of this simulation is cached, otherwise None.
+        """
+        if self.result_cache is None:
+            return None
+        run_status = self.result_cache.get(
+            simulation_cache_key(
+                simulation_data, simulation_report or simulation_data.get("report"), self.simulation_type
+            )
+        )
+        if run_status is None:
+            return None
+        simulation_stats = SimulationStats()
+        simulation_stats.finish()
+        return RunStatus(run_status, simulation_stats, from_cache=True)
@@ -0,0 +1,142 @@
+"""
+Inputs shared by every sample of a dataset.
+
+Every sample of the intensity datasets is conditioned on the same initial beam
+intensity. Returned with each sample, the initial image is collated into a
+(batch_size, 1, H, W) copy and transferred to the device for every batch. A
+dataset built with shared_initial_intensity=True instead returns
+(image, parameter values) samples and exposes the initial image once, as a
+SharedInitialImage, which keeps a single copy on each device and expands it to
+the batch size as a view:
+
+    dataset = IntensityImageDataset(..., shared_initial_intensity=True)
+    for batch in DataLoader(dataset, batch_size=10):
+        correct_images, images, input_params = batch_to_device(batch, device, dataset.shared_initial_image)
+
+A trained model computes the same features of the initial image for every
+prediction. A ParameterOnlySurrogate computes them once and predicts from the
+parameter values alone:
+
+    surrogate = ParameterOnlySurrogate(model, initial_beam_intensity)
+    images = surrogate(param_vals)
+"""
+import numpy as np
+import torch
+
+
+class SharedInitialImage:
+    """
+    An initial intensity image shared by every sample, copied to each device once.
+
+    Parameters
+    ----------
+    initial_beam_intensity: array-like
+      an (H, W) or (1, H, W) image
+    """
+
+    def __init__(self, initial_beam_intensity):
+        initial_beam_intensity = np.asarray(initial_beam_intensity, dtype=np.float32)
+        self.image = torch.from_numpy(initial_beam_intensity.reshape((1,) + initial_beam_intensity.shape[-2:]))
+        self._device_images = {}
+
+    def __getstate__(self):
+        # DataLoader worker processes get the image, not the device copies
+        state = self.__dict__.copy()
+        state["_device_images"] = {}
+        return state
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(shape={tuple(self.image.shape)})"
+
+    def to(self, device=None):
+        """
+        Return the (1, H, W) image on device, copying it only the first time.
+        """
+        if device is None:
+            return self.image
+        device = torch.device(device)
+        if device not in self._device_images:
+            self._device_images[device] = self.image.to(device)
+        return self._device_images[device]
+
+    def expand(self, batch_size, device=None):
+        """
+        Return a (batch_size, 1, H, W) view of the image on device, without copying it.
+        """
+        return self.to(device)[None].expand(batch_size, -1, -1, -1)
+
+
+def batch_to_device(batch, device=None, shared_initial_image=None):
+    """
+    Return the (correct images, initial images, parameter values) of a batch on device.
+
+    Parameters
+    ----------
+    batch: sequence of Tensor
+      (correct images, initial images, parameter values) from a dataset with a per-sample
+      initial image, or (correct images, parameter values) from a dataset with a shared one
+    device: torch.device or str, optional
+      by default the tensors are not moved
+    shared_initial_image: SharedInitialImage, optional
+      the dataset's shared_initial_image, needed if the batch has no initial images
+    """
+    # non_blocking copies from pinned memory overlap with compute, other copies are unaffected
+    if len(batch) == 3:
+        correct_images, images, input_params = batch
+        if device is not None:
+            images = images.to(device, non_blocking=True)
+    elif len(batch) == 2:
+        if shared_initial_image is None:
+            raise ValueError("a batch without initial images needs the dataset's shared_initial_image")
+        correct_images, input_params = batch
+        images = shared_initial_image.expand(len(correct_images), device)
+    else:
+        raise ValueError(f"a batch has 2 or 3 tensors, not {len(batch)}")
+    if device is not None:
+        correct_images = correct_images.to(device, non_blocking=True)
+        input_params = input_params.to(device, non_blocking=True)
+    return correct_images, images, input_params
+
+
+class ParameterOnlySurrogate(torch.nn.Module):
+    """
+    A trained model with the features of a fixed initial image computed once.
+
+    The model, like u_net.UNet or network.n02.BeamlineModel, splits its forward into
+    image_features(images) and predict_from_features(features, parameter values). The
+    features of the initial image are computed in eval mode when the surrogate is built
+    and kept as a buffer, so each call runs only predict_from_features. Build a new
+    surrogate after the model weights change.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+    initial_beam_intensity: array-like or Tensor
+      an (H, W), (1, H, W), or (1, 1, H, W) image
+    """
+
+    def __init__(self, model, initial_beam_intensity):
+        super().__init__()
+        self.model = model
+        self.parameter_count = model.parameter_count
+        initial_image = torch.as_tensor(initial_beam_intensity, dtype=torch.float32)
+        device = next(model.parameters()).device
+        model.eval()
+        with torch.no_grad():
+            image_features = model.image_features(
+                initial_image.reshape((1, 1) + initial_image.shape[-2:]).to(device)
+            )
+        self.register_buffer("image_features", image_features)
+        # the features are those of the model in eval mode
+        self.eval()
+
+    def forward(self, input_params):
+        """
+        Return the (N, 1, H, W) images predicted for (N, P) parameter values.
+        """
+        input_params = torch.as_tensor(
+            input_params, dtype=self.image_features.dtype, device=self.image_features.device
+        )
+        return self.model.predict_from_features(
+            self.image_features.expand(input_params.shape[0], -1), input_params
+        )
@@ -1,8 +1,9 @@
-import re
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from deep_beamline_simulation.srw_io import read_srw_intensity
+
 
 def open_beam(filename):
     data = np.load(filename)
@@ -10,18 +11,9 @@ def open_beam(filename):
     return data
 
 
-def open_dat(filename):
-    first_ten_lines = pd.read_csv(filename, nrows=9)
-    horizontal_position = str(first_ten_lines.loc[5])
-    vertical_position = str(first_ten_lines.loc[8])
-    horizontal = re.findall("[0-9]{2,300}", horizontal_position)
-    horizontal_shape = int(horizontal[0])
-    vertical = re.findall("[0-9]{2,300}", vertical_position)
-    vertical_shape = int(vertical[0])
-
-    data = pd.read_csv(filename, skiprows=10, header=None)
-    data = data.values.copy()
-    data.resize(vertical_shape, horizontal_shape)
+def open_dat(filename, sidecar=False):
+    # rows are vertical positions and columns horizontal positions
+    data = read_srw_intensity(filename, sidecar=sidecar)
     shaped_data = pd.DataFrame(data)
     return shaped_data
 
@@ -0,0 +1,157 @@
+"""
+Building blocks for the on-disk caches in deep_beamline_simulation.
+
+A cache is a directory of entries. An entry is one or more files sharing a key,
+for example "<key>.json" and "<key>.npy". The modification time of an entry's
+index file records when the entry was last used, and the least recently used
+entries are deleted when the cache grows past its size limit.
+"""
+import hashlib
+import json
+import logging
+import numbers
+import os
+import tempfile
+
+from pathlib import Path
+
+import appdirs
+
+
+def default_cache_directory(*subdirectories):
+    """
+    Return the user cache directory for deep_beamline_simulation, eg. ~/.cache/deep-beamline-simulation.
+    """
+    return Path(appdirs.user_cache_dir("deep-beamline-simulation")).joinpath(*subdirectories)
+
+
+def canonical_hash(obj, float_digits=12):
+    """
+    Return a SHA-256 hex digest of obj that does not depend on dictionary order or float formatting.
+
+    Floats are compared by value after rounding to `float_digits` significant digits, and
+    integers exactly, so 1, 1.0 and 0.1 + 0.9 hash the same but 10**13 and 10**13 + 1 do not.
+    Tuples hash the same as lists.
+
+    Parameters
+    ----------
+    obj: dict, list, tuple, str, int, float, bool, or None
+      any JSON-like structure
+    float_digits: int
+      number of significant digits kept when normalizing numbers
+    """
+    canonical_json = json.dumps(
+        _normalize_numbers(obj, float_digits),
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=True,
+        allow_nan=True,
+    )
+    return hashlib.sha256(canonical_json.encode("ascii")).hexdigest()
+
+
+def _normalize_numbers(obj, float_digits):
+    if isinstance(obj, dict):
+        return {str(key): _normalize_numbers(value, float_digits) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_normalize_numbers(value, float_digits) for value in obj]
+    elif isinstance(obj, bool) or obj is None or isinstance(obj, str):
+        return obj
+    elif isinstance(obj, numbers.Integral):
+        # including numpy integers, exact however many digits they have
+        return int(obj)
+    try:
+        # floats, including numpy floats
+        rounded_obj = float(f"{float(obj):.{float_digits}g}")
+    except (TypeError, ValueError):
+        raise TypeError(f"can not hash object of type {type(obj)}: {obj!r}")
+    if rounded_obj.is_integer():
+        # so 1.0 hashes the same as 1
+        return int(rounded_obj)
+    return rounded_obj
+
+
+def atomic_write(path, write_function, mode="wb"):
+    """
+    Call write_function(file) on a temporary file and then move it to path.
+
+    Readers in other processes never see a partially written file.
+    """
+    path = Path(path)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, mode) as temporary_file:
+            write_function(temporary_file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def mark_used(path):
+    """
+    Record that a cache entry was used by updating the modification time of its index file.
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # the entry was evicted by another process
+        pass
+
+
+def evict_least_recently_used(cache_directory, index_suffix, max_size_bytes, keep=()):
+    """
+    Delete the least recently used entries until the cache is no larger than max_size_bytes.
+
+    Parameters
+    ----------
+    cache_directory: path-like
+      the cache directory
+    index_suffix: str
+      suffix of the file whose modification time records when an entry was last used, eg. ".json"
+    max_size_bytes: int
+      size limit for all files in the cache directory
+    keep: collection of str
+      keys of entries that must not be evicted, for example the entry just written
+
+    Returns
+    -------
+    list of str
+      keys of the evicted entries
+    """
+    log = logging.getLogger("deep_beamline_simulation.disk_cache")
+
+    entry_sizes = {}
+    entry_used_times = {}
+    for cache_path in Path(cache_directory).iterdir():
+        if cache_path.name.startswith("."):
+            # temporary files
+            continue
+        key = cache_path.name.split(".", 1)[0]
+        try:
+            cache_path_stat = cache_path.stat()
+        except FileNotFoundError:
+            continue
+        entry_sizes[key] = entry_sizes.get(key, 0) + cache_path_stat.st_size
+        if cache_path.name == key + index_suffix:
+            entry_used_times[key] = cache_path_stat.st_mtime
+
+    cache_size = sum(entry_sizes.values())
+    evicted_keys = []
+    # entries without an index file were abandoned while being written, so go first
+    for key in sorted(entry_sizes, key=lambda key_: entry_used_times.get(key_, float("-inf"))):
+        if cache_size <= max_size_bytes:
+            break
+        if key in keep:
+            continue
+        for cache_path in Path(cache_directory).glob(f"{key}.*"):
+            try:
+                cache_path.unlink()
+            except FileNotFoundError:
+                pass
+        cache_size -= entry_sizes[key]
+        evicted_keys.append(key)
+        log.debug("evicted cache entry '%s'", key)
+
+    return evicted_keys
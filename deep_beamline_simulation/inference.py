@@ -0,0 +1,642 @@
+"""
+Predict intensity images with a trained surrogate model instead of running SRW.
+
+A checkpoint written by `save_checkpoint` holds the model weights, the
+arguments to build the model, the preprocessed initial intensity, and the
+parameter names. A `SurrogateInferenceEngine` loads it and predicts the
+preprocessed intensity image for each parameter vector:
+
+    engine = SurrogateInferenceEngine.from_checkpoint("unet.pt")
+    images = engine.predict(param_vals)
+
+`export_checkpoint` saves the model as TorchScript or a torch.export program
+instead, with the initial intensity and parameter names in the same file. An
+exported model loads without building the model from this package's code, and
+has less per-call Python overhead. from_checkpoint loads either.
+
+The initial intensity is the same for every prediction, so the engine computes
+the model's features of it once, with a conditioning.ParameterOnlySurrogate, and
+each batch only runs the part of the model that depends on the parameter values.
+export_model(..., parameter_only=True) exports that part alone.
+
+Requests from many threads are batched together: `submit` queues parameter
+vectors and returns a future, and a worker thread runs the model on everything
+queued, up to max_batch_size vectors, waiting at most max_latency_s for more
+requests after the first. `serve_http` puts a local HTTP front end on an engine,
+and running this module serves a checkpoint:
+
+    python -m deep_beamline_simulation.inference unet.pt --port 8000
+    curl -d '{"param_vals": [[0.1, 0.2]]}' http://127.0.0.1:8000/predict
+"""
+import argparse
+import base64
+import concurrent.futures
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import warnings
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from deep_beamline_simulation.conditioning import ParameterOnlySurrogate
+
+
+def _build_unet(**model_kwargs):
+    from deep_beamline_simulation.u_net import UNet
+
+    return UNet(**model_kwargs)
+
+
+def _build_n02_beamline_model(**model_kwargs):
+    from deep_beamline_simulation.network.n02 import build_beamline_model
+
+    return build_beamline_model(**model_kwargs)
+
+
+# files saved with an exported model
+_EXPORT_METADATA_NAME = "surrogate.json"
+_EXPORT_INITIAL_INTENSITY_NAME = "initial_beam_intensity.npy.b64"
+
+# model name -> function building the model from the model_kwargs of a checkpoint
+MODEL_BUILDERS = {
+    "unet": _build_unet,
+    "n02": _build_n02_beamline_model,
+}
+
+
+def _param_names(params):
+    if params is None:
+        return None
+    return [param.decode() if isinstance(param, bytes) else str(param) for param in params]
+
+
+def save_checkpoint(checkpoint_path, model, model_name, model_kwargs, initial_beam_intensity, params=None):
+    """
+    Save a trained model for a SurrogateInferenceEngine.
+
+    Parameters
+    ----------
+    checkpoint_path: path-like
+    model: torch.nn.Module
+    model_name: str
+      a key of MODEL_BUILDERS, "unet" for u_net.UNet or "n02" for the n02 BeamlineModel
+    model_kwargs: dict
+      arguments of the MODEL_BUILDERS function, for example
+      {"input_size": 128, "output_size": 128, "parameter_count": 4} for "unet"
+    initial_beam_intensity: array-like
+      the preprocessed (H, W) initial intensity the model was trained with
+    params: sequence of str, optional
+      names of the parameters, in the order of the parameter vectors
+    """
+    if model_name not in MODEL_BUILDERS:
+        raise ValueError(f"model_name must be one of {sorted(MODEL_BUILDERS)}, not '{model_name}'")
+    torch.save(
+        {
+            "model_name": model_name,
+            "model_kwargs": dict(model_kwargs),
+            "state_dict": model.state_dict(),
+            "initial_beam_intensity": torch.as_tensor(np.asarray(initial_beam_intensity, dtype=np.float32)),
+            "params": _param_names(params),
+        },
+        checkpoint_path,
+    )
+
+
+def load_checkpoint(checkpoint_path, map_location="cpu"):
+    """
+    Return the model, in eval mode, the initial intensity, and the parameter names saved by `save_checkpoint`.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location=map_location)
+    model = MODEL_BUILDERS[checkpoint["model_name"]](**checkpoint["model_kwargs"])
+    model.load_state_dict(checkpoint["state_dict"])
+    model.eval()
+    return model, checkpoint["initial_beam_intensity"].numpy(), checkpoint["params"]
+
+
+def export_model(
+    export_path, model, initial_beam_intensity, params=None, method="script", freeze=True, parameter_only=False
+):
+    """
+    Save a model as a TorchScript or torch.export program, for `load_exported_model` to load
+    without this package's model code.
+
+    The initial intensity and the parameter names are saved in the same file.
+
+    Parameters
+    ----------
+    export_path: path-like
+      torch.export expects the name to end in ".pt2"
+    model: torch.nn.Module
+      a model taking (initial images, parameter values), with a parameter_count attribute
+    initial_beam_intensity: array-like
+      the preprocessed (H, W) initial intensity the model was trained with
+    params: sequence of str, optional
+      names of the parameters
+    method: str
+      "script" to compile the model with torch.jit.script, "trace" to record the operations
+      of one call with torch.jit.trace, or "export" to capture the graph with torch.export
+      for any batch size
+    freeze: bool
+      for "script" and "trace", if True inline the weights and attributes with torch.jit.freeze,
+      which makes each call cheaper
+    parameter_only: bool
+      if True export a ParameterOnlySurrogate of the model, taking only parameter values,
+      with the features of the initial intensity computed once. A model that is already a
+      ParameterOnlySurrogate, like one from quantization.quantize_model, is always exported
+      this way
+    """
+    initial_beam_intensity = np.asarray(initial_beam_intensity, dtype=np.float32)
+    model = model.eval()
+    if isinstance(model, ParameterOnlySurrogate):
+        parameter_only = True
+        model_name = model.model.__class__.__name__
+    else:
+        model_name = model.__class__.__name__
+        if parameter_only:
+            model = ParameterOnlySurrogate(model, initial_beam_intensity)
+    if parameter_only:
+        example_inputs = (torch.zeros(2, model.parameter_count),)
+    else:
+        example_inputs = (
+            torch.from_numpy(initial_beam_intensity).expand(2, 1, -1, -1),
+            torch.zeros(2, model.parameter_count),
+        )
+
+    initial_beam_intensity_npy = io.BytesIO()
+    np.save(initial_beam_intensity_npy, initial_beam_intensity)
+    # torch.export only saves text files
+    extra_files = {
+        _EXPORT_METADATA_NAME: json.dumps(
+            {
+                "params": _param_names(params),
+                "model_name": model_name,
+                "method": method,
+                "parameter_only": parameter_only,
+            }
+        ),
+        _EXPORT_INITIAL_INTENSITY_NAME: base64.b64encode(initial_beam_intensity_npy.getvalue()).decode("ascii"),
+    }
+
+    if method == "export":
+        batch = torch.export.Dim("batch", min=1)
+        exported_program = torch.export.export(
+            model, example_inputs, dynamic_shapes=tuple({0: batch} for _ in example_inputs)
+        )
+        torch.export.save(exported_program, str(export_path), extra_files=extra_files)
+        return
+
+    if method == "script":
+        scripted_model = torch.jit.script(model)
+    elif method == "trace":
+        with torch.no_grad(), warnings.catch_warnings():
+            # the parameter values are already float32 tensors, so as_tensor returns them unchanged
+            warnings.filterwarnings("ignore", message="torch.as_tensor results are registered as constants")
+            scripted_model = torch.jit.trace(model, example_inputs)
+    else:
+        raise ValueError(f"method must be 'script', 'trace', or 'export', not '{method}'")
+    if freeze:
+        scripted_model = torch.jit.freeze(scripted_model)
+    torch.jit.save(scripted_model, str(export_path), _extra_files=extra_files)
+
+
+def export_checkpoint(checkpoint_path, export_path, method="script", freeze=True, parameter_only=False):
+    """
+    Save the model of a checkpoint written by `save_checkpoint` with `export_model`.
+    """
+    model, initial_beam_intensity, params = load_checkpoint(checkpoint_path)
+    export_model(
+        export_path,
+        model,
+        initial_beam_intensity,
+        params=params,
+        method=method,
+        freeze=freeze,
+        parameter_only=parameter_only,
+    )
+
+
+def _read_export_extra_files(export_path):
+    # both TorchScript and torch.export archives keep extra files in "<archive name>/extra/"
+    extra_files = {}
+    with zipfile.ZipFile(export_path) as archive:
+        for name in archive.namelist():
+            directory, _, file_name = name.rpartition("/")
+            if directory.endswith("/extra") and file_name in (
+                _EXPORT_METADATA_NAME,
+                _EXPORT_INITIAL_INTENSITY_NAME,
+            ):
+                extra_files[file_name] = archive.read(name)
+    return extra_files
+
+
+def _export_metadata(path):
+    extra_files = _read_export_extra_files(path)
+    if _EXPORT_METADATA_NAME not in extra_files:
+        return None
+    return json.loads(extra_files[_EXPORT_METADATA_NAME])
+
+
+def is_exported_model(path):
+    """
+    Return True if path was written by `export_model`, False for a `save_checkpoint` checkpoint.
+    """
+    return _export_metadata(path) is not None
+
+
+def load_exported_model(export_path, map_location="cpu"):
+    """
+    Return the model, the initial intensity, and the parameter names saved by `export_model`.
+    """
+    extra_files = _read_export_extra_files(export_path)
+    metadata = json.loads(extra_files[_EXPORT_METADATA_NAME])
+    initial_beam_intensity = np.load(io.BytesIO(base64.b64decode(extra_files[_EXPORT_INITIAL_INTENSITY_NAME])))
+    if metadata["method"] == "export":
+        model = torch.export.load(str(export_path)).module().to(map_location)
+    else:
+        model = torch.jit.load(str(export_path), map_location=map_location)
+    return model, initial_beam_intensity, metadata["params"]
+
+
+class InferenceEngineClosed(RuntimeError):
+    """
+    Raised when a request is submitted to a SurrogateInferenceEngine that is closed.
+    """
+
+
+class _InferenceRequest:
+    def __init__(self, param_vals):
+        self.param_vals = param_vals
+        self.future = concurrent.futures.Future()
+
+
+class SurrogateInferenceEngine:
+    """
+    Predict preprocessed intensity images from parameter vectors, batching concurrent requests.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+      a model taking (initial images, parameter values), like u_net.UNet, or only parameter
+      values if parameter_only is True
+    initial_beam_intensity: array-like
+      the preprocessed (H, W) initial intensity the model was trained with
+    params: sequence of str, optional
+      names of the parameters
+    device: torch.device or str, optional
+      by default CUDA if it is available, otherwise the CPU
+    max_batch_size: int
+      largest number of parameter vectors the model is run on at once
+    max_latency_s: float
+      longest time a request waits for other requests to batch with
+    parameter_only: bool
+      True if the model takes only parameter values, like one exported with parameter_only=True
+    cache_image_features: bool
+      if True and the model has image_features and predict_from_features methods, compute
+      the features of the initial intensity once, with a ParameterOnlySurrogate, instead of
+      for every batch
+    channels_last: bool
+      if True convert the model weights to the channels-last memory layout, which the CPU
+      convolution kernels run fastest on
+    """
+
+    def __init__(
+        self,
+        model,
+        initial_beam_intensity,
+        params=None,
+        device=None,
+        max_batch_size=64,
+        max_latency_s=0.002,
+        parameter_only=False,
+        cache_image_features=True,
+        channels_last=False,
+    ):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        try:
+            self.model.eval()
+        except NotImplementedError:
+            # the module of a torch.export program was exported in eval mode
+            pass
+        initial_beam_intensity = np.asarray(initial_beam_intensity, dtype=np.float32)
+        self.initial_image = torch.from_numpy(
+            initial_beam_intensity.reshape((1, 1) + initial_beam_intensity.shape[-2:])
+        ).to(self.device)
+        if parameter_only:
+            self._parameter_only_model = self.model
+        elif (
+            cache_image_features
+            and hasattr(self.model, "image_features")
+            and hasattr(self.model, "predict_from_features")
+        ):
+            self._parameter_only_model = ParameterOnlySurrogate(self.model, self.initial_image)
+        else:
+            # a frozen or torch.export model, run on the initial image for every batch
+            self._parameter_only_model = None
+        self.params = params
+        self.max_batch_size = max_batch_size
+        self.max_latency_s = max_latency_s
+
+        self.batch_count = 0
+        self.prediction_count = 0
+        self._requests = queue.Queue()
+        self._worker_thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, device=None, **kwargs):
+        """
+        Return an engine for a checkpoint written by `save_checkpoint` or a model written by
+        `export_model`.
+
+        kwargs are passed on to SurrogateInferenceEngine.
+        """
+        if is_exported_model(checkpoint_path):
+            model, initial_beam_intensity, params = load_exported_model(checkpoint_path)
+            kwargs.setdefault("parameter_only", _export_metadata(checkpoint_path).get("parameter_only", False))
+        else:
+            model, initial_beam_intensity, params = load_checkpoint(checkpoint_path)
+        return cls(model, initial_beam_intensity, params=params, device=device, **kwargs)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(model={self.model.__class__.__name__}, device='{self.device}', "
+            f"max_batch_size={self.max_batch_size}, max_latency_s={self.max_latency_s})"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def image_shape(self):
+        return tuple(self.initial_image.shape[-2:])
+
+    def _as_param_vals(self, param_vals):
+        param_vals = np.asarray(param_vals, dtype=np.float32)
+        if param_vals.ndim not in (1, 2):
+            raise ValueError(f"param_vals must be a vector or a 2D array of vectors, not shape {param_vals.shape}")
+        if self.params is not None and param_vals.shape[-1] != len(self.params):
+            raise ValueError(f"parameter vectors have {len(self.params)} values, not {param_vals.shape[-1]}")
+        return param_vals
+
+    def _run_model(self, param_vals):
+        """
+        Return the (N, H, W) images predicted for an (N, P) array of parameter vectors.
+        """
+        images = np.empty((len(param_vals),) + self.image_shape, dtype=np.float32)
+        with torch.inference_mode():
+            for batch_start in range(0, len(param_vals), self.max_batch_size):
+                batch_param_vals = torch.from_numpy(param_vals[batch_start:batch_start + self.max_batch_size])
+                if self._parameter_only_model is not None:
+                    batch_images = self._parameter_only_model(batch_param_vals.to(self.device))
+                else:
+                    batch_images = self.model(
+                        self.initial_image.expand(len(batch_param_vals), -1, -1, -1),
+                        batch_param_vals.to(self.device),
+                    )
+                images[batch_start:batch_start + len(batch_param_vals)] = batch_images[:, 0].cpu().numpy()
+                # predict and the worker thread can run the model at the same time
+                with self._lock:
+                    self.batch_count += 1
+                    self.prediction_count += len(batch_param_vals)
+        return images
+
+    def predict(self, param_vals):
+        """
+        Return the images predicted for param_vals, in the calling thread.
+
+        Parameters
+        ----------
+        param_vals: array-like
+          a parameter vector, or a 2D array with a parameter vector in each row
+
+        Returns
+        -------
+        numpy.ndarray
+          an (H, W) image for a vector, or (N, H, W) images for N vectors
+        """
+        param_vals = self._as_param_vals(param_vals)
+        images = self._run_model(np.atleast_2d(param_vals))
+        return images[0] if param_vals.ndim == 1 else images
+
+    def submit(self, param_vals):
+        """
+        Queue param_vals to be predicted in a batch with other requests.
+
+        Returns
+        -------
+        concurrent.futures.Future
+          the result is what `predict` returns for param_vals
+        """
+        param_vals = self._as_param_vals(param_vals)
+        with self._lock:
+            if self._closed:
+                raise InferenceEngineClosed(f"{self!r} is closed")
+            if self._worker_thread is None:
+                self._worker_thread = threading.Thread(
+                    target=self._serve_requests, name=self.__class__.__name__, daemon=True
+                )
+                self._worker_thread.start()
+            # queued while holding the lock, so close() can not queue the stop marker before it
+            request = _InferenceRequest(param_vals)
+            self._requests.put(request)
+        return request.future
+
+    def _next_batch(self):
+        """
+        Block until a request is queued, then return it with the requests queued within
+        max_latency_s, up to max_batch_size parameter vectors. None means stop.
+        """
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        batch_size = len(np.atleast_2d(request.param_vals))
+        deadline = time.monotonic() + self.max_latency_s
+        while batch_size < self.max_batch_size:
+            try:
+                request = self._requests.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                break
+            if request is None:
+                # stop after this batch
+                self._requests.put(None)
+                break
+            batch.append(request)
+            batch_size += len(np.atleast_2d(request.param_vals))
+        return batch
+
+    def _serve_requests(self):
+        log = logging.getLogger(self.__class__.__name__)
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                images = self._run_model(np.concatenate([np.atleast_2d(request.param_vals) for request in batch]))
+            except Exception as exception:
+                log.exception("prediction failed")
+                for request in batch:
+                    request.future.set_exception(exception)
+                continue
+            image_i = 0
+            for request in batch:
+                if request.param_vals.ndim == 1:
+                    request.future.set_result(images[image_i])
+                    image_i += 1
+                else:
+                    request.future.set_result(images[image_i:image_i + len(request.param_vals)])
+                    image_i += len(request.param_vals)
+
+    def close(self):
+        """
+        Predict the queued requests and stop the worker thread.
+        """
+        with self._lock:
+            self._closed = True
+            worker_thread = self._worker_thread
+        if worker_thread is not None:
+            self._requests.put(None)
+            worker_thread.join()
+
+
+def _make_request_handler(engine):
+    class SurrogateRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.getLogger("deep_beamline_simulation.inference").debug(format, *args)
+
+        def _send(self, status, body, content_type="application/json", headers=()):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for header, value in headers:
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status, obj):
+            self._send(status, json.dumps(obj).encode("utf-8"))
+
+        def do_GET(self):
+            if self.path != "/info":
+                self._send_json(404, {"error": f"no such path '{self.path}'"})
+                return
+            self._send_json(
+                200,
+                {
+                    "params": engine.params,
+                    "image_shape": list(engine.image_shape),
+                    "prediction_count": engine.prediction_count,
+                    "batch_count": engine.batch_count,
+                },
+            )
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": f"no such path '{self.path}'"})
+                return
+            log = logging.getLogger("deep_beamline_simulation.inference")
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(request, dict) or "param_vals" not in request:
+                    raise ValueError('the request body must be a JSON object {"param_vals": [...]}')
+                param_vals = engine._as_param_vals(request["param_vals"])
+            except (ValueError, TypeError) as error:
+                self._send_json(400, {"error": str(error)})
+                return
+            try:
+                images = engine.submit(param_vals).result()
+            except InferenceEngineClosed as error:
+                self._send_json(503, {"error": str(error)})
+                return
+            except Exception as error:
+                log.exception("prediction for %s failed", self.client_address)
+                self._send_json(500, {"error": f"prediction failed: {error}"})
+                return
+            if self.headers.get("Accept") == "application/octet-stream":
+                # the images as float32 bytes in C order, without the cost of JSON
+                self._send(
+                    200,
+                    np.ascontiguousarray(images, dtype="<f4").tobytes(),
+                    content_type="application/octet-stream",
+                    headers=[("X-Image-Shape", ",".join(str(length) for length in images.shape))],
+                )
+            else:
+                self._send_json(200, {"shape": list(images.shape), "images": images.tolist()})
+
+    return SurrogateRequestHandler
+
+
+def serve_http(engine, host="127.0.0.1", port=0):
+    """
+    Return a ThreadingHTTPServer, not yet serving, that predicts images with engine.
+
+    POST /predict with a JSON body {"param_vals": [...]} returns {"shape": [...], "images": [...]},
+    or with "Accept: application/octet-stream" the float32 images with their shape in the
+    X-Image-Shape header. GET /info describes the model. Requests handled at the same time
+    are batched by the engine. Call serve_forever() on the server to handle requests.
+
+    Parameters
+    ----------
+    engine: SurrogateInferenceEngine
+    host: str
+      by default only local connections are accepted
+    port: int
+      by default any free port, see server.server_address
+    """
+    return ThreadingHTTPServer((host, port), _make_request_handler(engine))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve predictions of a surrogate model checkpoint over HTTP.")
+    parser.add_argument("checkpoint_path", help="a checkpoint written by save_checkpoint or export_model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-latency-ms", type=float, default=2.0)
+    parser.add_argument("--channels-last", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    with SurrogateInferenceEngine.from_checkpoint(
+        args.checkpoint_path,
+        device=args.device,
+        max_batch_size=args.max_batch_size,
+        max_latency_s=args.max_latency_ms / 1000,
+        channels_last=args.channels_last,
+    ) as engine:
+        http_server = serve_http(engine, host=args.host, port=args.port)
+        logging.getLogger("deep_beamline_simulation.inference").info(
+            "serving %s on http://%s:%d", engine, *http_server.server_address[:2]
+        )
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""
+Read preprocessed training data from HDF5 on demand.
+
+`build_dataloaders` copies every dataset of preprocessed_results.h5 into memory
+before training. `LazyIntensityImageDataset` instead reads the images the
+DataLoader asks for, so training starts at once and the data can be larger than
+memory. For example:
+
+    dataset = LazyIntensityImageDataset("preprocessed_results.h5", cache_blocks=16)
+    dataloader = DataLoader(dataset, batch_size=10, shuffle=True, num_workers=4)
+
+The file is opened in each process the first time it is read, so the dataset can
+be used with DataLoader worker processes. An uncompressed dataset with
+contiguous layout is memory-mapped instead of read through h5py.
+
+Reading a batch one image at a time costs one HDF5 read, and one collate, for
+each image. Indexed with a list of indices the dataset instead reads each run
+of consecutive images with a single slice and returns stacked tensors. A
+`BlockShuffleBatchSampler` shuffles blocks of consecutive images rather than
+single images, so each batch is a few long runs:
+
+    dataloader = build_lazy_dataloader(dataset, batch_size=10, sampler="block", block_size=64)
+"""
+import collections
+import logging
+import os
+
+import h5py
+import numpy as np
+import torch
+
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
+
+from deep_beamline_simulation.conditioning import SharedInitialImage
+
+
+def contiguous_runs(sorted_indices):
+    """
+    Return (start, stop) of each run of consecutive values in an increasing array of indices.
+    """
+    sorted_indices = np.asarray(sorted_indices, dtype=np.int64)
+    if len(sorted_indices) == 0:
+        return []
+    run_ends = np.flatnonzero(np.diff(sorted_indices) != 1)
+    starts = np.concatenate([[0], run_ends + 1])
+    stops = np.concatenate([run_ends + 1, [len(sorted_indices)]])
+    return [(int(sorted_indices[start]), int(sorted_indices[stop - 1]) + 1) for start, stop in zip(starts, stops)]
+
+
+class LazyH5Array:
+    """
+    A read-only, array-like view of an HDF5 dataset that reads rows on demand.
+
+    Rows are read in blocks of `block_size` rows. If `cache_blocks` is larger than
+    zero the most recently used blocks are kept in memory, which helps when nearby
+    rows are read together, for example with a block-shuffling sampler.
+
+    Parameters
+    ----------
+    h5_path: path-like
+      the HDF5 file
+    dataset_name: str
+      the dataset, eg. "preprocessed_beam_intensities"
+    block_size: int
+      number of rows read at a time when blocks are cached
+    cache_blocks: int
+      number of blocks to keep in memory, 0 to read rows one at a time without caching
+    memmap: bool
+      if True memory-map the dataset when it is contiguous and uncompressed
+    """
+
+    def __init__(self, h5_path, dataset_name, block_size=64, cache_blocks=0, memmap=True):
+        if block_size < 1:
+            raise ValueError(f"block_size must be at least 1, not {block_size}")
+        self.h5_path = h5_path
+        self.dataset_name = dataset_name
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.memmap = memmap
+        with h5py.File(h5_path, mode="r") as h5_file:
+            dataset = h5_file[dataset_name]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+        self._reset()
+
+    def _reset(self):
+        self._pid = None
+        self._h5_file = None
+        self._array = None
+        self._block_cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        # open files and memory maps are not passed to other processes
+        state = dict(self.__dict__)
+        state.update(_pid=None, _h5_file=None, _array=None, _block_cache=collections.OrderedDict())
+        return state
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(h5_path='{self.h5_path}', dataset_name='{self.dataset_name}', "
+            f"shape={self.shape}, block_size={self.block_size}, cache_blocks={self.cache_blocks})"
+        )
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def memory_mapped(self):
+        """
+        True if the dataset is read through a memory map, known after the first read.
+        """
+        return isinstance(self._array, np.memmap)
+
+    def _open(self):
+        """
+        Return the dataset or memory map, opening the file if this process has not opened it yet.
+        """
+        if self._pid != os.getpid():
+            # a forked DataLoader worker must not share the parent's file handle
+            self._reset()
+            self._pid = os.getpid()
+            self._h5_file = h5py.File(self.h5_path, mode="r")
+            dataset = self._h5_file[self.dataset_name]
+            offset = dataset.id.get_offset()
+            if self.memmap and dataset.chunks is None and dataset.compression is None and offset is not None:
+                logging.getLogger(self.__class__.__name__).debug(
+                    "memory-mapping '%s' in '%s'", self.dataset_name, self.h5_path
+                )
+                self._array = np.memmap(
+                    self.h5_path, dtype=dataset.dtype, mode="r", offset=offset, shape=self.shape
+                )
+                self._h5_file.close()
+                self._h5_file = None
+            else:
+                self._array = dataset
+        return self._array
+
+    def close(self):
+        if self._h5_file is not None:
+            self._h5_file.close()
+        self._reset()
+
+    def _read(self, index):
+        rows = self._open()[index]
+        if self.memory_mapped:
+            # copy out of the read-only memory map
+            return np.array(rows)
+        return rows
+
+    def _read_block(self, block_i):
+        block = self._block_cache.get(block_i)
+        if block is None:
+            start = block_i * self.block_size
+            block = self._read(slice(start, min(start + self.block_size, len(self))))
+            self._block_cache[block_i] = block
+            if len(self._block_cache) > self.cache_blocks:
+                self._block_cache.popitem(last=False)
+        else:
+            self._block_cache.move_to_end(block_i)
+        return block
+
+    def read_rows(self, indices):
+        """
+        Return the rows at indices, in the order given.
+
+        If cache_blocks is larger than zero the rows are taken from the cached blocks,
+        reading the blocks that are not cached, otherwise each run of consecutive rows
+        is read with one slice.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f"indices are out of range for {len(self)} rows")
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        rows = np.empty((len(unique_indices),) + self.shape[1:], dtype=self.dtype)
+        if self.cache_blocks > 0:
+            block_indices = unique_indices // self.block_size
+            for block_i in np.unique(block_indices):
+                in_block = block_indices == block_i
+                rows[in_block] = self._read_block(block_i)[unique_indices[in_block] % self.block_size]
+        else:
+            row_i = 0
+            for start, stop in contiguous_runs(unique_indices):
+                rows[row_i:row_i + stop - start] = self._open()[start:stop]
+                row_i += stop - start
+        return rows[inverse]
+
+    def __getitem__(self, index):
+        """
+        Return one row, or a slice of rows with a step of 1, as an in-memory array.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise IndexError("only slices with a step of 1 are supported")
+            return self._read(slice(start, stop))
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"index {index} is out of range for {len(self)} rows")
+        if self.cache_blocks > 0:
+            # copy so the cached block can not be changed through the returned row
+            return self._read_block(index // self.block_size)[index % self.block_size].copy()
+        return self._read(index)
+
+
+class LazyIntensityImageDataset:
+    """
+    The dataset of `build_dataloaders`, reading images from preprocessed_results.h5 on demand.
+
+    Items are (image, initial image, parameter values) like IntensityImageDataset,
+    or (image, parameter values) with shared_initial_intensity=True. The initial
+    intensity and the parameters are small and are read when the dataset is created,
+    the images are read by a LazyH5Array.
+
+    Parameters
+    ----------
+    h5_path: path-like
+      a file written by `preprocess_beam_intensities`
+    indices: sequence of int, optional
+      the images in this dataset, by default every image
+    block_size: int
+      number of images read at a time when blocks are cached
+    cache_blocks: int
+      number of blocks of images to keep in memory in each process
+    memmap: bool
+      if True memory-map the images when they are stored contiguous and uncompressed
+    shared_initial_intensity: bool
+      if True leave the initial image out of the items, it is shared_initial_image
+    """
+
+    def __init__(
+        self, h5_path, indices=None, block_size=64, cache_blocks=0, memmap=True, shared_initial_intensity=False
+    ):
+        self.beam_intensities = LazyH5Array(
+            h5_path,
+            "preprocessed_beam_intensities",
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            memmap=memmap,
+        )
+        if indices is None:
+            indices = np.arange(len(self.beam_intensities))
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        with h5py.File(h5_path, mode="r") as preprocessed_results:
+            self.initial_beam_intensity = np.expand_dims(
+                preprocessed_results["preprocessed_initial_beam_intensity"][()], axis=0
+            )
+            self.params = preprocessed_results["params"][()]
+            self.param_vals = preprocessed_results["preprocessed_param_vals"][()].astype("float32")
+        self.shared_initial_intensity = shared_initial_intensity
+        self.shared_initial_image = SharedInitialImage(self.initial_beam_intensity)
+
+    def __getitem__(self, index):
+        """
+        Returns the specified intensity image at the index given, or a batch of
+        stacked tensors if index is a list of indices
+        """
+        if np.ndim(index) > 0:
+            return self.read_batch(index)
+        image_i = self.indices[index]
+        if self.shared_initial_intensity:
+            return self.beam_intensities[image_i][None], self.param_vals[image_i]
+        return self.beam_intensities[image_i][None], self.initial_beam_intensity, self.param_vals[image_i]
+
+    def read_batch(self, indices):
+        """
+        Return the images, initial images, and parameter values at indices as stacked tensors,
+        or only the images and parameter values with shared_initial_intensity=True.
+
+        Each run of consecutive images is read with a single slice. The initial image
+        tensor is a broadcast view of a single image.
+        """
+        image_indices = self.indices[np.asarray(indices, dtype=np.int64)]
+        images = torch.from_numpy(self.beam_intensities.read_rows(image_indices)[:, None])
+        param_vals = torch.from_numpy(self.param_vals[image_indices])
+        if self.shared_initial_intensity:
+            return images, param_vals
+        return images, self.shared_initial_image.expand(len(image_indices)), param_vals
+
+    def __getitems__(self, indices):
+        """
+        Return the samples at indices, read with `read_batch`, for a DataLoader with a batch_size.
+
+        The DataLoader collates the samples into a batch again, copying them. The
+        DataLoader of `build_lazy_dataloader` uses the stacked tensors of `read_batch` as they are.
+        """
+        return list(zip(*self.read_batch(indices)))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def report(self):
+        """
+        Print information about the current data
+        """
+        print(f"length: {len(self)}")
+        print(f"initial beam intensity.shape:\n{self.initial_beam_intensity.shape}\n")
+        print(f"data shape:\n{(len(self), 1) + self.beam_intensities.shape[1:]}\n")
+        print(f"beamline parameters dtype:\n\t{self.params.dtype}\n")
+        print(f"beamline parameters:\n\t{self.params}\n")
+
+
+class BlockShuffleBatchSampler:
+    """
+    Yield batches of indices from blocks of consecutive indices in random order.
+
+    The indices 0 to length - 1 are split into blocks of `block_size` consecutive
+    indices. The order of the blocks, and of the indices within each block, is
+    shuffled each epoch, and the shuffled indices are cut into batches. A batch
+    then covers a few blocks, which a LazyIntensityImageDataset reads with a few
+    slices, instead of `batch_size` scattered indices.
+
+    Parameters
+    ----------
+    length: int
+      number of indices, the length of the dataset
+    batch_size: int
+      number of indices in each batch
+    block_size: int
+      number of consecutive indices in each block
+    shuffle_within_blocks: bool
+      if True also shuffle the indices within each block
+    drop_last: bool
+      if True do not yield a last batch smaller than batch_size
+    seed: int, optional
+      seed for the random block order, the order still changes from epoch to epoch
+    """
+
+    def __init__(self, length, batch_size, block_size=64, shuffle_within_blocks=True, drop_last=False, seed=None):
+        if batch_size < 1 or block_size < 1:
+            raise ValueError(f"batch_size and block_size must be at least 1, not {batch_size} and {block_size}")
+        self.length = length
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.shuffle_within_blocks = shuffle_within_blocks
+        self.drop_last = drop_last
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.length // self.batch_size
+        return -(-self.length // self.batch_size)
+
+    def __iter__(self):
+        block_starts = np.arange(0, self.length, self.block_size)
+        shuffled_indices = []
+        for block_start in self._rng.permutation(block_starts):
+            block_indices = np.arange(block_start, min(block_start + self.block_size, self.length))
+            if self.shuffle_within_blocks:
+                block_indices = self._rng.permutation(block_indices)
+            shuffled_indices.append(block_indices)
+        shuffled_indices = np.concatenate(shuffled_indices) if shuffled_indices else np.empty(0, dtype=np.int64)
+
+        for batch_start in range(0, len(shuffled_indices), self.batch_size):
+            batch_indices = shuffled_indices[batch_start:batch_start + self.batch_size]
+            if self.drop_last and len(batch_indices) < self.batch_size:
+                break
+            yield batch_indices.tolist()
+
+
+def build_lazy_dataloader(dataset, batch_size, sampler="random", block_size=64, num_workers=0, seed=None):
+    """
+    Return a shuffling DataLoader for a LazyIntensityImageDataset.
+
+    Parameters
+    ----------
+    dataset: LazyIntensityImageDataset
+    batch_size: int
+    sampler: str
+      "random" to shuffle single images, or "block" to shuffle blocks of consecutive
+      images with a BlockShuffleBatchSampler; either way each batch is read as stacked tensors
+    block_size: int
+      for "block", number of consecutive images in each block
+    num_workers: int
+      number of DataLoader worker processes
+    seed: int, optional
+      seed for the order of the images
+    """
+    if sampler == "random":
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        batch_sampler = BatchSampler(RandomSampler(dataset, generator=generator), batch_size, drop_last=False)
+    elif sampler == "block":
+        batch_sampler = BlockShuffleBatchSampler(len(dataset), batch_size, block_size=block_size, seed=seed)
+    else:
+        raise ValueError(f"sampler must be 'random' or 'block', not '{sampler}'")
+    # with batch_size=None the dataset is indexed with a whole batch and returns stacked
+    # tensors, which the DataLoader passes on without collating them again
+    return DataLoader(dataset, batch_size=None, sampler=batch_sampler, num_workers=num_workers)
@@ -0,0 +1,107 @@
+import threading
+import time as ttime
+
+
+class _MetadataCacheEntry:
+    def __init__(self, value, etag, stored_time):
+        self.value = value
+        self.etag = etag
+        self.stored_time = stored_time
+
+
+class SirepoMetadataCache:
+    """
+    An in-memory cache of Sirepo guest logins, simulation lists and simulation data.
+
+    Entries are fresh for `ttl_seconds` after they are stored. A stale entry is
+    kept so its ETag, if the server sent one, can be used to revalidate it with
+    an If-None-Match request.
+
+    Sirepo gives each guest user their own copies of the example simulations,
+    with their own simulation ids. So the cache also keeps the cookies of the
+    guest login, and sessions sharing a cache log in as the same guest user
+    without contacting the server. The cache is thread-safe.
+
+    Parameters
+    ----------
+    ttl_seconds: float
+      number of seconds an entry is used without asking the server, None for no limit
+    """
+
+    def __init__(self, ttl_seconds=300.0):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(ttl_seconds={self.ttl_seconds})"
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def login_key(server_url, simulation_type):
+        return ("login", server_url, simulation_type)
+
+    @staticmethod
+    def simulation_list_key(server_url, simulation_type):
+        return ("simulation-list", server_url, simulation_type)
+
+    @staticmethod
+    def simulation_data_key(server_url, simulation_type, simulation_id):
+        return ("simulation", server_url, simulation_type, simulation_id)
+
+    def get(self, key):
+        """
+        Return (value, etag, fresh) for key, or None if there is no entry for key.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        fresh = self.ttl_seconds is None or ttime.monotonic() - entry.stored_time < self.ttl_seconds
+        return entry.value, entry.etag, fresh
+
+    def put(self, key, value, etag=None):
+        with self._lock:
+            self._entries[key] = _MetadataCacheEntry(value, etag, ttime.monotonic())
+
+    def revalidate(self, key):
+        """
+        Make the entry for key fresh again, for example after a "304 Not Modified" response.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.stored_time = ttime.monotonic()
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry for key, or every entry if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_prefix(self, *key_prefix):
+        """
+        Remove every entry with a key starting with key_prefix.
+
+        For example, remove all simulation data for one server and simulation type with
+
+            metadata_cache.invalidate_prefix("simulation", server_url, simulation_type)
+
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[: len(key_prefix)] == key_prefix]:
+                del self._entries[key]
+
+    def invalidate_server(self, server_url):
+        """
+        Remove every entry for one Sirepo server.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == server_url]:
+                del self._entries[key]
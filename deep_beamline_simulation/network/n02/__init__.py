@@ -1,201 +1,141 @@
-from pathlib import Path
-
 import h5py
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 
-from deep_beamline_simulation.u_net import ImageProcessing
+from deep_beamline_simulation.conditioning import SharedInitialImage, batch_to_device
+from deep_beamline_simulation.lazy_dataset import LazyIntensityImageDataset, build_lazy_dataloader
+from deep_beamline_simulation.preprocessing import (
+    PreprocessingConfig,
+    preprocess_beam_intensities,
+    read_initial_beam_intensity_csv,
+)
+from deep_beamline_simulation.splits import split_indices
+from deep_beamline_simulation.tensor_dataset import TensorBatchLoader, TensorIntensityImageDataset
+
+
+def preprocess(
+    csx_results_h5_path,
+    initial_beam_intensity_csv_path,
+    preprocessed_results_h5_path="preprocessed_results.h5",
+    config=None,
+    chunk_size=64,
+    diagnostics=False,
+    workers=1,
+    preprocessing_cache=None,
+):
+    """
+    Preprocess CSX training data generated with a Sirepo ML script.
 
-import deep_beamline_simulation
-import deep_beamline_simulation.network.n02
+    By default the middle third of each image is kept and resized to 128x128.
+    The initial intensity was generated directly through Sirepo. With a
+    PreprocessingCache the preprocessed file is reused for the same inputs and
+    written to the cache directory instead of preprocessed_results_h5_path.
 
+    Returns
+    -------
+    (int, PreprocessingResult)
+      the number of beamline parameters and a summary of the preprocessed images
+    """
+    if config is None:
+        with h5py.File(csx_results_h5_path, mode="r") as f:
+            image_shape = f["beamIntensities"].shape[1:]
+        config = PreprocessingConfig.centered_crop(image_shape, fraction=1 / 3)
+
+    initial_beam_intensity = read_initial_beam_intensity_csv(initial_beam_intensity_csv_path)
+    if preprocessing_cache is None:
+        preprocessing_result = preprocess_beam_intensities(
+            csx_results_h5_path,
+            preprocessed_results_h5_path,
+            initial_beam_intensity=initial_beam_intensity,
+            config=config,
+            chunk_size=chunk_size,
+            diagnostics=diagnostics,
+            workers=workers,
+        )
+    else:
+        preprocessing_result = preprocessing_cache.preprocess(
+            csx_results_h5_path,
+            initial_beam_intensity=initial_beam_intensity,
+            config=config,
+            chunk_size=chunk_size,
+            diagnostics=diagnostics,
+            workers=workers,
+        )
 
-def preprocess(csx_results_h5_path, initial_beam_intensity_csv_path):
-    dbs_init_path = Path(deep_beamline_simulation.network.n02.__file__)
-    print(dbs_init_path)
+    return preprocessing_result.parameter_count, preprocessing_result
 
-    dbs_repository_path = dbs_init_path.parent.parent
-    print(dbs_repository_path)
 
+class BeamlineModel(nn.Module):
     """
-    Training data was generated for CSX with a Sirepo ML script.
-    """
-    # 500 simulations
-    train_file = dbs_repository_path / "NSLS-II-CSX-10/rsopt-srw-20220228170315/datasets/results.h5"
+    The n02 network, see `build_beamline_model`.
 
+    The class is defined at module level so models can be pickled and scripted with
+    torch.jit.script. forward is image_features followed by predict_from_features, so
+    the features of a fixed initial intensity can be computed once, see
+    conditioning.ParameterOnlySurrogate.
     """
-    Initial intensity data was generated directly through Sirepo.
-    """
-    #initial_beam_intensity_file = dbs_repository_path / "NSLS-II-CSX-10/initial_intensity.csv"
-
-
-    # read results.h5 generated by Sirepo ML script
-    # preprocess the data and write a new h5 file
-    with h5py.File(csx_results_h5_path) as f:
-        beam_intensities = f["beamIntensities"]
-        ip = ImageProcessing(beam_intensities)
-        s = ip.smallest_image_size()
-
-        # this is used later
-        print(f"params.shape: {f['params'].shape}")
-        _parameter_count = f["params"].shape[0]
-
-        # crop the images
-        h = beam_intensities.shape[1]
-        w = beam_intensities.shape[2]
-        hi = 0 + (h // 3)
-        hj = h - (h // 3)
-        wi = 0 + (w // 3)
-        wj = w - (w // 3)
-
-        cropped_beam_intensities = beam_intensities[:, hi:hj, wi:wj]
-        plt.figure()
-        plt.imshow(beam_intensities[0], aspect="auto")
-        plt.title("cropped image")
-        plt.show()
-
-        log_cropped_beam_intensities = np.log(cropped_beam_intensities + 1e-10)
-        plt.figure()
-        plt.hist(log_cropped_beam_intensities.flatten(), bins=100)
-        plt.title("log transformed cropped image data")
-        plt.show()
-
-        normalized_log_cropped_beam_intensities = (log_cropped_beam_intensities - np.mean(
-            log_cropped_beam_intensities)) / np.std(log_cropped_beam_intensities)
-        fig, axs = plt.subplots(nrows=1, ncols=2)
-        axs[0].hist(normalized_log_cropped_beam_intensities.flatten(), bins=300)
-        axs[0].set_title("normalized log transformed cropped image data")
-
-        axs[1].hist(np.std(normalized_log_cropped_beam_intensities, axis=(1, 2)), bins=300)
-        axs[1].set_title("std")
-        plt.show()
-
-        # this may not be necessary
-        bad_image_indices = []
-        good_image_indices = []
-        resized_images = []
-
-        for i in range(normalized_log_cropped_beam_intensities.shape[0]):
-            std = np.std(normalized_log_cropped_beam_intensities[i])
-            if 1e-10 < std:
-                good_image_indices.append(i)
-            else:
-                print(f"rejecting image {i} with std {std:.3e}")
-                bad_image_indices.append(i)
-                # don't plot all bad images, there are about 50
-                if len(bad_image_indices) < 3:
-                    plt.figure()
-                    plt.imshow(
-                        ip.resize(
-                            normalized_log_cropped_beam_intensities[i],
-                            height=128 + 3,
-                            length=128 + 1
-                        ),
-                        aspect="equal"
-                    )
-                    plt.show()
-
-            resized_images.append(
-                ip.resize(
-                    normalized_log_cropped_beam_intensities[i],
-                    height=128 + 3,
-                    length=128 + 1
-                )
-            )
-
-        print(f"bad image count: {len(bad_image_indices)}")
 
-        initial_beam_intensity = pd.read_csv(initial_beam_intensity_csv_path, skiprows=1).to_numpy()
-        min_initial_beam_intensity = np.min(initial_beam_intensity)
-        print(f"min initial beam intensity {min_initial_beam_intensity}")
-        if min_initial_beam_intensity > 0:
-            e = 0.0
-        elif min_initial_beam_intensity == 0.0:
-            e = 1e-10
-        else:
-            e = 1e-10 + np.abs(min_initial_beam_intensity)
-
-        log_initial_beam_intensity = np.log(
-            initial_beam_intensity + e
+    def __init__(self, beamline_down, beamline_middle, beamline_up, parameter_count):
+        super().__init__()
+        self.parameter_count = parameter_count
+        self.beamline_down = beamline_down
+        self.beamline_middle = beamline_middle
+        self.beamline_up = beamline_up
+
+    def image_features(self, image):
+        """
+        Return the flattened (N, F) output of beamline_down for (N, 1, H, W) images.
+
+        Images that do not change, like the initial intensity, need their features
+        computed only once.
+        """
+        # print(f"image.shape: {image.shape}")
+        down_image_filters = self.beamline_down(image)
+        # print(f"down_image_filters.shape: {down_image_filters.shape}")
+        return down_image_filters.reshape(image.shape[0], -1)
+
+    def predict_from_features(self, flat_down_image_filters, radius_scale_factor):
+        """
+        Return the (N, 1, H, W) images predicted from image_features and (N, P) parameter values.
+        """
+        batch_count = flat_down_image_filters.shape[0]
+        radius_scale_factor = torch.as_tensor(
+            radius_scale_factor, dtype=flat_down_image_filters.dtype, device=flat_down_image_filters.device
         )
-        plt.figure()
-        plt.hist(log_initial_beam_intensity.flatten(), bins=100)
-        plt.title("log_initial_beam_intensity")
-        plt.show()
-
-        normalized_initial_beam_intensity = (log_initial_beam_intensity - np.mean(log_initial_beam_intensity)) / np.std(
-            log_initial_beam_intensity)
-        resized_initial_beam_intensity = ip.resize(
-            normalized_initial_beam_intensity,
-            height=128 + 3,
-            length=128 + 1
+        # print(f"radius_scale_factor.shape: {radius_scale_factor.shape}")
+        # print(f"flat_down_image_filters shape: {flat_down_image_filters.shape}")
+
+        radius_scale_factor_embedding = self.beamline_middle(radius_scale_factor)
+        # print(f"radius_scale_factor_embedding shape: {radius_scale_factor_embedding.shape}")
+
+        flat_down_image_filters_with_radius_scale_factor = torch.cat(
+            (
+                flat_down_image_filters,
+                radius_scale_factor_embedding
+            ),
+            dim=1
         )
+        # print(f"flat_down_image_filters_with_radius_scale_factor.shape: {flat_down_image_filters_with_radius_scale_factor.shape}")
+        # for debugging
+        # return flat_down_image_filters_with_radius_scale_factor
+
+        image_filters_with_radius_scale_factor = flat_down_image_filters_with_radius_scale_factor.reshape(
+            batch_count,
+            -1,
+            # if the smallest filter is 32x32 the radius scaled factor embedding must be 1024
+            32,
+            32
+        )
+        # print(f"image_filters_with_radius_scale_factor.shape: {image_filters_with_radius_scale_factor.shape}")
+        image = self.beamline_up(image_filters_with_radius_scale_factor)
 
-        with h5py.File("preprocessed_results.h5", mode="w") as preprocessed_results:
-            good_image_count = len(good_image_indices)
-
-            pi_ds = preprocessed_results.create_dataset(
-                "preprocessed_initial_beam_intensity",
-                (128, 128)
-            )
-            pi_ds[:] = resized_initial_beam_intensity
-
-            params_ds = preprocessed_results.create_dataset_like("params", f["params"])
-            for i, param in enumerate(f["params"]):
-                params_ds[i] = param
+        return image
 
-            pbi_ds = preprocessed_results.create_dataset(
-                "preprocessed_beam_intensities",
-                (good_image_count, 128, 128)
-            )
-            # pbi_ds = preprocessed_results.create_dataset(
-            #     "preprocessed_beam_intensities",
-            #     (f["beamIntensities"].shape[0], 128, 128)
-            # )
-
-            normalized_param_vals_ds = preprocessed_results.create_dataset(
-                "preprocessed_param_vals",
-                (good_image_count, f["paramVals"].shape[1])
-            )
-            # normalized_param_vals_ds = preprocessed_results.create_dataset_like(
-            #     "preprocessed_param_vals",
-            #     f["paramVals"]
-            # )
-
-            normalized_param_vals = (f["paramVals"] - np.mean(f["paramVals"])) / np.std(f["paramVals"])
-            print(f"normalized_param_vals\n{normalized_param_vals}")
-
-            for i, good_i in enumerate(good_image_indices):
-                normalized_param_vals_ds[i] = normalized_param_vals[good_i]
-                pbi_ds[i] = resized_images[good_i]
-
-            # for i, resized_image in enumerate(resized_images):
-            #     normalized_param_vals_ds[i] = normalized_param_vals[i]
-            #     pbi_ds[i] = resized_images[i]
-
-            for good_i in good_image_indices[:10]:
-                # print(pbi_ds[i])
-                print(f"std: {np.std(pbi_ds[good_i])}")
-                f, ax = plt.subplots(nrows=1, ncols=3)
-                ax[0].imshow(beam_intensities[good_i], aspect="equal")
-                ax[1].imshow(normalized_log_cropped_beam_intensities[good_i], aspect="equal")
-                ax[2].imshow(resized_images[good_i], aspect="equal")
-                plt.title(f"{params_ds[:]}\n{normalized_param_vals[good_i, :]}")
-                plt.show()
-
-        with h5py.File("preprocessed_results.h5", mode="r") as preprocessed_results:
-            print(preprocessed_results.keys())
-            print(preprocessed_results["params"])
-            print(preprocessed_results["params"][:])
-            print(preprocessed_results["preprocessed_param_vals"])
-            # print(preprocessed_results["preprocessed_initial_beam_intensity"][0:2, :10])
-
-    return _parameter_count
+    def forward(self, image, radius_scale_factor):
+        return self.predict_from_features(self.image_features(image), radius_scale_factor)
 
 
 def build_beamline_model(parameter_count):
@@ -357,62 +297,23 @@ def build_beamline_model(parameter_count):
         ),
     )
 
-    class BeamlineModel(nn.Module):
-        def __init__(self):
-            super().__init__()
-            self.parameter_count = parameter_count
-            self.beamline_down = beamline_down
-            self.beamline_middle = beamline_middle
-            self.beamline_up = beamline_up
-
-        def forward(self, image, radius_scale_factor):
-            batch_count = image.shape[0]
-
-            # print(f"image.shape: {image.shape}")
-            # print(f"radius_scale_factor.shape: {radius_scale_factor.shape}")
-
-            down_image_filters = self.beamline_down(image)
-            # print(f"down_image_filters.shape: {down_image_filters.shape}")
-            flat_down_image_filters = down_image_filters.reshape(batch_count, -1)
-            # print(f"flat_down_image_filters shape: {flat_down_image_filters.shape}")
-
-            radius_scale_factor_embedding = self.beamline_middle(radius_scale_factor)
-            # print(f"radius_scale_factor_embedding shape: {radius_scale_factor_embedding.shape}")
-
-            flat_down_image_filters_with_radius_scale_factor = torch.cat(
-                (
-                    flat_down_image_filters,
-                    radius_scale_factor_embedding
-                ),
-                dim=1
-            )
-            # print(f"flat_down_image_filters_with_radius_scale_factor.shape: {flat_down_image_filters_with_radius_scale_factor.shape}")
-            # for debugging
-            # return flat_down_image_filters_with_radius_scale_factor
-
-            image_filters_with_radius_scale_factor = flat_down_image_filters_with_radius_scale_factor.reshape(
-                batch_count,
-                -1,
-                # if the smallest filter is 32x32 the radius scaled factor embedding must be 1024
-                32,
-                32
-            )
-            # print(f"image_filters_with_radius_scale_factor.shape: {image_filters_with_radius_scale_factor.shape}")
-            image = self.beamline_up(image_filters_with_radius_scale_factor)
-
-            return image
-
-    return BeamlineModel()
+    return BeamlineModel(beamline_down, beamline_middle, beamline_up, parameter_count)
 
 
 class BeamIntensityDataset:
-    def __init__(self, beam_intensities, initial_beam_intensity, params, param_vals):
+    def __init__(
+        self, beam_intensities, initial_beam_intensity, params, param_vals, shared_initial_intensity=False
+    ):
         self.beam_intensities = np.expand_dims(beam_intensities, axis=1)
         self.initial_beam_intensity = np.expand_dims(initial_beam_intensity, axis=0)
         self.params = params
         self.param_vals = param_vals.astype("float32")
+        self.shared_initial_intensity = shared_initial_intensity
+        self.shared_initial_image = SharedInitialImage(self.initial_beam_intensity)
 
     def __getitem__(self, index):
+        if self.shared_initial_intensity:
+            return self.beam_intensities[index], self.param_vals[index]
         return self.beam_intensities[index], self.initial_beam_intensity, self.param_vals[index]
 
     def __len__(self):
@@ -427,7 +328,114 @@ class BeamIntensityDataset:
         print(f"beamline parameters:\n\t{self.params}\n")
 
 
-def build_beam_intensity_dataloaders(preprocessed_results_h5_path, batch_size=20):
+def build_beam_intensity_dataloaders(
+    preprocessed_results_h5_path,
+    batch_size=20,
+    dataset_type="array",
+    block_size=64,
+    cache_blocks=0,
+    num_workers=0,
+    sampler="random",
+    shared_initial_intensity=False,
+    pin_memory=False,
+    split=None,
+    testing_subset="test",
+):
+    """
+    Return training and testing dataloaders for the first two thirds and the last third of the images,
+    or for the training subset and the testing_subset of split, see `split_indices`.
+
+    With dataset_type "lazy" the images are read from the file as they are needed by a
+    LazyIntensityImageDataset instead of being read into memory first, and sampler
+    "block" shuffles blocks of consecutive images, see `build_lazy_dataloader`.
+    With dataset_type "tensor" the images are read into float32 tensors, optionally
+    gathered into pinned memory, and batches are served by a TensorBatchLoader.
+    With shared_initial_intensity=True batches leave out the initial image, which `train`
+    takes from the dataset's shared_initial_image.
+    """
+    training_indices, testing_indices = split_indices(
+        preprocessed_results_h5_path, split=split, testing_subset=testing_subset
+    )
+    if dataset_type == "lazy":
+        training_beam_intensity_dataset = LazyIntensityImageDataset(
+            preprocessed_results_h5_path,
+            indices=training_indices,
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        testing_beam_intensity_dataset = LazyIntensityImageDataset(
+            preprocessed_results_h5_path,
+            indices=testing_indices,
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        training_beam_intensity_dataloader = build_lazy_dataloader(
+            training_beam_intensity_dataset,
+            batch_size,
+            sampler=sampler,
+            block_size=block_size,
+            num_workers=num_workers,
+        )
+        testing_beam_intensity_dataloader = build_lazy_dataloader(
+            testing_beam_intensity_dataset,
+            batch_size,
+            sampler=sampler,
+            block_size=block_size,
+            num_workers=num_workers,
+        )
+        return training_beam_intensity_dataloader, testing_beam_intensity_dataloader
+    elif dataset_type == "tensor":
+        if sampler != "random":
+            raise ValueError(f"the '{sampler}' sampler needs dataset_type 'lazy'")
+        training_beam_intensity_dataset = TensorIntensityImageDataset.from_h5(
+            preprocessed_results_h5_path,
+            indices=training_indices,
+            pin_memory=pin_memory,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        testing_beam_intensity_dataset = TensorIntensityImageDataset.from_h5(
+            preprocessed_results_h5_path,
+            indices=testing_indices,
+            pin_memory=pin_memory,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        return (
+            TensorBatchLoader(training_beam_intensity_dataset, batch_size),
+            TensorBatchLoader(testing_beam_intensity_dataset, batch_size),
+        )
+    elif dataset_type == "array":
+        if sampler != "random":
+            raise ValueError(f"the '{sampler}' sampler needs dataset_type 'lazy'")
+        training_beam_intensity_dataset, testing_beam_intensity_dataset = _build_beam_intensity_datasets(
+            preprocessed_results_h5_path,
+            training_indices,
+            testing_indices,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+    else:
+        raise ValueError(f"dataset_type must be 'array', 'tensor', or 'lazy', not '{dataset_type}'")
+
+    training_beam_intensity_dataloader = DataLoader(
+        training_beam_intensity_dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+    )
+    testing_beam_intensity_dataloader = DataLoader(
+        testing_beam_intensity_dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+    )
+
+    return training_beam_intensity_dataloader, testing_beam_intensity_dataloader
+
+
+def _build_beam_intensity_datasets(
+    preprocessed_results_h5_path, training_indices, testing_indices, shared_initial_intensity=False
+):
     with h5py.File(preprocessed_results_h5_path, mode="r") as preprocessed_results:
         initial_beam_intensity_ds = preprocessed_results["preprocessed_initial_beam_intensity"]
         initial_beam_intensity = np.zeros_like(initial_beam_intensity_ds)
@@ -446,34 +454,22 @@ def build_beam_intensity_dataloaders(preprocessed_results_h5_path, batch_size=20
         beamline_parameter_values = np.zeros_like(beamline_parameter_values_ds)
         beamline_parameter_values[:] = beamline_parameter_values_ds[:]
 
-        half = beam_intensities.shape[0] // 2
-        two_thirds = 2 * (beam_intensities.shape[0] // 3)
-
-        training_beam_intensity_dataset = BeamIntensityDataset(
-            beam_intensities=beam_intensities[:two_thirds],
-            initial_beam_intensity=initial_beam_intensity,
-            params=beamline_parameters,
-            param_vals=beamline_parameter_values[:two_thirds]
-        )
-        training_beam_intensity_dataloader = DataLoader(
-            training_beam_intensity_dataset,
-            batch_size=batch_size,
-            shuffle=True
-        )
-
-        testing_beam_intensity_dataset = BeamIntensityDataset(
-            beam_intensities=beam_intensities[two_thirds:],
-            initial_beam_intensity=initial_beam_intensity,
-            params=beamline_parameters,
-            param_vals=beamline_parameter_values[two_thirds:]
-        )
-        testing_beam_intensity_dataloader = DataLoader(
-            testing_beam_intensity_dataset,
-            batch_size=batch_size,
-            shuffle=True
-        )
+    training_beam_intensity_dataset = BeamIntensityDataset(
+        beam_intensities=beam_intensities[training_indices],
+        initial_beam_intensity=initial_beam_intensity,
+        params=beamline_parameters,
+        param_vals=beamline_parameter_values[training_indices],
+        shared_initial_intensity=shared_initial_intensity,
+    )
+    testing_beam_intensity_dataset = BeamIntensityDataset(
+        beam_intensities=beam_intensities[testing_indices],
+        initial_beam_intensity=initial_beam_intensity,
+        params=beamline_parameters,
+        param_vals=beamline_parameter_values[testing_indices],
+        shared_initial_intensity=shared_initial_intensity,
+    )
 
-    return training_beam_intensity_dataloader, testing_beam_intensity_dataloader
+    return training_beam_intensity_dataset, testing_beam_intensity_dataset
 
 
 def train(
@@ -493,17 +489,20 @@ def train(
         device = torch.device("cpu")
 
     circle_squasher_model.to(device)
+    # datasets built with shared_initial_intensity=True leave the initial image out of the batches
+    train_shared_initial_image = getattr(train_dataloader.dataset, "shared_initial_image", None)
+    test_shared_initial_image = getattr(test_dataloader.dataset, "shared_initial_image", None)
 
     for epoch_i in range(epoch_count):
         training_loss = 0.0
         circle_squasher_model.train()
-        for correct_squashed_circle_images, circle_images, radius_scale_factors in train_dataloader:
+        for batch in train_dataloader:
             optimizer.zero_grad()
 
             # torch calls circle_images 'inputs'
-            circle_images = circle_images.to(device)
-            correct_squashed_circle_images = correct_squashed_circle_images.to(device)
-            radius_scale_factors = radius_scale_factors.to(device)
+            correct_squashed_circle_images, circle_images, radius_scale_factors = batch_to_device(
+                batch, device, train_shared_initial_image
+            )
 
             predicted_squashed_circle_images = circle_squasher_model(
                 circle_images,
@@ -524,11 +523,11 @@ def train(
 
         test_loss = 0.0
         circle_squasher_model.eval()
-        for correct_squashed_circle_images, circle_images, radius_scale_factors in test_dataloader:
+        for batch in test_dataloader:
             # torch calls circle_images 'inputs'
-            circle_images = circle_images.to(device)
-            correct_squashed_circle_images = correct_squashed_circle_images.to(device)
-            radius_scale_factors = radius_scale_factors.to(device)
+            correct_squashed_circle_images, circle_images, radius_scale_factors = batch_to_device(
+                batch, device, test_shared_initial_image
+            )
 
             predicted_squashed_circle_images = circle_squasher_model(
                 circle_images,
@@ -0,0 +1,170 @@
+"""
+Strategies for deciding when to make the next Sirepo run-status call.
+
+A polling strategy is asked for the delay before each run-status call with
+
+    delay = polling_strategy.next_delay(
+        status_call_count, elapsed_seconds, next_request_seconds
+    )
+
+where `status_call_count` is the number of run-status calls already made for the
+simulation, `elapsed_seconds` is the time since the simulation was started, and
+`next_request_seconds` is Sirepo's suggested delay. A delay of None means stop waiting.
+
+Strategies keep no per-simulation state so one strategy can be shared by many
+concurrent simulations. Timing for each simulation is kept by SimulationStats.
+"""
+import time as ttime
+
+
+class PollingStrategy:
+    def next_delay(self, status_call_count, elapsed_seconds, next_request_seconds):
+        """
+        Return the number of seconds to wait before the next run-status call, or None to stop waiting.
+        """
+        raise NotImplementedError()
+
+
+class FixedPolling(PollingStrategy):
+    """
+    Wait the same number of seconds before every run-status call.
+    """
+
+    def __init__(self, interval_seconds):
+        self.interval_seconds = interval_seconds
+
+    def next_delay(self, status_call_count, elapsed_seconds, next_request_seconds):
+        return self.interval_seconds
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(interval_seconds={self.interval_seconds})"
+
+
+class ServerHintedPolling(PollingStrategy):
+    """
+    Wait the number of seconds suggested by Sirepo's nextRequestSeconds.
+
+    This was the only behavior before polling strategies were introduced.
+    """
+
+    def next_delay(self, status_call_count, elapsed_seconds, next_request_seconds):
+        return next_request_seconds
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class ExponentialBackoffPolling(PollingStrategy):
+    """
+    Start with a short delay and multiply it by `factor` after each run-status call.
+
+    Short simulations are noticed soon after they complete, while long simulations
+    are polled no more often than every `max_seconds`. If `use_server_hint` is True
+    the delay is also capped by Sirepo's nextRequestSeconds.
+    """
+
+    def __init__(self, initial_seconds=0.02, factor=2.0, max_seconds=5.0, use_server_hint=True):
+        self.initial_seconds = initial_seconds
+        self.factor = factor
+        self.max_seconds = max_seconds
+        self.use_server_hint = use_server_hint
+
+    def next_delay(self, status_call_count, elapsed_seconds, next_request_seconds):
+        delay = min(self.initial_seconds * self.factor**status_call_count, self.max_seconds)
+        if self.use_server_hint and next_request_seconds is not None:
+            delay = min(delay, next_request_seconds)
+        return delay
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(initial_seconds={self.initial_seconds}, factor={self.factor}, "
+            f"max_seconds={self.max_seconds}, use_server_hint={self.use_server_hint})"
+        )
+
+
+class DeadlinePolling(PollingStrategy):
+    """
+    Stop waiting `timeout_seconds` after the simulation started.
+
+    The delays come from `polling_strategy` but never extend past the deadline.
+    """
+
+    def __init__(self, timeout_seconds, polling_strategy=None):
+        self.timeout_seconds = timeout_seconds
+        if polling_strategy is None:
+            self.polling_strategy = ExponentialBackoffPolling()
+        else:
+            self.polling_strategy = polling_strategy
+
+    def next_delay(self, status_call_count, elapsed_seconds, next_request_seconds):
+        remaining_seconds = self.timeout_seconds - elapsed_seconds
+        if remaining_seconds <= 0:
+            return None
+        delay = self.polling_strategy.next_delay(status_call_count, elapsed_seconds, next_request_seconds)
+        if delay is None:
+            return None
+        return min(delay, remaining_seconds)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(timeout_seconds={self.timeout_seconds}, "
+            f"polling_strategy={self.polling_strategy!r})"
+        )
+
+
+def default_polling_strategy():
+    return ExponentialBackoffPolling()
+
+
+class SimulationStats:
+    """
+    Timing for one simulation from the run-simulation request to the final run-status response.
+
+    Attributes
+    ----------
+    status_call_count: int
+      number of run-status calls
+    status_call_seconds: list of float
+      round-trip time of each run-status call
+    sleep_seconds: float
+      total time spent waiting between run-status calls
+    elapsed_seconds: float
+      time from the start of the simulation to its completion, or to now if it has not completed
+    """
+
+    def __init__(self):
+        self.start_time = ttime.monotonic()
+        self.end_time = None
+        self.status_call_count = 0
+        self.status_call_seconds = []
+        self.sleep_seconds = 0.0
+
+    def record_sleep(self, sleep_seconds):
+        self.sleep_seconds += sleep_seconds
+
+    def record_status_call(self, status_call_seconds):
+        self.status_call_count += 1
+        self.status_call_seconds.append(status_call_seconds)
+
+    def finish(self):
+        self.end_time = ttime.monotonic()
+
+    @property
+    def elapsed_seconds(self):
+        if self.end_time is None:
+            return ttime.monotonic() - self.start_time
+        else:
+            return self.end_time - self.start_time
+
+    @property
+    def mean_status_call_seconds(self):
+        if self.status_call_count == 0:
+            return 0.0
+        return sum(self.status_call_seconds) / self.status_call_count
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(status_call_count={self.status_call_count}, "
+            f"elapsed_seconds={self.elapsed_seconds:.3f}, sleep_seconds={self.sleep_seconds:.3f}, "
+            f"mean_status_call_seconds={self.mean_status_call_seconds:.4f})"
+        )
@@ -0,0 +1,610 @@
+"""
+Preprocess simulated beam intensities for training.
+
+A results.h5 file written by a parameter sweep, or by an rsopt export, holds
+every simulated intensity in the "beamIntensities" dataset. Preprocessing crops
+each image, takes the log, normalizes by the mean and standard deviation of the
+whole dataset, rejects blank images, and resizes the rest for the network.
+
+`preprocess_beam_intensities` does this in two passes over the file, reading a
+chunk of images at a time. The first pass accumulates the dataset mean and
+standard deviation with `RunningStatistics`, the second normalizes and resizes
+each chunk and writes it to preprocessed_results.h5. Memory use depends on the
+chunk size, not on the number of images.
+
+With `workers` larger than 1 the chunks of each pass are spread over worker
+processes, each opening the file to read its own chunks. The chunk statistics
+are merged in chunk order and every image is written to its place, so the
+preprocessed file is the same as with a single worker.
+
+The preprocessing steps are described by a `PreprocessingConfig`, and nothing
+is plotted. Diagnostics, streaming summaries of the intensities, are computed
+only when asked for and can be plotted afterwards:
+
+    result = preprocess_beam_intensities("results.h5", config=PreprocessingConfig(), diagnostics=True)
+    result.diagnostics.plot()
+"""
+import json
+import logging
+
+import cv2
+import h5py
+import numpy as np
+import pandas as pd
+
+from deep_beamline_simulation.srw_runner import run_tasks
+
+# number of bins in the diagnostic histogram of normalized intensities
+_HISTOGRAM_BIN_COUNT = 300
+
+
+class RunningStatistics:
+    """
+    Count, mean and variance of a stream of values, updated a chunk at a time.
+
+    The moments of each chunk are merged with those accumulated so far using
+    the parallel form of Welford's algorithm, so the result does not depend on
+    holding all values in memory, and statistics of separate streams can be
+    combined with `merge`.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        # sum of squared differences from the mean
+        self.m2 = m2
+
+    @classmethod
+    def from_values(cls, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return cls()
+        mean = values.mean()
+        return cls(count=values.size, mean=mean, m2=np.square(values - mean).sum())
+
+    def merge(self, other):
+        """
+        Add the values accumulated by another RunningStatistics.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    def update(self, values):
+        """
+        Add an array of values.
+        """
+        return self.merge(RunningStatistics.from_values(values))
+
+    @property
+    def variance(self):
+        """
+        The population variance, like np.var.
+        """
+        if self.count == 0:
+            return np.nan
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(count={self.count}, mean={self.mean}, std={self.std})"
+
+
+class PreprocessingConfig:
+    """
+    The preprocessing steps applied to each image.
+
+    Parameters
+    ----------
+    crop_box: (int, int, int, int)
+      first and last row and first and last column of the cropped images, None for the image edge
+    log_epsilon: float
+      added to the intensities before taking the log
+    normalization: str
+      "global" to normalize by the mean and std of the whole dataset, "per_image" to normalize
+      each image by its own mean and std, or "none"
+    image_size: (int, int)
+      height and width of the preprocessed images
+    rejection_std: float
+      images whose normalized standard deviation is not larger than this are rejected as blank,
+      with "per_image" normalization the std of the log image is compared
+    """
+
+    normalizations = ("global", "per_image", "none")
+
+    def __init__(
+        self,
+        crop_box=(None, None, 400, 650),
+        log_epsilon=1e-10,
+        normalization="global",
+        image_size=(128, 128),
+        rejection_std=1e-10,
+    ):
+        if len(crop_box) != 4:
+            raise ValueError(f"crop_box must be (first row, last row, first column, last column), not {crop_box}")
+        if normalization not in self.normalizations:
+            raise ValueError(f"normalization must be one of {self.normalizations}, not '{normalization}'")
+        if len(image_size) != 2:
+            raise ValueError(f"image_size must be (height, width), not {image_size}")
+        self.crop_box = tuple(crop_box)
+        self.log_epsilon = log_epsilon
+        self.normalization = normalization
+        self.image_size = tuple(image_size)
+        self.rejection_std = rejection_std
+
+    @classmethod
+    def centered_crop(cls, image_shape, fraction=1 / 3, **kwargs):
+        """
+        Return a PreprocessingConfig cropping `fraction` of the image height and width from each side.
+        """
+        height, width = image_shape
+        row_margin = int(height * fraction)
+        column_margin = int(width * fraction)
+        crop_box = (row_margin, height - row_margin, column_margin, width - column_margin)
+        return cls(crop_box=crop_box, **kwargs)
+
+    def to_dict(self):
+        return {
+            "crop_box": list(self.crop_box),
+            "log_epsilon": self.log_epsilon,
+            "normalization": self.normalization,
+            "image_size": list(self.image_size),
+            "rejection_std": self.rejection_std,
+        }
+
+    @classmethod
+    def from_dict(cls, config_dict):
+        return cls(**config_dict)
+
+    def __eq__(self, other):
+        return isinstance(other, PreprocessingConfig) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())})"
+
+
+class PreprocessingDiagnostics:
+    """
+    Streaming summaries of a preprocessing run, computed only when asked for.
+
+    Attributes
+    ----------
+    log_intensity_statistics: RunningStatistics
+      mean and std of the cropped log intensities of every image
+    log_intensity_range: (float, float)
+      minimum and maximum cropped log intensity
+    image_stds: numpy.ndarray
+      normalized standard deviation of each image, the quantity compared to rejection_std
+    histogram_counts: numpy.ndarray
+      histogram of the normalized intensities of the images that were written
+    histogram_bin_edges: numpy.ndarray
+      edges of the histogram bins
+    """
+
+    def __init__(self, log_intensity_statistics, log_intensity_range, image_stds, histogram_bin_edges):
+        self.log_intensity_statistics = log_intensity_statistics
+        self.log_intensity_range = log_intensity_range
+        self.image_stds = image_stds
+        self.histogram_bin_edges = histogram_bin_edges
+        self.histogram_counts = np.zeros(len(histogram_bin_edges) - 1, dtype=np.int64)
+
+    def to_dict(self):
+        return {
+            "log_intensity_count": int(self.log_intensity_statistics.count),
+            "log_intensity_mean": float(self.log_intensity_statistics.mean),
+            "log_intensity_std": float(self.log_intensity_statistics.std),
+            "log_intensity_range": [float(v) for v in self.log_intensity_range],
+            "image_std_range": [float(np.min(self.image_stds)), float(np.max(self.image_stds))],
+        }
+
+    def plot(self, axs=None):
+        """
+        Plot the histogram of normalized intensities and of the image standard deviations.
+        """
+        import matplotlib.pyplot as plt
+
+        if axs is None:
+            _, axs = plt.subplots(nrows=1, ncols=2)
+        axs[0].stairs(self.histogram_counts, self.histogram_bin_edges, fill=True)
+        axs[0].set_title("Normalized Log Transformed Cropped Image Data")
+        axs[1].hist(self.image_stds, bins=min(300, max(len(self.image_stds), 1)))
+        axs[1].set_title("STD")
+        return axs
+
+
+class PreprocessingResult:
+    """
+    Summary of a `preprocess_beam_intensities` call.
+
+    Attributes
+    ----------
+    preprocessed_results_path: path-like
+      the file written
+    parameter_count: int
+      number of beamline parameters
+    image_count: int
+      number of images read
+    good_image_indices: numpy.ndarray
+      indices of the images written to the preprocessed file, in order
+    rejected_image_indices: numpy.ndarray
+      indices of the blank images that were not written
+    log_intensity_statistics: RunningStatistics
+      mean and standard deviation of the cropped log intensities
+    config: PreprocessingConfig
+      the preprocessing steps
+    diagnostics: PreprocessingDiagnostics or None
+      summaries of the intensities, if they were asked for
+    """
+
+    def __init__(
+        self,
+        preprocessed_results_path,
+        parameter_count,
+        image_count,
+        good_image_indices,
+        rejected_image_indices,
+        log_intensity_statistics,
+        config,
+        diagnostics=None,
+    ):
+        self.preprocessed_results_path = preprocessed_results_path
+        self.parameter_count = parameter_count
+        self.image_count = image_count
+        self.good_image_indices = good_image_indices
+        self.rejected_image_indices = rejected_image_indices
+        self.log_intensity_statistics = log_intensity_statistics
+        self.config = config
+        self.diagnostics = diagnostics
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(preprocessed_results_path='{self.preprocessed_results_path}', "
+            f"image_count={self.image_count}, rejected_image_count={len(self.rejected_image_indices)})"
+        )
+
+
+def resize_images(images, image_size):
+    """
+    Resize each image in a (n, height, width) array to image_size (height, width) with cubic interpolation.
+    """
+    resized_images = np.empty((images.shape[0],) + tuple(image_size), dtype=images.dtype)
+    for image_i, image in enumerate(images):
+        # cv2 takes the size as (width, height)
+        resized_images[image_i] = cv2.resize(
+            image, dsize=(image_size[1], image_size[0]), interpolation=cv2.INTER_CUBIC
+        )
+    return resized_images
+
+
+def preprocess_initial_beam_intensity(initial_beam_intensity, image_size=(128, 128)):
+    """
+    Log transform, normalize, and resize the initial beam intensity.
+
+    The log is taken after shifting the intensity so its minimum is positive.
+    """
+    initial_beam_intensity = np.asarray(initial_beam_intensity, dtype=np.float64)
+    min_initial_beam_intensity = np.min(initial_beam_intensity)
+    if min_initial_beam_intensity > 0:
+        e = 0.0
+    elif min_initial_beam_intensity == 0.0:
+        e = 1e-10
+    else:
+        e = 1e-10 + np.abs(min_initial_beam_intensity)
+
+    log_initial_beam_intensity = np.log(initial_beam_intensity + e)
+    normalized_initial_beam_intensity = (
+        log_initial_beam_intensity - np.mean(log_initial_beam_intensity)
+    ) / np.std(log_initial_beam_intensity)
+    return resize_images(normalized_initial_beam_intensity[None], image_size)[0]
+
+
+def read_initial_beam_intensity_csv(initial_beam_intensity_csv_path):
+    """
+    Read an initial intensity exported from Sirepo as CSV, the first line is a title.
+    """
+    return pd.read_csv(initial_beam_intensity_csv_path, skiprows=1).to_numpy()
+
+
+def _chunk_slices(image_count, hdf5_chunks, chunk_size):
+    """
+    Return slices of at most chunk_size images, aligned with the HDF5 chunks of the dataset.
+    """
+    if hdf5_chunks is not None:
+        # read whole HDF5 chunks so no chunk is decompressed twice
+        hdf5_chunk_size = hdf5_chunks[0]
+        chunk_size = max(chunk_size // hdf5_chunk_size, 1) * hdf5_chunk_size
+    return [slice(start, min(start + chunk_size, image_count)) for start in range(0, image_count, chunk_size)]
+
+
+def _log_cropped_images(beam_intensities, image_slice, config):
+    row_start, row_stop, column_start, column_stop = config.crop_box
+    # read only the cropped region of each image
+    cropped_images = beam_intensities[image_slice, row_start:row_stop, column_start:column_stop]
+    return np.log(cropped_images.astype(np.float64) + config.log_epsilon)
+
+
+def _normalize(log_cropped_images, config, mean, std):
+    if config.normalization == "global":
+        return (log_cropped_images - mean) / std
+    elif config.normalization == "per_image":
+        return (
+            log_cropped_images - np.mean(log_cropped_images, axis=(1, 2), keepdims=True)
+        ) / np.std(log_cropped_images, axis=(1, 2), keepdims=True)
+    else:
+        return log_cropped_images
+
+
+def _normalized_range(config, mean, std, log_image_means, log_image_stds, log_image_mins, log_image_maxs):
+    """
+    Return the smallest and largest normalized intensity of the images, from their per-image summaries.
+    """
+    if config.normalization == "global":
+        normalized_mins = (log_image_mins - mean) / std
+        normalized_maxs = (log_image_maxs - mean) / std
+    elif config.normalization == "per_image":
+        normalized_mins = (log_image_mins - log_image_means) / log_image_stds
+        normalized_maxs = (log_image_maxs - log_image_means) / log_image_stds
+    else:
+        normalized_mins = log_image_mins
+        normalized_maxs = log_image_maxs
+    if len(normalized_mins) == 0:
+        return 0.0, 1.0
+    normalized_min = float(np.min(normalized_mins))
+    normalized_max = float(np.max(normalized_maxs))
+    if normalized_max <= normalized_min:
+        normalized_max = normalized_min + 1.0
+    return normalized_min, normalized_max
+
+
+def _first_pass_chunk(beam_intensities, image_slice, config, diagnostics):
+    """
+    Return the moments of the log intensities of a chunk, and the std of each image,
+    with the mean, min and max of each image if diagnostics is True.
+    """
+    log_cropped_images = _log_cropped_images(beam_intensities, image_slice, config)
+    chunk_statistics = RunningStatistics.from_values(log_cropped_images)
+    log_image_summaries = [np.std(log_cropped_images, axis=(1, 2))]
+    if diagnostics:
+        log_image_summaries.extend(
+            [
+                np.mean(log_cropped_images, axis=(1, 2)),
+                np.min(log_cropped_images, axis=(1, 2)),
+                np.max(log_cropped_images, axis=(1, 2)),
+            ]
+        )
+    return chunk_statistics, log_image_summaries
+
+
+def _second_pass_chunk(beam_intensities, image_slice, chunk_good_images, config, mean, std, histogram_bin_edges):
+    """
+    Return the normalized and resized good images of a chunk, and their histogram if histogram_bin_edges is given.
+    """
+    log_cropped_images = _log_cropped_images(beam_intensities, image_slice, config)
+    normalized_images = _normalize(log_cropped_images[chunk_good_images], config, mean, std)
+    histogram_counts = None
+    if histogram_bin_edges is not None:
+        histogram_counts = np.histogram(normalized_images, bins=histogram_bin_edges)[0]
+    return resize_images(normalized_images, config.image_size), histogram_counts
+
+
+def _first_pass_task(results_path, image_slice, config, diagnostics):
+    # each worker process opens the file and reads its own slice
+    with h5py.File(results_path, mode="r") as results:
+        return _first_pass_chunk(results["beamIntensities"], image_slice, config, diagnostics)
+
+
+def _second_pass_task(results_path, image_slice, chunk_good_images, config, mean, std, histogram_bin_edges):
+    with h5py.File(results_path, mode="r") as results:
+        return _second_pass_chunk(
+            results["beamIntensities"], image_slice, chunk_good_images, config, mean, std, histogram_bin_edges
+        )
+
+
+def _run_first_pass(results_path, image_slices, config, diagnostics, workers):
+    """
+    Yield the index of each chunk and its `_first_pass_chunk` result, in any order.
+    """
+    if workers == 1:
+        with h5py.File(results_path, mode="r") as results:
+            beam_intensities = results["beamIntensities"]
+            for chunk_i, image_slice in enumerate(image_slices):
+                yield chunk_i, _first_pass_chunk(beam_intensities, image_slice, config, diagnostics)
+    else:
+        yield from run_tasks(
+            _first_pass_task,
+            [(results_path, image_slice, config, diagnostics) for image_slice in image_slices],
+            max_workers=workers,
+            progress_callback=None,
+        )
+
+
+def _run_second_pass(results_path, image_slices, good_images, config, mean, std, histogram_bin_edges, workers):
+    """
+    Yield the index of each chunk with good images and its `_second_pass_chunk` result, in any order.
+    """
+    chunk_tasks = [
+        (chunk_i, (image_slice, good_images[image_slice], config, mean, std, histogram_bin_edges))
+        for chunk_i, image_slice in enumerate(image_slices)
+        if np.any(good_images[image_slice])
+    ]
+    if workers == 1:
+        with h5py.File(results_path, mode="r") as results:
+            beam_intensities = results["beamIntensities"]
+            for chunk_i, chunk_task in chunk_tasks:
+                yield chunk_i, _second_pass_chunk(beam_intensities, *chunk_task)
+    else:
+        for task_i, chunk_result in run_tasks(
+            _second_pass_task,
+            [(results_path,) + chunk_task for _, chunk_task in chunk_tasks],
+            max_workers=workers,
+            progress_callback=None,
+        ):
+            yield chunk_tasks[task_i][0], chunk_result
+
+
+def preprocess_beam_intensities(
+    results_path,
+    preprocessed_results_path="preprocessed_results.h5",
+    initial_beam_intensity=None,
+    config=None,
+    chunk_size=64,
+    diagnostics=False,
+    workers=1,
+):
+    """
+    Write the preprocessed images, parameters, and initial intensity of a results.h5 file.
+
+    Parameters
+    ----------
+    results_path: path-like
+      a file with "beamIntensities", "params" and "paramVals" datasets
+    preprocessed_results_path: path-like
+      the file to write
+    initial_beam_intensity: numpy.ndarray, optional
+      the intensity before the beamline, written as "preprocessed_initial_beam_intensity"
+    config: PreprocessingConfig, optional
+      the preprocessing steps, by default `PreprocessingConfig()`
+    chunk_size: int
+      number of images read at a time
+    diagnostics: bool
+      if True compute a PreprocessingDiagnostics, available as `result.diagnostics`
+    workers: int
+      number of processes reading and preprocessing chunks, the preprocessed file is the
+      same for any number of workers
+
+    Returns
+    -------
+    PreprocessingResult
+    """
+    log = logging.getLogger("deep_beamline_simulation.preprocessing")
+
+    if config is None:
+        config = PreprocessingConfig()
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, not {workers}")
+
+    with h5py.File(results_path, mode="r") as results:
+        image_count = results["beamIntensities"].shape[0]
+        hdf5_chunks = results["beamIntensities"].chunks
+        params = results["params"][()]
+        param_vals = results["paramVals"][()]
+    parameter_count = params.shape[0]
+    image_slices = _chunk_slices(image_count, hdf5_chunks, chunk_size)
+    workers = min(workers, max(len(image_slices), 1))
+    log.info(
+        "preprocessing %d images from '%s' with %s on %d workers", image_count, results_path, config, workers
+    )
+
+    # first pass: the dataset mean and std, and the std of each image for rejecting blank images
+    chunk_results = [None] * len(image_slices)
+    for chunk_i, chunk_result in _run_first_pass(results_path, image_slices, config, diagnostics, workers):
+        chunk_results[chunk_i] = chunk_result
+    # merge the chunks in order so the result does not depend on which worker finished first
+    log_intensity_statistics = RunningStatistics()
+    for chunk_statistics, _ in chunk_results:
+        log_intensity_statistics.merge(chunk_statistics)
+    log_image_summaries = [
+        np.concatenate([summaries[summary_i] for _, summaries in chunk_results]) if chunk_results else np.empty(0)
+        for summary_i in range(4 if diagnostics else 1)
+    ]
+    log_image_stds = log_image_summaries[0]
+    del chunk_results
+
+    mean = log_intensity_statistics.mean
+    std = log_intensity_statistics.std
+    if config.normalization == "global":
+        # the std of a normalized image is the std of the log image divided by the dataset std
+        image_stds = log_image_stds / std
+    else:
+        image_stds = log_image_stds
+    good_images = image_stds > config.rejection_std
+    good_image_indices = np.flatnonzero(good_images)
+    rejected_image_indices = np.flatnonzero(~good_images)
+    for image_i in rejected_image_indices:
+        log.debug("rejecting image %d with std %.3e", image_i, image_stds[image_i])
+    log.info("bad image count: %d", len(rejected_image_indices))
+
+    preprocessing_diagnostics = None
+    histogram_bin_edges = None
+    if diagnostics:
+        _, log_image_means, log_image_mins, log_image_maxs = log_image_summaries
+        normalized_min, normalized_max = _normalized_range(
+            config,
+            mean,
+            std,
+            log_image_means[good_images],
+            log_image_stds[good_images],
+            log_image_mins[good_images],
+            log_image_maxs[good_images],
+        )
+        histogram_bin_edges = np.linspace(normalized_min, normalized_max, _HISTOGRAM_BIN_COUNT + 1)
+        preprocessing_diagnostics = PreprocessingDiagnostics(
+            log_intensity_statistics=log_intensity_statistics,
+            log_intensity_range=(float(np.min(log_image_mins)), float(np.max(log_image_maxs))),
+            image_stds=image_stds,
+            histogram_bin_edges=histogram_bin_edges,
+        )
+
+    normalized_param_vals = (param_vals - np.mean(param_vals)) / np.std(param_vals)
+
+    with h5py.File(preprocessed_results_path, mode="w") as preprocessed_results:
+        preprocessed_results.attrs["preprocessing_config"] = json.dumps(config.to_dict())
+        preprocessed_results.attrs["log_intensity_mean"] = mean
+        preprocessed_results.attrs["log_intensity_std"] = std
+
+        if initial_beam_intensity is not None:
+            preprocessed_results.create_dataset(
+                "preprocessed_initial_beam_intensity",
+                data=preprocess_initial_beam_intensity(initial_beam_intensity, config.image_size),
+                dtype=np.float32,
+            )
+
+        preprocessed_results.create_dataset("params", data=params)
+
+        preprocessed_results.create_dataset(
+            "preprocessed_param_vals",
+            data=normalized_param_vals[good_image_indices],
+            dtype=np.float32,
+        )
+
+        pbi_ds = preprocessed_results.create_dataset(
+            "preprocessed_beam_intensities",
+            (len(good_image_indices),) + config.image_size,
+            dtype=np.float32,
+        )
+
+        # second pass: normalize, resize, and write the good images of each chunk
+        # where each chunk's first good image goes in the preprocessed dataset
+        good_image_offsets = np.concatenate([[0], np.cumsum(good_images)])
+        for chunk_i, (resized_images, histogram_counts) in _run_second_pass(
+            results_path, image_slices, good_images, config, mean, std, histogram_bin_edges, workers
+        ):
+            good_image_i = good_image_offsets[image_slices[chunk_i].start]
+            pbi_ds[good_image_i:good_image_i + len(resized_images)] = resized_images
+            if preprocessing_diagnostics is not None:
+                preprocessing_diagnostics.histogram_counts += histogram_counts
+
+    if preprocessing_diagnostics is not None:
+        log.info("preprocessing diagnostics: %s", preprocessing_diagnostics.to_dict())
+
+    return PreprocessingResult(
+        preprocessed_results_path=preprocessed_results_path,
+        parameter_count=parameter_count,
+        image_count=image_count,
+        good_image_indices=good_image_indices,
+        rejected_image_indices=rejected_image_indices,
+        log_intensity_statistics=log_intensity_statistics,
+        config=config,
+        diagnostics=preprocessing_diagnostics,
+    )
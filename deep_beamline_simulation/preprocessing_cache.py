@@ -0,0 +1,325 @@
+"""
+An on-disk cache of preprocessed training data.
+
+Preprocessing a results.h5 file gives the same preprocessed_results.h5 as long
+as the file and the preprocessing settings do not change, so the preprocessed
+file can be reused, for example while iterating on model hyperparameters:
+
+    preprocessing_cache = PreprocessingCache()
+    result = preprocessing_cache.preprocess("results.h5", initial_beam_intensity=..., config=...)
+    build_dataloaders(result.preprocessed_results_path, batch_size=10)
+
+Entries are keyed by a digest of the content of results.h5, the initial
+intensity and the PreprocessingConfig. The content digest of a file is
+remembered together with its size and modification time, so an unchanged
+file is not read again to look up its entry.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from pathlib import Path
+
+import numpy as np
+
+from deep_beamline_simulation.disk_cache import (
+    atomic_write,
+    canonical_hash,
+    default_cache_directory,
+    evict_least_recently_used,
+    mark_used,
+)
+from deep_beamline_simulation.preprocessing import (
+    PreprocessingConfig,
+    PreprocessingDiagnostics,
+    PreprocessingResult,
+    RunningStatistics,
+    preprocess_beam_intensities,
+)
+
+# change this when preprocess_beam_intensities writes different files for the same input,
+# so old entries are not used
+PREPROCESSING_VERSION = 1
+
+
+def file_digest(path, block_size=2**20):
+    """
+    Return the SHA-256 hex digest of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def array_digest(array):
+    """
+    Return the SHA-256 hex digest of the dtype, shape, and values of an array.
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode("ascii"))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class PreprocessingCache:
+    """
+    An on-disk cache of preprocessed_results.h5 files.
+
+    Each entry is stored as "<key>.h5", with the PreprocessingResult in "<key>.json"
+    and the diagnostics, if they were computed, in "<key>.diagnostics.npz". When the
+    cache grows past `max_size_bytes` the least recently used entries are deleted.
+
+    Parameters
+    ----------
+    cache_directory: path-like, optional
+      by default a "preprocessed" directory in the user cache directory
+    max_size_bytes: int
+      size limit for the cache, 16 GiB by default
+    """
+
+    def __init__(self, cache_directory=None, max_size_bytes=16 * 2**30):
+        if cache_directory is None:
+            cache_directory = default_cache_directory("preprocessed")
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        # the names of files starting with "." are not cache entries
+        self._source_digests_path = self.cache_directory / ".source_digests.json"
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(cache_directory='{self.cache_directory}', "
+            f"max_size_bytes={self.max_size_bytes})"
+        )
+
+    def _h5_path(self, key):
+        return self.cache_directory / f"{key}.h5"
+
+    def _json_path(self, key):
+        return self.cache_directory / f"{key}.json"
+
+    def _diagnostics_path(self, key):
+        return self.cache_directory / f"{key}.diagnostics.npz"
+
+    def __contains__(self, key):
+        return self._json_path(key).exists()
+
+    def source_digest(self, results_path):
+        """
+        Return the content digest of results_path, reading the file only if its size or
+        modification time changed since the digest was last computed.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        results_path = Path(results_path).resolve()
+        results_stat = results_path.stat()
+        try:
+            with open(self._source_digests_path) as source_digests_file:
+                source_digests = json.load(source_digests_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            source_digests = {}
+
+        source_digest = source_digests.get(str(results_path))
+        if (
+            source_digest is not None
+            and source_digest["size"] == results_stat.st_size
+            and source_digest["mtime_ns"] == results_stat.st_mtime_ns
+        ):
+            return source_digest["digest"]
+
+        log.debug("computing the digest of '%s'", results_path)
+        digest = file_digest(results_path)
+        source_digests[str(results_path)] = {
+            "size": results_stat.st_size,
+            "mtime_ns": results_stat.st_mtime_ns,
+            "digest": digest,
+        }
+        atomic_write(
+            self._source_digests_path,
+            lambda source_digests_file: json.dump(source_digests, source_digests_file),
+            mode="w",
+        )
+        return digest
+
+    def key(self, results_path, config=None, initial_beam_intensity=None):
+        """
+        Return the cache key for preprocessing results_path with config and initial_beam_intensity.
+        """
+        if config is None:
+            config = PreprocessingConfig()
+        return canonical_hash(
+            {
+                "version": PREPROCESSING_VERSION,
+                "source": self.source_digest(results_path),
+                "config": config.to_dict(),
+                "initialBeamIntensity": None
+                if initial_beam_intensity is None
+                else array_digest(np.asarray(initial_beam_intensity, dtype=np.float64)),
+            }
+        )
+
+    def get(self, key, diagnostics=False):
+        """
+        Return the cached PreprocessingResult for key, or None if there is no entry for key,
+        or if diagnostics is True and the entry has no diagnostics.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        try:
+            with open(self._json_path(key)) as result_file:
+                result_dict = json.load(result_file)
+        except FileNotFoundError:
+            log.debug("cache miss '%s'", key)
+            return None
+        if not self._h5_path(key).exists():
+            # the entry was evicted while it was being read
+            return None
+
+        preprocessing_diagnostics = None
+        if diagnostics:
+            try:
+                preprocessing_diagnostics = _load_diagnostics(self._diagnostics_path(key))
+            except FileNotFoundError:
+                log.debug("cache entry '%s' has no diagnostics", key)
+                return None
+
+        mark_used(self._json_path(key))
+        log.debug("cache hit '%s'", key)
+        return PreprocessingResult(
+            preprocessed_results_path=self._h5_path(key),
+            parameter_count=result_dict["parameter_count"],
+            image_count=result_dict["image_count"],
+            good_image_indices=np.array(result_dict["good_image_indices"], dtype=np.int64),
+            rejected_image_indices=np.array(result_dict["rejected_image_indices"], dtype=np.int64),
+            log_intensity_statistics=RunningStatistics(**result_dict["log_intensity_statistics"]),
+            config=PreprocessingConfig.from_dict(result_dict["config"]),
+            diagnostics=preprocessing_diagnostics,
+        )
+
+    def preprocess(
+        self,
+        results_path,
+        initial_beam_intensity=None,
+        config=None,
+        chunk_size=64,
+        diagnostics=False,
+        workers=1,
+        bypass_cache=False,
+    ):
+        """
+        Return the cached PreprocessingResult for results_path, preprocessing it on a cache miss.
+
+        The arguments are those of `preprocess_beam_intensities`. The preprocessed file is
+        `result.preprocessed_results_path`, in the cache directory.
+
+        Parameters
+        ----------
+        bypass_cache: bool
+          if True preprocess even if there is a cached entry, and replace the entry
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        if config is None:
+            config = PreprocessingConfig()
+        key = self.key(results_path, config, initial_beam_intensity)
+        if not bypass_cache:
+            preprocessing_result = self.get(key, diagnostics=diagnostics)
+            if preprocessing_result is not None:
+                log.info("using cached preprocessing of '%s'", results_path)
+                return preprocessing_result
+
+        # preprocess into a temporary file, the names of files starting with "." are not cache entries
+        temporary_h5_path = self.cache_directory / f".{key}.{os.getpid()}.h5.tmp"
+        try:
+            preprocessing_result = preprocess_beam_intensities(
+                results_path,
+                temporary_h5_path,
+                initial_beam_intensity=initial_beam_intensity,
+                config=config,
+                chunk_size=chunk_size,
+                diagnostics=diagnostics,
+                workers=workers,
+            )
+            os.replace(temporary_h5_path, self._h5_path(key))
+        finally:
+            if temporary_h5_path.exists():
+                temporary_h5_path.unlink()
+        preprocessing_result.preprocessed_results_path = self._h5_path(key)
+
+        if preprocessing_result.diagnostics is not None:
+            atomic_write(
+                self._diagnostics_path(key),
+                lambda diagnostics_file: _save_diagnostics(diagnostics_file, preprocessing_result.diagnostics),
+            )
+        # write the index file last, an entry without one is incomplete
+        result_dict = {
+            "results_path": str(results_path),
+            "parameter_count": preprocessing_result.parameter_count,
+            "image_count": preprocessing_result.image_count,
+            "good_image_indices": preprocessing_result.good_image_indices.tolist(),
+            "rejected_image_indices": preprocessing_result.rejected_image_indices.tolist(),
+            "log_intensity_statistics": {
+                "count": int(preprocessing_result.log_intensity_statistics.count),
+                "mean": float(preprocessing_result.log_intensity_statistics.mean),
+                "m2": float(preprocessing_result.log_intensity_statistics.m2),
+            },
+            "config": config.to_dict(),
+        }
+        atomic_write(self._json_path(key), lambda json_file: json.dump(result_dict, json_file), mode="w")
+        evict_least_recently_used(self.cache_directory, ".json", self.max_size_bytes, keep={key})
+        return preprocessing_result
+
+    def invalidate(self, key):
+        """
+        Remove the entry for key if it exists.
+        """
+        for cache_path in (self._json_path(key), self._h5_path(key), self._diagnostics_path(key)):
+            if cache_path.exists():
+                cache_path.unlink()
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        for cache_path in self.cache_directory.iterdir():
+            if cache_path.is_file():
+                cache_path.unlink()
+
+    @property
+    def size_bytes(self):
+        return sum(
+            cache_path.stat().st_size
+            for cache_path in self.cache_directory.iterdir()
+            if not cache_path.name.startswith(".")
+        )
+
+
+def _save_diagnostics(diagnostics_file, preprocessing_diagnostics):
+    np.savez(
+        diagnostics_file,
+        log_intensity_moments=[
+            preprocessing_diagnostics.log_intensity_statistics.count,
+            preprocessing_diagnostics.log_intensity_statistics.mean,
+            preprocessing_diagnostics.log_intensity_statistics.m2,
+        ],
+        log_intensity_range=preprocessing_diagnostics.log_intensity_range,
+        image_stds=preprocessing_diagnostics.image_stds,
+        histogram_counts=preprocessing_diagnostics.histogram_counts,
+        histogram_bin_edges=preprocessing_diagnostics.histogram_bin_edges,
+    )
+
+
+def _load_diagnostics(diagnostics_path):
+    with np.load(diagnostics_path) as diagnostics_npz:
+        count, mean, m2 = diagnostics_npz["log_intensity_moments"]
+        preprocessing_diagnostics = PreprocessingDiagnostics(
+            log_intensity_statistics=RunningStatistics(count=int(count), mean=mean, m2=m2),
+            log_intensity_range=tuple(diagnostics_npz["log_intensity_range"].tolist()),
+            image_stds=diagnostics_npz["image_stds"],
+            histogram_bin_edges=diagnostics_npz["histogram_bin_edges"],
+        )
+        preprocessing_diagnostics.histogram_counts = diagnostics_npz["histogram_counts"]
+    return preprocessing_diagnostics
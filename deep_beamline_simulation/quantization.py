@@ -0,0 +1,343 @@
+"""
+Post-training int8 quantization of surrogate models for CPU inference.
+
+`quantize_model` makes a ParameterOnlySurrogate of a trained UNet or n02
+BeamlineModel, so the features of the initial intensity are computed once in
+float32, then quantizes what runs for each prediction:
+
+- Linear layers are quantized dynamically, the activations are quantized on
+  the fly for each call, so they need no calibration.
+- Conv2d layers are quantized statically, with activation ranges observed on
+  calibration parameter values read from preprocessed_results.h5.
+
+The weights are converted to the channels-last memory layout, which the CPU
+convolution kernels run fastest on. `quantize_checkpoint` quantizes a
+checkpoint written by inference.save_checkpoint, calibrated on training images
+and compared with the float model on the held-out images, and saves it for a
+SurrogateInferenceEngine:
+
+    quantized_model, report = quantize_checkpoint(
+        "unet_checkpoint.pt", "preprocessed_results.h5", export_path="unet_int8.pt"
+    )
+    engine = SurrogateInferenceEngine.from_checkpoint("unet_int8.pt", device="cpu")
+
+or from the command line:
+
+    python -m deep_beamline_simulation.quantization unet_checkpoint.pt preprocessed_results.h5 unet_int8.pt
+
+Quantized models only run on the CPU.
+"""
+import argparse
+import copy
+import io
+import json
+import logging
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from deep_beamline_simulation.conditioning import ParameterOnlySurrogate
+from deep_beamline_simulation.inference import export_model, load_checkpoint
+from deep_beamline_simulation.splits import split_indices
+from deep_beamline_simulation.tensor_dataset import TensorIntensityImageDataset
+
+
+def _quantization_backend(backend=None):
+    # "x86" and "fbgemm" for x86 CPUs, "qnnpack" for ARM CPUs
+    supported_engines = torch.backends.quantized.supported_engines
+    if backend is None:
+        backend = next(
+            (engine for engine in ("x86", "fbgemm", "qnnpack") if engine in supported_engines),
+            torch.backends.quantized.engine,
+        )
+    if backend not in supported_engines:
+        raise ValueError(f"quantization backend '{backend}' is not one of {supported_engines}")
+    torch.backends.quantized.engine = backend
+    return backend
+
+
+def _drop_unused_modules(model, param_vals):
+    """
+    Replace the submodules model does not run for param_vals, like the image_features
+    layers of a ParameterOnlySurrogate, with torch.nn.Identity, and return the modules it runs.
+
+    The unused layers are replaced, not deleted, so the model code still compiles with
+    torch.jit.script.
+    """
+    used_modules = []
+    hooks = [
+        module.register_forward_hook(lambda module, inputs, output: used_modules.append(module))
+        for module in model.modules()
+    ]
+    try:
+        with torch.no_grad():
+            model(param_vals[:1])
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    used_module_ids = {id(module) for module in used_modules}
+
+    def drop_unused_children(parent_module):
+        for child_name, child_module in list(parent_module.named_children()):
+            # a model whose methods, not forward, are called runs only some of its children
+            if any(id(module) in used_module_ids for module in child_module.modules()):
+                drop_unused_children(child_module)
+            else:
+                setattr(parent_module, child_name, torch.nn.Identity())
+
+    drop_unused_children(model)
+    return used_modules
+
+
+def quantize_model(
+    model,
+    initial_beam_intensity,
+    calibration_param_vals,
+    static_convolutions=True,
+    dynamic_linear=True,
+    channels_last=True,
+    batch_size=64,
+    backend=None,
+):
+    """
+    Return an int8 ParameterOnlySurrogate of a trained model, for the CPU.
+
+    The model is copied, not changed. The quantized model only runs the layers that do
+    not compute the features of the initial intensity, the others are left out.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+      a model with image_features and predict_from_features methods, like u_net.UNet
+    initial_beam_intensity: array-like
+      the preprocessed (H, W) initial intensity the model was trained with
+    calibration_param_vals: array-like
+      (N, P) parameter values to observe the Conv2d activation ranges on, like those
+      of the training images
+    static_convolutions: bool
+      if True quantize the Conv2d layers statically
+    dynamic_linear: bool
+      if True quantize the Linear layers dynamically
+    channels_last: bool
+      if True convert the weights to the channels-last memory layout
+    batch_size: int
+      number of calibration parameter vectors run at once
+    backend: str, optional
+      the torch.backends.quantized engine, by default "x86" if it is supported
+    """
+    log = logging.getLogger("deep_beamline_simulation.quantization")
+
+    backend = _quantization_backend(backend)
+    surrogate = ParameterOnlySurrogate(copy.deepcopy(model).cpu(), initial_beam_intensity)
+    if channels_last:
+        surrogate = surrogate.to(memory_format=torch.channels_last)
+    calibration_param_vals = torch.as_tensor(np.asarray(calibration_param_vals, dtype=np.float32))
+
+    used_modules = _drop_unused_modules(surrogate, calibration_param_vals)
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favor of torchao, which is not a dependency
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        warnings.filterwarnings("ignore", message=".*quantized tensor creation functions.*")
+        warnings.filterwarnings("ignore", message=".*reduce_range will be deprecated.*")
+        if static_convolutions:
+            used_convolutions = list(
+                {id(module): module for module in used_modules if isinstance(module, torch.nn.Conv2d)}.values()
+            )
+            # eager mode static quantization: quantize the input and dequantize the output of each
+            # convolution, so the model code needs no QuantStub or DeQuantStub
+            for parent_module in list(surrogate.modules()):
+                for child_name, child_module in list(parent_module.named_children()):
+                    if any(child_module is convolution for convolution in used_convolutions):
+                        quantized_convolution = torch.ao.quantization.QuantWrapper(child_module)
+                        quantized_convolution.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+                        setattr(parent_module, child_name, quantized_convolution)
+            torch.ao.quantization.prepare(surrogate, inplace=True)
+            with torch.no_grad():
+                for batch_start in range(0, len(calibration_param_vals), batch_size):
+                    surrogate(calibration_param_vals[batch_start:batch_start + batch_size])
+            torch.ao.quantization.convert(surrogate, inplace=True)
+            log.info(
+                "quantized %d Conv2d layers with %d calibration vectors",
+                len(used_convolutions),
+                len(calibration_param_vals),
+            )
+        if dynamic_linear:
+            surrogate = torch.ao.quantization.quantize_dynamic(surrogate, {torch.nn.Linear}, dtype=torch.qint8)
+    return surrogate.eval()
+
+
+def model_size(model):
+    """
+    Return the number of bytes of the saved state_dict of a model.
+    """
+    state_dict_file = io.BytesIO()
+    torch.save(model.state_dict(), state_dict_file)
+    return len(state_dict_file.getvalue())
+
+
+def _predict(model, param_vals, batch_size):
+    with torch.inference_mode():
+        return torch.cat(
+            [
+                model(param_vals[batch_start:batch_start + batch_size])
+                for batch_start in range(0, len(param_vals), batch_size)
+            ]
+        )
+
+
+def _seconds_per_prediction(model, param_vals, batch_size, repeat=3):
+    # the first call is not timed, it allocates buffers and picks kernels
+    _predict(model, param_vals[:batch_size], batch_size)
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        _predict(model, param_vals[:batch_size], batch_size)
+    return (time.perf_counter() - start_time) / (repeat * len(param_vals[:batch_size]))
+
+
+def accuracy_report(float_model, quantized_model, param_vals, beam_intensities=None, batch_size=64):
+    """
+    Compare the predictions of a quantized model with those of the float model.
+
+    Parameters
+    ----------
+    float_model: torch.nn.Module
+    quantized_model: torch.nn.Module
+      both take (N, P) parameter values, like ParameterOnlySurrogate
+    param_vals: array-like
+      (N, P) parameter values, like those of the held-out images
+    beam_intensities: array-like, optional
+      the (N, H, W) or (N, 1, H, W) correct images, to report the error of each model
+    batch_size: int
+
+    Returns
+    -------
+    dict
+      image_count, the mean squared, largest absolute, and relative (L2) differences
+      of the quantized predictions from the float predictions, the mean squared error
+      of each model if beam_intensities are given, the seconds per prediction of each
+      model for batches of batch_size, and the size of each model in bytes
+    """
+    param_vals = torch.as_tensor(np.asarray(param_vals, dtype=np.float32))
+    float_images = _predict(float_model, param_vals, batch_size)
+    quantized_images = _predict(quantized_model, param_vals, batch_size)
+    difference = (quantized_images - float_images).double()
+    report = {
+        "image_count": len(param_vals),
+        "mean_squared_difference": difference.pow(2).mean().item(),
+        "max_absolute_difference": difference.abs().max().item(),
+        "relative_difference": (difference.norm() / float_images.double().norm().clamp_min(1e-30)).item(),
+    }
+    if beam_intensities is not None:
+        beam_intensities = torch.as_tensor(np.asarray(beam_intensities, dtype=np.float32))
+        beam_intensities = beam_intensities.reshape(float_images.shape).double()
+        report["float_mean_squared_error"] = (float_images - beam_intensities).pow(2).mean().item()
+        report["quantized_mean_squared_error"] = (quantized_images - beam_intensities).pow(2).mean().item()
+    report["float_seconds_per_prediction"] = _seconds_per_prediction(float_model, param_vals, batch_size)
+    report["quantized_seconds_per_prediction"] = _seconds_per_prediction(quantized_model, param_vals, batch_size)
+    report["float_model_bytes"] = model_size(float_model)
+    report["quantized_model_bytes"] = model_size(quantized_model)
+    return report
+
+
+def quantize_checkpoint(
+    checkpoint_path,
+    h5_path,
+    export_path=None,
+    split=None,
+    testing_subset="test",
+    calibration_count=256,
+    seed=0,
+    batch_size=64,
+    **kwargs,
+):
+    """
+    Quantize the model of a checkpoint written by inference.save_checkpoint.
+
+    The model is calibrated on training images of a file written by
+    `preprocess_beam_intensities` and compared with the float model on the held-out images.
+
+    Parameters
+    ----------
+    checkpoint_path: path-like
+    h5_path: path-like
+      the preprocessed results the model was trained on
+    export_path: path-like, optional
+      if given, save the quantized model there as TorchScript with inference.export_model,
+      for SurrogateInferenceEngine.from_checkpoint
+    split: SplitConfig or DatasetSplit, optional
+      the split the model was trained with, see splits.split_indices
+    testing_subset: str
+      "test" or "validation", the held-out images the report is computed on
+    calibration_count: int
+      number of training images, chosen at random, to calibrate on
+    seed: int
+      seed for choosing the calibration images
+    batch_size: int
+    kwargs
+      passed on to quantize_model
+
+    Returns
+    -------
+    (ParameterOnlySurrogate, dict)
+      the quantized model and the accuracy_report on the held-out images
+    """
+    log = logging.getLogger("deep_beamline_simulation.quantization")
+
+    model, initial_beam_intensity, params = load_checkpoint(checkpoint_path)
+    training_indices, testing_indices = split_indices(h5_path, split=split, testing_subset=testing_subset)
+    calibration_indices = np.random.default_rng(seed).choice(
+        training_indices, size=min(calibration_count, len(training_indices)), replace=False
+    )
+    calibration_dataset = TensorIntensityImageDataset.from_h5(h5_path, indices=np.sort(calibration_indices))
+    testing_dataset = TensorIntensityImageDataset.from_h5(h5_path, indices=testing_indices)
+
+    quantized_model = quantize_model(
+        model, initial_beam_intensity, calibration_dataset.param_vals, batch_size=batch_size, **kwargs
+    )
+    report = accuracy_report(
+        ParameterOnlySurrogate(model, initial_beam_intensity),
+        quantized_model,
+        testing_dataset.param_vals,
+        testing_dataset.beam_intensities,
+        batch_size=batch_size,
+    )
+    log.info("quantized '%s': %s", checkpoint_path, report)
+    if export_path is not None:
+        export_model(export_path, quantized_model, initial_beam_intensity, params=params, method="script")
+    return quantized_model, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quantize a surrogate model checkpoint to int8 for the CPU.")
+    parser.add_argument("checkpoint_path", help="a checkpoint written by save_checkpoint")
+    parser.add_argument("h5_path", help="the preprocessed results the model was trained on")
+    parser.add_argument("export_path", help="where to save the quantized model")
+    parser.add_argument("--calibration-count", type=int, default=256)
+    parser.add_argument("--testing-subset", default="test", choices=("test", "validation"))
+    parser.add_argument("--no-static-convolutions", dest="static_convolutions", action="store_false")
+    parser.add_argument("--no-channels-last", dest="channels_last", action="store_false")
+    parser.add_argument("--report", help="write the accuracy report to this JSON file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    _, report = quantize_checkpoint(
+        args.checkpoint_path,
+        args.h5_path,
+        export_path=args.export_path,
+        testing_subset=args.testing_subset,
+        calibration_count=args.calibration_count,
+        static_convolutions=args.static_convolutions,
+        channels_last=args.channels_last,
+    )
+    print(json.dumps(report, indent=2))
+    if args.report is not None:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,582 @@
+import concurrent.futures
+import logging
+import threading
+import uuid
+
+from contextlib import ContextDecorator
+
+import requests
+
+from deep_beamline_simulation import SirepoGuestSession, SirepoSimulationError, _with_simulation_id
+
+
+class SirepoServerUnavailable(Exception):
+    """
+    Raised when no Sirepo server in a SirepoSessionPool can run a simulation.
+    """
+
+
+class _PooledServer:
+    """
+    Bookkeeping for one Sirepo server in a SirepoSessionPool.
+    """
+
+    def __init__(self, sirepo_session):
+        self.sirepo_session = sirepo_session
+        self.server_url = sirepo_session._server_url
+        self.active = False
+        self.in_flight_count = 0
+        self.completed_count = 0
+        self.consecutive_error_count = 0
+        # (folder, name) -> simulation id of the example simulation on this server
+        self.source_simulation_ids = {}
+        # (folder, name) -> ids of scratch copies with no running job
+        self.idle_scratch_simulation_ids = {}
+        self.scratch_simulation_ids = []
+        # requests.Session is not thread-safe so each thread gets its own SirepoGuestSession
+        self._thread_sessions = threading.local()
+        self._thread_sessions_lock = threading.Lock()
+        self._all_thread_sessions = []
+
+    def thread_session(self):
+        """
+        Return a SirepoGuestSession for the calling thread, logged in as the same guest user as `sirepo_session`.
+
+        Sirepo identifies the guest user by its cookie, so the thread's session copies the cookies of
+        `sirepo_session` instead of logging in again, and sees the same simulations.
+        """
+        thread_session = getattr(self._thread_sessions, "sirepo_session", None)
+        # after a new login the cookies of sirepo_session are those of a new guest user
+        if thread_session is None or self._thread_sessions.login_session is not self.sirepo_session._session:
+            thread_session = SirepoGuestSession(
+                sirepo_server_url=self.server_url,
+                simulation_type=self.sirepo_session.simulation_type,
+                polling_strategy=self.sirepo_session.polling_strategy,
+                result_cache=self.sirepo_session.result_cache,
+                metadata_cache=self.sirepo_session.metadata_cache,
+            )
+            thread_session._session = requests.Session()
+            thread_session._session.cookies.update(self.sirepo_session._session.cookies)
+            self._thread_sessions.sirepo_session = thread_session
+            self._thread_sessions.login_session = self.sirepo_session._session
+            with self._thread_sessions_lock:
+                self._all_thread_sessions.append(thread_session)
+        return thread_session
+
+    def close_thread_sessions(self):
+        """
+        Close the session of every thread.
+        """
+        with self._thread_sessions_lock:
+            for thread_session in self._all_thread_sessions:
+                thread_session.logout()
+            self._all_thread_sessions.clear()
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(server_url='{self.server_url}', active={self.active}, "
+            f"in_flight_count={self.in_flight_count}, completed_count={self.completed_count})"
+        )
+
+
+class SirepoSessionPool(ContextDecorator):
+    def __init__(
+        self,
+        sirepo_server_urls,
+        simulation_type,
+        max_jobs_per_server=4,
+        max_consecutive_errors=3,
+        polling_strategy=None,
+        result_cache=None,
+        metadata_cache=None,
+    ):
+        """
+        Run simulations on several Sirepo servers, sending each simulation to the least-loaded server.
+
+        Each server gets its own guest login, shared by a SirepoGuestSession for each thread
+        that makes requests to the server, since requests.Session is not thread-safe.
+        Sirepo runs one job per simulation id
+        and report, so jobs run on scratch copies of the simulation, as in
+        `SirepoGuestSession.run_simulations`. Scratch copies are reused and are deleted by `logout`.
+
+        Every guest user on every server has its own simulation ids, so a simulation is
+        identified by the folder and name in simulation_data["models"]["simulation"], and
+        its id on each server is looked up in that server's simulation list.
+
+        A server is removed from the pool when it fails to log in, fails a health check,
+        or fails `max_consecutive_errors` requests in a row. Requests that fail because a
+        server is unavailable are retried on another server. A simulation that Sirepo
+        reports as failed raises SirepoSimulationError and is not retried.
+
+        Parameters
+        ----------
+        sirepo_server_urls: iterable of str
+          URIs specifying host and port, eg. ["http://localhost:8000", "http://localhost:8001"]
+        simulation_type: str
+          "srw" or "shadow"
+        max_jobs_per_server: int
+          maximum number of jobs `run_simulations` runs on each server at the same time
+        max_consecutive_errors: int
+          number of failed requests in a row after which a server is removed from the pool
+        polling_strategy: PollingStrategy, optional
+          see SirepoGuestSession
+        result_cache: SimulationResultCache, optional
+          see SirepoGuestSession, shared by all servers
+        metadata_cache: SirepoMetadataCache, optional
+          see SirepoGuestSession, shared by all servers
+        """
+        if max_jobs_per_server < 1:
+            raise ValueError(f"max_jobs_per_server must be at least 1, not {max_jobs_per_server}")
+
+        self.simulation_type = simulation_type.lower()
+        self.max_jobs_per_server = max_jobs_per_server
+        self.max_consecutive_errors = max_consecutive_errors
+        self.result_cache = result_cache
+
+        self._pooled_servers = []
+        for sirepo_server_url in sirepo_server_urls:
+            self._pooled_servers.append(
+                _PooledServer(
+                    SirepoGuestSession(
+                        sirepo_server_url=sirepo_server_url,
+                        simulation_type=simulation_type,
+                        polling_strategy=polling_strategy,
+                        result_cache=result_cache,
+                        metadata_cache=metadata_cache,
+                    )
+                )
+            )
+        if len(self._pooled_servers) == 0:
+            raise ValueError("at least one Sirepo server URL is required")
+
+        self._lock = threading.Lock()
+
+    @property
+    def servers(self):
+        """
+        URLs of the servers in the pool.
+        """
+        with self._lock:
+            return [pooled_server.server_url for pooled_server in self._pooled_servers if pooled_server.active]
+
+    @property
+    def removed_servers(self):
+        """
+        URLs of the servers that have been removed from the pool.
+        """
+        with self._lock:
+            return [
+                pooled_server.server_url for pooled_server in self._pooled_servers if not pooled_server.active
+            ]
+
+    @property
+    def in_flight_counts(self):
+        """
+        Return a dictionary of server URL -> number of jobs started but not yet completed.
+        """
+        with self._lock:
+            return {
+                pooled_server.server_url: pooled_server.in_flight_count for pooled_server in self._pooled_servers
+            }
+
+    @property
+    def completed_counts(self):
+        """
+        Return a dictionary of server URL -> number of jobs completed.
+        """
+        with self._lock:
+            return {
+                pooled_server.server_url: pooled_server.completed_count for pooled_server in self._pooled_servers
+            }
+
+    def login(self):
+        """
+        Log in to every server. Servers that can not be reached are removed from the pool.
+
+        Raise SirepoServerUnavailable if no server can be reached.
+        """
+        self.health_check(include_removed=True)
+        if len(self.servers) == 0:
+            raise SirepoServerUnavailable(
+                f"no Sirepo server is available: {[s.server_url for s in self._pooled_servers]}"
+            )
+
+    def logout(self):
+        """
+        Delete the scratch simulations and close every session.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        for pooled_server in self._pooled_servers:
+            if pooled_server.sirepo_session._session is None:
+                continue
+            for scratch_simulation_id in pooled_server.scratch_simulation_ids:
+                log.debug(
+                    "deleting scratch simulation '%s' on '%s'", scratch_simulation_id, pooled_server.server_url
+                )
+                try:
+                    pooled_server.sirepo_session.delete_simulation(scratch_simulation_id)
+                except requests.RequestException as request_exception:
+                    log.warning(
+                        "failed to delete scratch simulation '%s' on '%s': %s",
+                        scratch_simulation_id,
+                        pooled_server.server_url,
+                        request_exception,
+                    )
+            pooled_server.scratch_simulation_ids.clear()
+            pooled_server.idle_scratch_simulation_ids.clear()
+            pooled_server.close_thread_sessions()
+            pooled_server.sirepo_session.logout()
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, *exc):
+        self.logout()
+        return False
+
+    def health_check(self, include_removed=False):
+        """
+        Ask each server for its simulation list and remove servers that do not respond.
+
+        Parameters
+        ----------
+        include_removed: bool
+          if True also log in again to removed servers and return them to the pool if they respond
+
+        Returns
+        -------
+        dictionary of server URL -> bool
+          True for each server that responded, only servers that were checked are included
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        health = {}
+        for pooled_server in self._pooled_servers:
+            if not (pooled_server.active or include_removed):
+                continue
+            try:
+                if not pooled_server.active:
+                    pooled_server.sirepo_session.login()
+                    # scratch copies made before the server was removed may be gone
+                    pooled_server.source_simulation_ids.clear()
+                    pooled_server.idle_scratch_simulation_ids.clear()
+                    pooled_server.scratch_simulation_ids.clear()
+                pooled_server.sirepo_session.simulation_list(refresh=True)
+            except (requests.RequestException, ValueError) as request_exception:
+                log.warning("health check failed for '%s': %s", pooled_server.server_url, request_exception)
+                self._remove_server(pooled_server)
+                health[pooled_server.server_url] = False
+            else:
+                with self._lock:
+                    if not pooled_server.active:
+                        log.info("adding '%s' to the pool", pooled_server.server_url)
+                    pooled_server.active = True
+                    pooled_server.consecutive_error_count = 0
+                health[pooled_server.server_url] = True
+
+        return health
+
+    def run_simulation(self, simulation_data, simulation_report=None, bypass_cache=False):
+        """
+        Start a simulation on the least-loaded server but do not wait for it to complete.
+
+        See SirepoGuestSession.run_simulation. The returned response has a `server_url`
+        attribute, the URL of the server running the simulation, or None if the result
+        came from the result cache. Pass the response to `wait_for_simulation`.
+
+        Raises
+        ------
+        SirepoServerUnavailable
+          if every server has been removed from the pool
+        """
+        if not bypass_cache:
+            cached_run_status_response = self._pooled_servers[0].sirepo_session._cached_run_status_response(
+                simulation_data, simulation_report
+            )
+            if cached_run_status_response is not None:
+                cached_run_status_response.server_url = None
+                return cached_run_status_response
+
+        while True:
+            pooled_server = self._acquire_least_loaded_server()
+            try:
+                scratch_simulation_id = self._acquire_scratch_simulation(pooled_server, simulation_data)
+                # a scratch simulation is not reused if starting its job fails
+                run_simulation_response = pooled_server.thread_session().run_simulation(
+                    simulation_id=scratch_simulation_id,
+                    simulation_data=_with_simulation_id(simulation_data, scratch_simulation_id),
+                    simulation_report=simulation_report,
+                    # the cache was checked above
+                    bypass_cache=True,
+                )
+                if run_simulation_response.status_code >= 500:
+                    run_simulation_response.raise_for_status()
+            except requests.RequestException as request_exception:
+                self._release_server(pooled_server, request_exception=request_exception)
+                continue
+            except BaseException:
+                self._release_server(pooled_server)
+                raise
+
+            run_simulation_response.server_url = pooled_server.server_url
+            run_simulation_response.scratch_simulation_id = scratch_simulation_id
+            run_simulation_response.scratch_simulation_key = _simulation_folder_and_name(simulation_data)
+            return run_simulation_response
+
+    def wait_for_simulation(self, run_simulation_response, max_status_calls=100, polling_strategy=None):
+        """
+        Wait for a simulation started by `run_simulation` to complete and return the final run-status response.
+
+        See SirepoGuestSession.wait_for_simulation. The returned response has a `server_url` attribute.
+        A requests.RequestException is raised if the server becomes unavailable.
+        """
+        if run_simulation_response.server_url is None:
+            # the result came from the cache
+            return run_simulation_response
+
+        pooled_server = self._pooled_server(run_simulation_response.server_url)
+        try:
+            run_status_response = pooled_server.thread_session().wait_for_simulation(
+                run_simulation_response,
+                max_status_calls=max_status_calls,
+                polling_strategy=polling_strategy,
+            )
+        except requests.RequestException as request_exception:
+            self._release_server(pooled_server, request_exception=request_exception)
+            raise
+        except BaseException:
+            self._release_server(
+                pooled_server,
+                scratch_simulation_key=run_simulation_response.scratch_simulation_key,
+                scratch_simulation_id=run_simulation_response.scratch_simulation_id,
+            )
+            raise
+
+        self._release_server(
+            pooled_server,
+            scratch_simulation_key=run_simulation_response.scratch_simulation_key,
+            scratch_simulation_id=run_simulation_response.scratch_simulation_id,
+            completed=True,
+        )
+        run_status_response.server_url = pooled_server.server_url
+        return run_status_response
+
+    def run_simulations(
+        self,
+        simulation_data_list,
+        simulation_report=None,
+        max_status_calls=100,
+        polling_strategy=None,
+        bypass_cache=False,
+        return_exceptions=False,
+    ):
+        """Run many simulations across the servers in the pool.
+
+        Up to `max_jobs_per_server` jobs run on each server at the same time and each new
+        job goes to the least-loaded server, so throughput grows with the number of servers.
+        A simulation interrupted because its server became unavailable is run again on
+        another server.
+
+        Parameters
+        ----------
+        simulation_data_list: iterable of dict
+          simulation data, for example modified copies of the result of `simulation_data`
+          from any one of the servers
+        simulation_report: str, optional
+          report to run for each simulation, eg. "watchpointReport6"
+        max_status_calls: int
+          maximum number of run-status calls for each job
+        polling_strategy: PollingStrategy, optional
+          overrides the polling strategy for these simulations
+        bypass_cache: bool
+          if True run every simulation even if its result is cached
+        return_exceptions: bool
+          see SirepoGuestSession.run_simulations
+
+        Yields
+        ------
+        (int, requests.Response)
+          the index into `simulation_data_list` and the final run-status response,
+          in order of completion, with `simulation_stats` and `server_url` attributes
+
+        Raises
+        ------
+        SirepoServerUnavailable
+          if every server has been removed from the pool
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        pending_simulation_data = enumerate(simulation_data_list)
+        pending_simulation_data_exhausted = False
+        # future -> index into simulation_data_list
+        in_flight_futures = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_jobs_per_server * len(self._pooled_servers),
+            thread_name_prefix=self.__class__.__name__,
+        ) as executor:
+            try:
+                while True:
+                    # the capacity shrinks when servers are removed
+                    capacity = self.max_jobs_per_server * len(self.servers)
+                    while not pending_simulation_data_exhausted and len(in_flight_futures) < max(capacity, 1):
+                        try:
+                            simulation_i, simulation_data = next(pending_simulation_data)
+                        except StopIteration:
+                            pending_simulation_data_exhausted = True
+                            break
+
+                        if not bypass_cache:
+                            cached_run_status_response = self._pooled_servers[
+                                0
+                            ].sirepo_session._cached_run_status_response(simulation_data, simulation_report)
+                            if cached_run_status_response is not None:
+                                cached_run_status_response.server_url = None
+                                yield simulation_i, cached_run_status_response
+                                continue
+
+                        in_flight_futures[
+                            executor.submit(
+                                self._run_and_wait,
+                                simulation_data,
+                                simulation_report,
+                                max_status_calls,
+                                polling_strategy,
+                            )
+                        ] = simulation_i
+
+                    if len(in_flight_futures) == 0:
+                        break
+
+                    done_futures, _ = concurrent.futures.wait(
+                        in_flight_futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for done_future in done_futures:
+                        simulation_i = in_flight_futures.pop(done_future)
+                        if return_exceptions and isinstance(done_future.exception(), SirepoSimulationError):
+                            log.warning("simulation %d failed: %s", simulation_i, done_future.exception())
+                            yield simulation_i, done_future.exception()
+                            continue
+                        run_status_response = done_future.result()
+                        log.info(
+                            "simulation %d completed on '%s': %s",
+                            simulation_i,
+                            run_status_response.server_url,
+                            run_status_response.simulation_stats,
+                        )
+                        yield simulation_i, run_status_response
+            finally:
+                for in_flight_future in in_flight_futures:
+                    in_flight_future.cancel()
+
+    def _run_and_wait(self, simulation_data, simulation_report, max_status_calls, polling_strategy):
+        while True:
+            run_simulation_response = self.run_simulation(
+                simulation_data, simulation_report=simulation_report, bypass_cache=True
+            )
+            try:
+                return self.wait_for_simulation(
+                    run_simulation_response,
+                    max_status_calls=max_status_calls,
+                    polling_strategy=polling_strategy,
+                )
+            except requests.RequestException:
+                # the server error was recorded by wait_for_simulation, try another server
+                continue
+
+    def _pooled_server(self, server_url):
+        for pooled_server in self._pooled_servers:
+            if pooled_server.server_url == server_url:
+                return pooled_server
+        raise KeyError(f"'{server_url}' is not in the pool")
+
+    def _acquire_least_loaded_server(self):
+        with self._lock:
+            active_servers = [pooled_server for pooled_server in self._pooled_servers if pooled_server.active]
+            if len(active_servers) == 0:
+                raise SirepoServerUnavailable(
+                    f"every Sirepo server has been removed from the pool: "
+                    f"{[pooled_server.server_url for pooled_server in self._pooled_servers]}"
+                )
+            pooled_server = min(active_servers, key=lambda pooled_server_: pooled_server_.in_flight_count)
+            pooled_server.in_flight_count += 1
+            return pooled_server
+
+    def _release_server(
+        self,
+        pooled_server,
+        scratch_simulation_key=None,
+        scratch_simulation_id=None,
+        completed=False,
+        request_exception=None,
+    ):
+        log = logging.getLogger(self.__class__.__name__)
+
+        with self._lock:
+            pooled_server.in_flight_count -= 1
+            if scratch_simulation_id is not None:
+                pooled_server.idle_scratch_simulation_ids.setdefault(scratch_simulation_key, []).append(
+                    scratch_simulation_id
+                )
+            if completed:
+                pooled_server.completed_count += 1
+            if request_exception is None:
+                pooled_server.consecutive_error_count = 0
+                return
+            pooled_server.consecutive_error_count += 1
+            consecutive_error_count = pooled_server.consecutive_error_count
+
+        log.warning(
+            "request to '%s' failed (%d in a row): %s",
+            pooled_server.server_url,
+            consecutive_error_count,
+            request_exception,
+        )
+        if consecutive_error_count >= self.max_consecutive_errors:
+            self._remove_server(pooled_server)
+
+    def _remove_server(self, pooled_server):
+        log = logging.getLogger(self.__class__.__name__)
+
+        with self._lock:
+            if pooled_server.active:
+                log.warning("removing '%s' from the pool", pooled_server.server_url)
+            pooled_server.active = False
+
+    def _acquire_scratch_simulation(self, pooled_server, simulation_data):
+        """
+        Return the id of a scratch copy of simulation_data's simulation with no running job.
+        """
+        scratch_simulation_key = _simulation_folder_and_name(simulation_data)
+        with self._lock:
+            idle_scratch_simulation_ids = pooled_server.idle_scratch_simulation_ids.get(scratch_simulation_key)
+            if idle_scratch_simulation_ids:
+                return idle_scratch_simulation_ids.pop()
+            source_simulation_id = pooled_server.source_simulation_ids.get(scratch_simulation_key)
+
+        folder, name = scratch_simulation_key
+        if source_simulation_id is None:
+            try:
+                source_simulation_id = pooled_server.thread_session().simulation_list()[folder][name]
+            except KeyError:
+                raise ValueError(
+                    f"simulation '{name}' in folder '{folder}' is not on '{pooled_server.server_url}'"
+                )
+            with self._lock:
+                pooled_server.source_simulation_ids[scratch_simulation_key] = source_simulation_id
+
+        scratch_simulation_data = pooled_server.thread_session().copy_simulation(
+            simulation_id=source_simulation_id,
+            name=f"{name} {uuid.uuid4().hex[:8]}",
+            folder=folder,
+        )
+        scratch_simulation_id = scratch_simulation_data["models"]["simulation"]["simulationId"]
+        with self._lock:
+            pooled_server.scratch_simulation_ids.append(scratch_simulation_id)
+        return scratch_simulation_id
+
+
+def _simulation_folder_and_name(simulation_data):
+    simulation_model = simulation_data["models"]["simulation"]
+    return simulation_model["folder"], simulation_model["name"]
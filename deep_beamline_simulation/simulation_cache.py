@@ -0,0 +1,165 @@
+import json
+import logging
+
+from pathlib import Path
+
+import numpy as np
+
+from deep_beamline_simulation.disk_cache import (
+    atomic_write,
+    canonical_hash,
+    default_cache_directory,
+    evict_least_recently_used,
+    mark_used,
+)
+
+# fields of models["simulation"] that identify a simulation rather than describe it,
+# so two copies of a simulation with the same parameters have the same cache key
+SIMULATION_BOOKKEEPING_FIELDS = (
+    "documentationUrl",
+    "folder",
+    "isExample",
+    "lastModified",
+    "name",
+    "notes",
+    "outOfSessionSimulationId",
+    "simulationId",
+    "simulationSerial",
+)
+
+
+def simulation_cache_key(simulation_data, simulation_report, simulation_type="srw"):
+    """
+    Return a cache key for the result of running simulation_report with simulation_data.
+
+    The key is a hash of the simulation "models" dictionary that ignores dictionary
+    order, small float formatting differences, and fields that only identify the
+    simulation, such as its id, name and folder.
+    """
+    models = dict(simulation_data["models"])
+    if "simulation" in models:
+        models["simulation"] = {
+            field_name: field_value
+            for field_name, field_value in models["simulation"].items()
+            if field_name not in SIMULATION_BOOKKEEPING_FIELDS
+        }
+    return canonical_hash(
+        {
+            "models": models,
+            "report": simulation_report,
+            "simulationType": simulation_type,
+        }
+    )
+
+
+class SimulationResultCache:
+    """
+    An on-disk cache of completed run-status responses.
+
+    Each entry is stored as "<key>.json". An intensity matrix ("z_matrix") in the
+    run-status is stored separately as "<key>.npy" so it can be loaded without
+    parsing JSON. When the cache grows past `max_size_bytes` the least recently
+    used entries are deleted.
+
+    Parameters
+    ----------
+    cache_directory: path-like, optional
+      by default a "sirepo-results" directory in the user cache directory
+    max_size_bytes: int
+      size limit for the cache, 1 GiB by default
+    """
+
+    def __init__(self, cache_directory=None, max_size_bytes=2**30):
+        if cache_directory is None:
+            cache_directory = default_cache_directory("sirepo-results")
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(cache_directory='{self.cache_directory}', "
+            f"max_size_bytes={self.max_size_bytes})"
+        )
+
+    def _json_path(self, key):
+        return self.cache_directory / f"{key}.json"
+
+    def _npy_path(self, key):
+        return self.cache_directory / f"{key}.npy"
+
+    def __contains__(self, key):
+        return self._json_path(key).exists()
+
+    def get(self, key):
+        """
+        Return the cached run-status JSON for key, or None if there is no entry for key.
+        """
+        log = logging.getLogger(self.__class__.__name__)
+
+        try:
+            with open(self._json_path(key)) as run_status_file:
+                run_status = json.load(run_status_file)
+        except FileNotFoundError:
+            log.debug("cache miss '%s'", key)
+            return None
+
+        if run_status.pop("_z_matrix_npy", False):
+            try:
+                run_status["z_matrix"] = np.load(self._npy_path(key)).tolist()
+            except FileNotFoundError:
+                # the entry was evicted while it was being read
+                return None
+
+        mark_used(self._json_path(key))
+        log.debug("cache hit '%s'", key)
+        return run_status
+
+    def get_intensity_matrix(self, key):
+        """
+        Return the cached intensity matrix for key as a read-only memory-mapped array,
+        or None if there is no intensity matrix for key.
+        """
+        try:
+            intensity_matrix = np.load(self._npy_path(key), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        mark_used(self._json_path(key))
+        return intensity_matrix
+
+    def put(self, key, run_status):
+        """
+        Store a completed run-status JSON and evict old entries if the cache is too large.
+        """
+        run_status = dict(run_status)
+        z_matrix = run_status.pop("z_matrix", None)
+        if z_matrix is not None:
+            run_status["_z_matrix_npy"] = True
+            atomic_write(self._npy_path(key), lambda npy_file: np.save(npy_file, np.asarray(z_matrix)))
+        # write the index file last, an entry without one is incomplete
+        atomic_write(
+            self._json_path(key),
+            lambda json_file: json_file.write(json.dumps(run_status)),
+            mode="w",
+        )
+        evict_least_recently_used(self.cache_directory, ".json", self.max_size_bytes, keep={key})
+
+    def invalidate(self, key):
+        """
+        Remove the entry for key if it exists.
+        """
+        for cache_path in (self._json_path(key), self._npy_path(key)):
+            if cache_path.exists():
+                cache_path.unlink()
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        for cache_path in self.cache_directory.iterdir():
+            if cache_path.is_file():
+                cache_path.unlink()
+
+    @property
+    def size_bytes(self):
+        return sum(cache_path.stat().st_size for cache_path in self.cache_directory.iterdir())
@@ -0,0 +1,336 @@
+"""
+Deterministic training, validation, and test splits of preprocessed training data.
+
+`build_dataloaders` trains on the first two thirds of the images in file order,
+which follows the order of the parameter sweep. A `SplitConfig` describes a
+different split, and `load_split` computes it once and stores the indices in a
+file next to preprocessed_results.h5, so every training run with the same
+config, including runs in parallel, uses the same split without deriving it again:
+
+    split = load_split("preprocessed_results.h5", SplitConfig(method="kfold", fold_count=5, fold=2))
+    build_dataloaders("preprocessed_results.h5", batch_size=10, dataset_type="lazy", split=split)
+
+The split only holds image indices, so lazy datasets read their images straight
+from preprocessed_results.h5.
+"""
+import json
+import logging
+
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from deep_beamline_simulation.disk_cache import atomic_write, canonical_hash
+from deep_beamline_simulation.preprocessing_cache import array_digest
+
+SUBSETS = ("training", "validation", "test")
+
+
+class SplitConfig:
+    """
+    How to split the images into training, validation, and test subsets.
+
+    Parameters
+    ----------
+    method: str
+      "ordered" to split in file order, "random" to split at random, "stratified" to split
+      each region of parameter space at random so every subset covers the parameter space,
+      "blocked" to put whole regions of parameter space in one subset, so the validation and
+      test images are not near training images, or "kfold" for cross-validation, where the
+      images that are not test images are split into fold_count folds and fold is the
+      validation subset
+    validation_fraction: float
+      fraction of the images in the validation subset, except for "kfold"
+    test_fraction: float
+      fraction of the images in the test subset
+    seed: int
+      seed for the random order
+    fold_count: int
+      for "kfold", number of folds
+    fold: int
+      for "kfold", the fold used for validation
+    bins: int
+      for "stratified" and "blocked", the parameter space is split into this many
+      quantiles of each parameter
+    parameters: sequence of str, optional
+      for "stratified" and "blocked", names of the parameters that define the regions
+      of parameter space, by default every parameter
+    """
+
+    methods = ("ordered", "random", "stratified", "blocked", "kfold")
+
+    def __init__(
+        self,
+        method="random",
+        validation_fraction=0.0,
+        test_fraction=1 / 3,
+        seed=0,
+        fold_count=5,
+        fold=0,
+        bins=4,
+        parameters=None,
+    ):
+        if method not in self.methods:
+            raise ValueError(f"method must be one of {self.methods}, not '{method}'")
+        if validation_fraction < 0 or test_fraction < 0 or validation_fraction + test_fraction > 1:
+            raise ValueError(
+                f"validation_fraction {validation_fraction} and test_fraction {test_fraction} "
+                "must be at least 0 and add up to at most 1"
+            )
+        if not 0 <= fold < fold_count:
+            raise ValueError(f"fold must be between 0 and fold_count - 1 = {fold_count - 1}, not {fold}")
+        self.method = method
+        self.validation_fraction = validation_fraction
+        self.test_fraction = test_fraction
+        self.seed = seed
+        self.fold_count = fold_count
+        self.fold = fold
+        self.bins = bins
+        self.parameters = None if parameters is None else tuple(parameters)
+
+    def to_dict(self):
+        return {
+            "method": self.method,
+            "validation_fraction": self.validation_fraction,
+            "test_fraction": self.test_fraction,
+            "seed": self.seed,
+            "fold_count": self.fold_count,
+            "fold": self.fold,
+            "bins": self.bins,
+            "parameters": None if self.parameters is None else list(self.parameters),
+        }
+
+    @classmethod
+    def from_dict(cls, config_dict):
+        return cls(**config_dict)
+
+    def __eq__(self, other):
+        return isinstance(other, SplitConfig) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())})"
+
+    @property
+    def key(self):
+        return canonical_hash(self.to_dict())[:16]
+
+
+class DatasetSplit:
+    """
+    Sorted image indices of the training, validation, and test subsets.
+
+    Attributes
+    ----------
+    training: numpy.ndarray
+    validation: numpy.ndarray
+    test: numpy.ndarray
+    config: SplitConfig
+    """
+
+    def __init__(self, training, validation, test, config):
+        self.training = np.sort(np.asarray(training, dtype=np.int64))
+        self.validation = np.sort(np.asarray(validation, dtype=np.int64))
+        self.test = np.sort(np.asarray(test, dtype=np.int64))
+        self.config = config
+
+    def __getitem__(self, subset):
+        if subset not in SUBSETS:
+            raise KeyError(f"subset must be one of {SUBSETS}, not '{subset}'")
+        return getattr(self, subset)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(training={len(self.training)}, validation={len(self.validation)}, "
+            f"test={len(self.test)}, config={self.config!r})"
+        )
+
+
+def parameter_space_regions(param_vals, bins):
+    """
+    Return the region of parameter space of each image, numbered from 0.
+
+    Each parameter is split into `bins` quantiles, fewer if it has fewer distinct values,
+    and a region is a combination of one quantile of each parameter.
+    """
+    param_vals = np.asarray(param_vals, dtype=np.float64).reshape(len(param_vals), -1)
+    quantiles = np.linspace(0.0, 1.0, bins + 1)[1:-1]
+    region_coordinates = np.empty(param_vals.shape, dtype=np.int64)
+    for parameter_i, parameter_vals in enumerate(param_vals.T):
+        bin_edges = np.unique(np.quantile(parameter_vals, quantiles)) if len(parameter_vals) else []
+        region_coordinates[:, parameter_i] = np.searchsorted(bin_edges, parameter_vals, side="right")
+    _, regions = np.unique(region_coordinates, axis=0, return_inverse=True)
+    return regions.reshape(-1)
+
+
+def make_split(image_count, config, param_vals=None):
+    """
+    Return the DatasetSplit of image_count images described by config.
+
+    Parameters
+    ----------
+    image_count: int
+    config: SplitConfig
+    param_vals: array-like, optional
+      (image_count, P) parameter values of the regions of parameter space, needed for
+      "stratified" and "blocked"
+    """
+    rng = np.random.default_rng(config.seed)
+    test_count = int(image_count * config.test_fraction)
+    validation_count = int(image_count * config.validation_fraction)
+
+    if config.method in ("ordered", "random"):
+        if config.method == "ordered":
+            order = np.arange(image_count)
+        else:
+            order = rng.permutation(image_count)
+        training_count = image_count - validation_count - test_count
+        return DatasetSplit(
+            training=order[:training_count],
+            validation=order[training_count:training_count + validation_count],
+            test=order[training_count + validation_count:],
+            config=config,
+        )
+    elif config.method == "kfold":
+        order = rng.permutation(image_count)
+        folds = np.array_split(order[test_count:], config.fold_count)
+        return DatasetSplit(
+            training=np.concatenate(
+                [folds[fold_i] for fold_i in range(config.fold_count) if fold_i != config.fold]
+            ),
+            validation=folds[config.fold],
+            test=order[:test_count],
+            config=config,
+        )
+
+    if param_vals is None:
+        raise ValueError(f"the '{config.method}' split needs param_vals")
+    regions = parameter_space_regions(param_vals, config.bins)
+    if config.method == "stratified":
+        # place the images of each region evenly on [0, 1) in random order, from a random offset,
+        # so each subset gets its fraction of every region to within one image
+        position_in_region = np.empty(image_count)
+        for region in np.unique(regions):
+            region_indices = np.flatnonzero(regions == region)
+            position_in_region[rng.permutation(region_indices)] = (
+                np.arange(len(region_indices)) + rng.uniform()
+            ) / len(region_indices)
+        test = position_in_region < config.test_fraction
+        validation = ~test & (position_in_region < config.test_fraction + config.validation_fraction)
+    else:
+        # give whole regions, in random order, to the test and validation subsets until they are full
+        test = np.zeros(image_count, dtype=bool)
+        validation = np.zeros(image_count, dtype=bool)
+        for region in rng.permutation(np.unique(regions)):
+            region_images = regions == region
+            if test.sum() < test_count:
+                test |= region_images
+            elif validation.sum() < validation_count:
+                validation |= region_images
+    return DatasetSplit(
+        training=np.flatnonzero(~test & ~validation),
+        validation=np.flatnonzero(validation),
+        test=np.flatnonzero(test),
+        config=config,
+    )
+
+
+def split_path(h5_path, config):
+    """
+    Return the path of the file next to h5_path that stores the split described by config.
+    """
+    h5_path = Path(h5_path)
+    return h5_path.with_name(f"{h5_path.stem}.split-{config.key}.npz")
+
+
+def load_split(h5_path, config=None):
+    """
+    Return the split of the images of a file written by `preprocess_beam_intensities`.
+
+    The split is read from the file at `split_path(h5_path, config)`. If that file does not
+    exist, or the parameter values in h5_path changed since it was written, the split is
+    computed and written there.
+
+    Parameters
+    ----------
+    h5_path: path-like
+    config: SplitConfig, optional
+      by default a random split with two thirds of the images for training and one third for testing
+    """
+    log = logging.getLogger("deep_beamline_simulation.splits")
+
+    if config is None:
+        config = SplitConfig()
+    with h5py.File(h5_path, mode="r") as preprocessed_results:
+        param_vals = preprocessed_results["preprocessed_param_vals"][()]
+        params = [
+            param.decode() if isinstance(param, bytes) else str(param) for param in preprocessed_results["params"]
+        ]
+    param_vals_digest = array_digest(param_vals)
+
+    path = split_path(h5_path, config)
+    try:
+        with np.load(path) as split_npz:
+            if str(split_npz["param_vals_digest"]) == param_vals_digest:
+                return DatasetSplit(
+                    training=split_npz["training"],
+                    validation=split_npz["validation"],
+                    test=split_npz["test"],
+                    config=SplitConfig.from_dict(json.loads(str(split_npz["config"]))),
+                )
+        log.info("'%s' changed since '%s' was written", h5_path, path)
+    except FileNotFoundError:
+        pass
+
+    if config.parameters is not None:
+        missing_parameters = set(config.parameters) - set(params)
+        if missing_parameters:
+            raise ValueError(f"parameters {sorted(missing_parameters)} are not in {params}")
+        param_vals = param_vals[:, [params.index(parameter) for parameter in config.parameters]]
+    split = make_split(len(param_vals), config, param_vals=param_vals)
+
+    # the split is deterministic, so processes writing it at the same time write the same file
+    atomic_write(
+        path,
+        lambda split_file: np.savez(
+            split_file,
+            training=split.training,
+            validation=split.validation,
+            test=split.test,
+            config=json.dumps(config.to_dict()),
+            param_vals_digest=param_vals_digest,
+        ),
+    )
+    log.debug("wrote %s to '%s'", split, path)
+    return split
+
+
+def split_indices(h5_path, split=None, testing_subset="test"):
+    """
+    Return the training and testing image indices of a file written by `preprocess_beam_intensities`.
+
+    Parameters
+    ----------
+    h5_path: path-like
+    split: SplitConfig or DatasetSplit, optional
+      by default the first two thirds of the images in file order are for training
+      and the rest for testing
+    testing_subset: str
+      "test" or "validation", the subset of the split used for testing
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+      training and testing image indices
+    """
+    if split is None:
+        with h5py.File(h5_path, mode="r") as preprocessed_results:
+            image_count = preprocessed_results["preprocessed_beam_intensities"].shape[0]
+        # get two thirds of the data to use for training
+        training_size = 2 * (image_count // 3)
+        return np.arange(training_size), np.arange(training_size, image_count)
+    if isinstance(split, SplitConfig):
+        split = load_split(h5_path, split)
+    if testing_subset not in ("test", "validation"):
+        raise ValueError(f"testing_subset must be 'test' or 'validation', not '{testing_subset}'")
+    return split.training, split[testing_subset]
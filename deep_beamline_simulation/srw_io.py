@@ -0,0 +1,233 @@
+"""
+Read SRW intensity files.
+
+SRW writes intensity distributions as text: a header of "#" lines describing
+the photon energy, horizontal and vertical meshes, followed by one value per
+line. For example:
+
+    #C-aligned Intensity (inner loop is vs photon energy, outer loop vs vertical position)
+    #1000.0 #Initial Photon Energy [eV]
+    #1000.0 #Final Photon Energy [eV]
+    #1 #Number of points vs Photon Energy
+    #-0.001 #Initial Horizontal Position [m]
+    #0.001 #Final Horizontal Position [m]
+    #100 #Number of points vs Horizontal Position
+    #-0.001 #Initial Vertical Position [m]
+    #0.001 #Final Vertical Position [m]
+    #100 #Number of points vs Vertical Position
+    1.9846e+12
+    ...
+
+`read_srw_intensity` parses the header once and converts the body with numpy's
+C parser in a single call. With `sidecar=True` the array is also saved next to
+the text file as "<file>.npy", and later reads memory-map the sidecar instead of
+parsing the text again.
+"""
+import logging
+import re
+
+from pathlib import Path
+
+import numpy as np
+
+from deep_beamline_simulation.disk_cache import atomic_write
+
+_HEADER_VALUE_PATTERN = re.compile(r"^#\s*(\S+)\s*#\s*(.*?)\s*(?:\[(.*)\])?\s*$")
+
+
+class SRWIntensityHeader:
+    """
+    The header of an SRW intensity file.
+
+    Attributes
+    ----------
+    title: str
+      the first header line, eg. "C-aligned Intensity (inner loop is vs photon energy, ...)"
+    photon_energy_range: (float, float, int)
+      initial and final photon energy and number of points
+    horizontal_range: (float, float, int)
+      initial and final horizontal position and number of points
+    vertical_range: (float, float, int)
+      initial and final vertical position and number of points
+    component_count: int
+      number of components, 1 unless the file has several Stokes components
+    labels: list of str
+      the description of each header value, eg. "Initial Photon Energy"
+    units: list of str
+      the units of each header value, eg. "eV", "" if there are none
+    header_line_count: int
+      number of header lines before the first intensity value
+    """
+
+    def __init__(self, title, values, labels, units):
+        if len(values) < 9:
+            raise ValueError(f"an SRW intensity header has at least 9 values, found {len(values)}")
+        self.title = title
+        self.photon_energy_range = (float(values[0]), float(values[1]), int(values[2]))
+        self.horizontal_range = (float(values[3]), float(values[4]), int(values[5]))
+        self.vertical_range = (float(values[6]), float(values[7]), int(values[8]))
+        self.component_count = int(values[9]) if len(values) > 9 else 1
+        self.labels = labels
+        self.units = units
+        self.header_line_count = 1 + len(values)
+
+    @property
+    def shape(self):
+        """
+        The shape of the intensity array: (vertical points, horizontal points), with
+        photon energy points and components added as further dimensions when there is more than one.
+        """
+        shape = (self.vertical_range[2], self.horizontal_range[2])
+        if self.photon_energy_range[2] > 1:
+            shape = shape + (self.photon_energy_range[2],)
+        if self.component_count > 1:
+            shape = (self.component_count,) + shape
+        return shape
+
+    @property
+    def photon_energy(self):
+        """
+        The initial photon energy, the photon energy of a single-energy calculation.
+        """
+        return self.photon_energy_range[0]
+
+    @property
+    def horizontal_extent(self):
+        return self.horizontal_range[:2]
+
+    @property
+    def vertical_extent(self):
+        return self.vertical_range[:2]
+
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "photon_energy_range": self.photon_energy_range,
+            "horizontal_range": self.horizontal_range,
+            "vertical_range": self.vertical_range,
+            "component_count": self.component_count,
+            "labels": self.labels,
+            "units": self.units,
+        }
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(photon_energy_range={self.photon_energy_range}, "
+            f"horizontal_range={self.horizontal_range}, vertical_range={self.vertical_range}, "
+            f"component_count={self.component_count})"
+        )
+
+
+def read_srw_header(srw_file_path):
+    """
+    Return the SRWIntensityHeader of an SRW intensity file, reading only the header lines.
+    """
+    values = []
+    labels = []
+    units = []
+    with open(srw_file_path) as srw_file:
+        title = srw_file.readline().lstrip("#").strip()
+        for header_line in srw_file:
+            if not header_line.startswith("#"):
+                break
+            header_match = _HEADER_VALUE_PATTERN.match(header_line)
+            if header_match is None:
+                raise ValueError(f"can not parse SRW header line '{header_line.strip()}' in '{srw_file_path}'")
+            value, label, unit = header_match.groups()
+            values.append(value)
+            labels.append(label)
+            units.append(unit or "")
+    return SRWIntensityHeader(title, values, labels, units)
+
+
+def sidecar_path(srw_file_path):
+    """
+    Return the path of the binary sidecar of an SRW intensity file.
+    """
+    srw_file_path = Path(srw_file_path)
+    return srw_file_path.with_name(srw_file_path.name + ".npy")
+
+
+def _read_sidecar(srw_file_path, dtype):
+    """
+    Return the memory-mapped sidecar array, or None if there is no up-to-date sidecar with this dtype.
+    """
+    srw_sidecar_path = sidecar_path(srw_file_path)
+    try:
+        if srw_sidecar_path.stat().st_mtime < Path(srw_file_path).stat().st_mtime:
+            return None
+        intensity = np.load(srw_sidecar_path, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+    if intensity.dtype != dtype:
+        return None
+    return intensity
+
+
+def read_srw_intensity(srw_file_path, dtype=np.float32, sidecar=False, return_header=False):
+    """
+    Read an SRW intensity file into an array shaped by its header.
+
+    Parameters
+    ----------
+    srw_file_path: path-like
+      an SRW intensity file, eg. "res_int_se.dat"
+    dtype: numpy dtype
+      dtype of the returned array
+    sidecar: bool
+      if True, memory-map "<file>.npy" if it is newer than the file, otherwise read the
+      file and write "<file>.npy" for next time
+    return_header: bool
+      if True return the SRWIntensityHeader too
+
+    Returns
+    -------
+    numpy.ndarray, or (numpy.ndarray, SRWIntensityHeader) if return_header is True
+      an array with shape `header.shape`, for a single photon energy (vertical points, horizontal points);
+      read-only and memory-mapped if it came from a sidecar
+    """
+    log = logging.getLogger("deep_beamline_simulation.srw_io")
+
+    dtype = np.dtype(dtype)
+    header = read_srw_header(srw_file_path)
+
+    intensity = _read_sidecar(srw_file_path, dtype) if sidecar else None
+    if intensity is None:
+        with open(srw_file_path) as srw_file:
+            for _ in range(header.header_line_count):
+                srw_file.readline()
+            srw_body = srw_file.read()
+        # parse in float64 like SRW's own reader, then convert
+        intensity = np.fromstring(srw_body, dtype=np.float64, sep=" ")
+        expected_size = int(np.prod(header.shape))
+        if intensity.size != expected_size:
+            raise ValueError(
+                f"'{srw_file_path}' has {intensity.size} values, its header describes {header.shape}"
+            )
+        # the photon energy is the innermost loop and the vertical position the outermost
+        intensity = intensity.astype(dtype, copy=False).reshape(header.shape)
+        if sidecar:
+            atomic_write(sidecar_path(srw_file_path), lambda sidecar_file: np.save(sidecar_file, intensity))
+            log.debug("wrote sidecar for '%s'", srw_file_path)
+    elif intensity.shape != header.shape:
+        raise ValueError(f"sidecar of '{srw_file_path}' has shape {intensity.shape}, expected {header.shape}")
+
+    if return_header:
+        return intensity, header
+    return intensity
+
+
+def convert_srw_files(srw_file_paths, dtype=np.float32):
+    """
+    Write the binary sidecar of each SRW intensity file that does not have an up-to-date sidecar.
+
+    Returns
+    -------
+    list of Path
+      the sidecar paths
+    """
+    sidecar_paths = []
+    for srw_file_path in srw_file_paths:
+        read_srw_intensity(srw_file_path, dtype=dtype, sidecar=True)
+        sidecar_paths.append(sidecar_path(srw_file_path))
+    return sidecar_paths
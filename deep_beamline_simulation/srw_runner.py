@@ -0,0 +1,347 @@
+"""
+Run SRW simulations, or any other independent tasks, on local worker processes.
+
+Tasks are handed out one at a time: a worker gets its next task as soon as it
+finishes the last one, so a few slow tasks, for example simulations with large
+apertures, do not leave the other workers idle the way a fixed split of the
+tasks into one contiguous slice per process does.
+
+Each worker has its own pipe to the parent process, so the parent always knows
+which task each worker is running. A task running longer than the timeout, or a
+worker that dies, for example in a segmentation fault, only fails that task;
+the worker is replaced and the other tasks carry on.
+
+For example:
+
+    def intensity(aperture_size):
+        ...
+
+    for task_i, result in run_tasks(intensity, [(size,) for size in sizes], task_timeout_seconds=600):
+        ...
+
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import time as ttime
+import traceback
+
+
+class TaskFailed(Exception):
+    """
+    Raised, or yielded, for a task that raised an exception or whose worker process died.
+    """
+
+    def __init__(self, task_i, message):
+        super().__init__(f"task {task_i} failed: {message}")
+        self.task_i = task_i
+
+
+class TaskTimeout(TaskFailed, TimeoutError):
+    """
+    Raised, or yielded, for a task that ran longer than its timeout.
+    """
+
+
+class TaskProgress:
+    """
+    Progress of a `run_tasks` call, passed to the progress callback after each task.
+
+    Attributes
+    ----------
+    task_count: int or None
+      number of tasks, None if the task arguments have no length
+    completed_count: int
+      number of tasks that succeeded
+    failed_count: int
+      number of tasks that failed or timed out
+    running_count: int
+      number of tasks running now
+    elapsed_seconds: float
+      time since the first task was started
+    """
+
+    def __init__(self, task_count):
+        self.task_count = task_count
+        self.completed_count = 0
+        self.failed_count = 0
+        self.running_count = 0
+        self.start_time = ttime.monotonic()
+
+    @property
+    def finished_count(self):
+        return self.completed_count + self.failed_count
+
+    @property
+    def elapsed_seconds(self):
+        return ttime.monotonic() - self.start_time
+
+    @property
+    def remaining_seconds(self):
+        """
+        Estimated time until every task has finished, None if it can not be estimated yet.
+        """
+        if self.task_count is None or self.finished_count == 0:
+            return None
+        return self.elapsed_seconds / self.finished_count * (self.task_count - self.finished_count)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(task_count={self.task_count}, completed_count={self.completed_count}, "
+            f"failed_count={self.failed_count}, running_count={self.running_count}, "
+            f"elapsed_seconds={self.elapsed_seconds:.1f})"
+        )
+
+
+def log_progress(task_progress):
+    """
+    The default progress callback, log one line for each finished task.
+    """
+    log = logging.getLogger("deep_beamline_simulation.srw_runner")
+
+    remaining_seconds = task_progress.remaining_seconds
+    log.info(
+        "%d of %s tasks finished (%d failed), %d running, %.1fs elapsed%s",
+        task_progress.finished_count,
+        "?" if task_progress.task_count is None else task_progress.task_count,
+        task_progress.failed_count,
+        task_progress.running_count,
+        task_progress.elapsed_seconds,
+        "" if remaining_seconds is None else f", about {remaining_seconds:.1f}s remaining",
+    )
+
+
+def default_worker_count(task_count=None):
+    """
+    Return one worker for each CPU but one, and no more workers than tasks, but at least one worker.
+    """
+    worker_count = max((os.cpu_count() or 1) - 1, 1)
+    if task_count is not None:
+        worker_count = min(worker_count, task_count)
+    return max(worker_count, 1)
+
+
+def _worker_main(connection, task_function):
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        task_i, task_arguments = task
+        try:
+            result = task_function(*task_arguments)
+        except BaseException:
+            # the exception may not be picklable, send the traceback instead
+            connection.send((task_i, False, traceback.format_exc()))
+        else:
+            connection.send((task_i, True, result))
+    connection.close()
+
+
+class _Worker:
+    def __init__(self, multiprocessing_context, task_function):
+        self.connection, worker_connection = multiprocessing_context.Pipe()
+        self.process = multiprocessing_context.Process(
+            target=_worker_main, args=(worker_connection, task_function), daemon=True
+        )
+        self.process.start()
+        worker_connection.close()
+        self.task_i = None
+        self.deadline = None
+
+    def start_task(self, task_i, task_arguments, task_timeout_seconds):
+        self.connection.send((task_i, task_arguments))
+        self.task_i = task_i
+        if task_timeout_seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = ttime.monotonic() + task_timeout_seconds
+
+    def finish_task(self):
+        self.task_i = None
+        self.deadline = None
+
+    def stop(self, timeout_seconds=5.0):
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout_seconds)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def run_tasks(
+    task_function,
+    task_arguments,
+    max_workers=None,
+    task_timeout_seconds=None,
+    progress_callback=log_progress,
+    return_exceptions=False,
+    multiprocessing_context=None,
+):
+    """Run task_function once for each tuple of arguments in task_arguments on worker processes.
+
+    Parameters
+    ----------
+    task_function: callable
+      a picklable function, for example a module-level function
+    task_arguments: iterable of tuple
+      the positional arguments of each task, consumed as workers become free
+    max_workers: int, optional
+      number of worker processes, by default one for each CPU but one and no more than the number of tasks
+    task_timeout_seconds: float, optional
+      a task running longer than this is stopped by terminating its worker process
+    progress_callback: callable, optional
+      called with a TaskProgress after each task finishes, by default `log_progress`
+    return_exceptions: bool
+      if True a failed task yields its TaskFailed or TaskTimeout in place of a result,
+      otherwise the TaskFailed or TaskTimeout is raised
+    multiprocessing_context: str, optional
+      "fork", "spawn", or "forkserver", by default the platform default
+
+    Yields
+    ------
+    (int, object)
+      the index into task_arguments and the value returned by task_function, in order of completion
+    """
+    log = logging.getLogger("deep_beamline_simulation.srw_runner")
+
+    try:
+        task_count = len(task_arguments)
+    except TypeError:
+        task_count = None
+    if max_workers is None:
+        max_workers = default_worker_count(task_count)
+    elif max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, not {max_workers}")
+    multiprocessing_context = multiprocessing.get_context(multiprocessing_context)
+
+    task_progress = TaskProgress(task_count)
+    pending_tasks = enumerate(task_arguments)
+    pending_tasks_exhausted = False
+    workers = []
+    try:
+        while True:
+            # give every idle worker a task, starting workers as needed
+            while not pending_tasks_exhausted:
+                idle_workers = [worker for worker in workers if worker.task_i is None]
+                if idle_workers:
+                    worker = idle_workers[0]
+                elif len(workers) < max_workers:
+                    worker = _Worker(multiprocessing_context, task_function)
+                    workers.append(worker)
+                else:
+                    break
+                try:
+                    task_i, task_i_arguments = next(pending_tasks)
+                except StopIteration:
+                    pending_tasks_exhausted = True
+                    break
+                worker.start_task(task_i, task_i_arguments, task_timeout_seconds)
+
+            busy_workers = [worker for worker in workers if worker.task_i is not None]
+            task_progress.running_count = len(busy_workers)
+            if len(busy_workers) == 0:
+                break
+
+            deadlines = [worker.deadline for worker in busy_workers if worker.deadline is not None]
+            wait_seconds = max(min(deadlines) - ttime.monotonic(), 0.0) if deadlines else None
+            multiprocessing.connection.wait(
+                [worker.connection for worker in busy_workers]
+                + [worker.process.sentinel for worker in busy_workers],
+                timeout=wait_seconds,
+            )
+
+            for worker in busy_workers:
+                task_i = worker.task_i
+                task_error = None
+                if worker.connection.poll():
+                    try:
+                        _, task_succeeded, task_result = worker.connection.recv()
+                    except EOFError:
+                        task_error = TaskFailed(task_i, f"worker exited with code {worker.process.exitcode}")
+                    else:
+                        worker.finish_task()
+                        if not task_succeeded:
+                            task_error = TaskFailed(task_i, task_result)
+                elif not worker.process.is_alive():
+                    task_error = TaskFailed(task_i, f"worker exited with code {worker.process.exitcode}")
+                elif worker.deadline is not None and ttime.monotonic() >= worker.deadline:
+                    task_error = TaskTimeout(task_i, f"did not finish in {task_timeout_seconds}s")
+                else:
+                    continue
+
+                if worker.task_i is not None:
+                    # the worker is stuck or dead, replace it
+                    worker.kill()
+                    workers.remove(worker)
+
+                if task_error is None:
+                    task_progress.completed_count += 1
+                else:
+                    task_progress.failed_count += 1
+                task_progress.running_count = len([worker for worker in workers if worker.task_i is not None])
+                if progress_callback is not None:
+                    progress_callback(task_progress)
+
+                if task_error is None:
+                    yield task_i, task_result
+                else:
+                    log.warning("%s", task_error)
+                    if not return_exceptions:
+                        raise task_error
+                    yield task_i, task_error
+    finally:
+        for worker in workers:
+            if worker.task_i is None:
+                worker.stop()
+            else:
+                worker.kill()
+
+
+def calc_srw_intensity(var_param, set_optics, optics_names=None, intensity_file_name=None):
+    """
+    Propagate a wavefront through a beamline exported from Sirepo and return the intensity file name.
+
+    This does what the main() function of a Sirepo SRW export does, with only the
+    propagated single-electron intensity calculation turned on.
+
+    Parameters
+    ----------
+    var_param: list
+      the varParam list of a Sirepo SRW export, with parameter values already set
+    set_optics: callable
+      the set_optics function of the same export
+    optics_names: list of str, optional
+      the beamline elements to include, by default every element
+    intensity_file_name: str, optional
+      file for the propagated intensity, by default the "ws_fni" entry of var_param
+
+    Returns
+    -------
+    str
+      the name of the SRW .dat file with the propagated intensity
+    """
+    from srwpy import srwl_bl
+
+    v = srwl_bl.srwl_uti_parse_options(srwl_bl.srwl_uti_ext_options(var_param), use_sys_argv=False)
+    if intensity_file_name is not None:
+        v.ws_fni = intensity_file_name
+    optics = set_optics(v, optics_names, True)
+    v.ws = True
+    v.ss = False
+    v.sm = False
+    v.pw = False
+    v.si = False
+    v.tr = False
+    srwl_bl.SRWLBeamline(_name=v.name).calc_all(v, optics)
+    return v.ws_fni
@@ -0,0 +1,653 @@
+"""
+Parameter sweeps over Sirepo beamline elements, streamed into HDF5.
+
+A sweep varies fields of elements in a simulation's models["beamline"] list, for
+example the size of an aperture, runs a simulation for each set of values, and
+writes each intensity matrix to an HDF5 file as soon as it arrives. The file has
+the layout read by `ImageProcessing.preprocess`:
+
+    params           parameter names, eg. "Aperture_horizontalSize"
+    paramVals        (sample count, parameter count) parameter values
+    beamIntensities  (sample count, rows, columns) intensity matrices
+
+For example:
+
+    parameter_space = ParameterSpace(
+        [
+            SweepParameter("Aperture", "horizontalSize", 0.1, 1.0),
+            SweepParameter("Aperture", "verticalSize", 0.1, 1.0),
+        ],
+        sampling="latin_hypercube",
+        sample_count=5000,
+        seed=1,
+    )
+    with SirepoGuestSession("http://localhost:8000", "srw") as sirepo_session:
+        run_sirepo_sweep(
+            sirepo_session,
+            simulation_data=sirepo_session.simulation_data(simulation_id),
+            parameter_space=parameter_space,
+            output_path="results.h5",
+            simulation_report="watchpointReport6",
+            journal_path="results.journal",
+        )
+
+With a journal the sweep can be interrupted and run again with the same
+arguments: samples already written are skipped and failed samples are retried.
+"""
+import copy
+import itertools
+import json
+import logging
+import os
+
+from collections import Counter
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from deep_beamline_simulation import SirepoSimulationError
+from deep_beamline_simulation.disk_cache import canonical_hash
+from deep_beamline_simulation.session_pool import SirepoSessionPool
+from deep_beamline_simulation.simulation_cache import simulation_cache_key
+
+
+class SweepParameter:
+    """
+    One field of one beamline element to vary in a sweep.
+
+    Parameters
+    ----------
+    element_title: str
+      the "title" of the element in models["beamline"], eg. "Aperture"
+    field_name: str
+      the element field to set, eg. "horizontalSize"
+    low: float
+      smallest value
+    high: float
+      largest value
+    count: int, optional
+      number of values for grid sampling
+    """
+
+    def __init__(self, element_title, field_name, low, high, count=None):
+        if high < low:
+            raise ValueError(f"high ({high}) must not be less than low ({low})")
+        self.element_title = element_title
+        self.field_name = field_name
+        self.low = low
+        self.high = high
+        self.count = count
+
+    @property
+    def name(self):
+        return f"{self.element_title}_{self.field_name}"
+
+    def grid_values(self):
+        if self.count is None:
+            raise ValueError(f"parameter '{self.name}' needs a count for grid sampling")
+        return np.linspace(self.low, self.high, self.count)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(element_title='{self.element_title}', field_name='{self.field_name}', "
+            f"low={self.low}, high={self.high}, count={self.count})"
+        )
+
+
+class ParameterSpace:
+    """
+    The parameter values of every sample in a sweep.
+
+    Sampling methods:
+      "grid"             every combination of each parameter's `count` evenly spaced values
+      "latin_hypercube"  `sample_count` samples, one in each of `sample_count` strata of every parameter
+      "sobol"            `sample_count` points of a scrambled Sobol sequence, requires scipy
+      "random"           `sample_count` uniformly distributed samples
+
+    Samples are indexed in a fixed order, so the same ParameterSpace with the same
+    seed always gives the same sample for the same index.
+
+    Parameters
+    ----------
+    parameters: list of SweepParameter
+    sampling: str
+      one of the sampling methods above
+    sample_count: int, optional
+      number of samples, required for every sampling method except "grid"
+    seed: int, optional
+      seed for the random sampling methods
+    """
+
+    sampling_methods = ("grid", "latin_hypercube", "sobol", "random")
+
+    def __init__(self, parameters, sampling="grid", sample_count=None, seed=None):
+        if sampling not in self.sampling_methods:
+            raise ValueError(f"sampling must be one of {self.sampling_methods}, not '{sampling}'")
+        if len(parameters) == 0:
+            raise ValueError("at least one parameter is required")
+        self.parameters = list(parameters)
+        self.sampling = sampling
+        self.seed = seed
+
+        if sampling == "grid":
+            self._grid_values = [parameter.grid_values() for parameter in self.parameters]
+            self.sample_count = int(np.prod([len(values) for values in self._grid_values]))
+            self._samples = None
+        else:
+            if sample_count is None:
+                raise ValueError(f"sample_count is required for '{sampling}' sampling")
+            self.sample_count = sample_count
+            unit_samples = _unit_samples(sampling, sample_count, len(self.parameters), seed)
+            lows = np.array([parameter.low for parameter in self.parameters])
+            highs = np.array([parameter.high for parameter in self.parameters])
+            self._samples = lows + unit_samples * (highs - lows)
+
+    @property
+    def names(self):
+        return [parameter.name for parameter in self.parameters]
+
+    def __len__(self):
+        return self.sample_count
+
+    def description(self):
+        """
+        Return a JSON-compatible description of the samples, used to recognize the same sweep when resuming.
+        """
+        return {
+            "parameters": [
+                [parameter.element_title, parameter.field_name, parameter.low, parameter.high, parameter.count]
+                for parameter in self.parameters
+            ],
+            "sampling": self.sampling,
+            "sample_count": self.sample_count,
+            "seed": self.seed,
+        }
+
+    def __getitem__(self, sample_i):
+        """
+        Return the parameter values of one sample as a 1-D array.
+        """
+        if not 0 <= sample_i < self.sample_count:
+            raise IndexError(f"sample index {sample_i} is out of range for {self.sample_count} samples")
+        if self._samples is None:
+            grid_indices = np.unravel_index(sample_i, [len(values) for values in self._grid_values])
+            return np.array([values[grid_i] for values, grid_i in zip(self._grid_values, grid_indices)])
+        else:
+            return self._samples[sample_i].copy()
+
+    def __iter__(self):
+        if self._samples is None:
+            for sample_values in itertools.product(*self._grid_values):
+                yield np.array(sample_values)
+        else:
+            yield from (sample_values.copy() for sample_values in self._samples)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(parameters={self.parameters!r}, sampling='{self.sampling}', "
+            f"sample_count={self.sample_count}, seed={self.seed})"
+        )
+
+
+def _unit_samples(sampling, sample_count, parameter_count, seed):
+    """
+    Return a (sample_count, parameter_count) array of samples in the unit hypercube.
+    """
+    rng = np.random.default_rng(seed)
+    if sampling == "random":
+        return rng.random((sample_count, parameter_count))
+    elif sampling == "latin_hypercube":
+        # one sample in a random position in each stratum, strata shuffled independently for each parameter
+        strata = np.stack([rng.permutation(sample_count) for _ in range(parameter_count)], axis=1)
+        return (strata + rng.random((sample_count, parameter_count))) / sample_count
+    elif sampling == "sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError as import_error:
+            raise ImportError("'sobol' sampling requires scipy") from import_error
+        return qmc.Sobol(d=parameter_count, scramble=True, seed=rng).random(sample_count)
+    else:
+        raise ValueError(f"unknown sampling method '{sampling}'")
+
+
+def find_beamline_element(simulation_data, element_title):
+    """
+    Return the element of simulation_data["models"]["beamline"] with the specified title.
+    """
+    for beamline_element in simulation_data["models"]["beamline"]:
+        if beamline_element.get("title") == element_title:
+            return beamline_element
+    raise KeyError(f"no beamline element with title '{element_title}'")
+
+
+def apply_parameters(simulation_data, parameters, parameter_values):
+    """
+    Return a copy of simulation_data with each parameter set to the corresponding value.
+    """
+    simulation_data_copy = copy.deepcopy(simulation_data)
+    for parameter, parameter_value in zip(parameters, parameter_values):
+        find_beamline_element(simulation_data_copy, parameter.element_title)[parameter.field_name] = float(
+            parameter_value
+        )
+    return simulation_data_copy
+
+
+def intensity_matrix(run_status):
+    """
+    Return the intensity matrix of a completed run-status as a (rows, columns) array.
+    """
+    return np.asarray(run_status["z_matrix"], dtype=np.float64).reshape(
+        run_status["y_range"][2], run_status["x_range"][2]
+    )
+
+
+class SweepWriter:
+    """
+    Write sweep samples into an HDF5 file in any order.
+
+    The datasets are allocated for `sample_count` samples when the first intensity
+    matrix arrives, since that is when its shape is known. Each intensity matrix is
+    its own compressed chunk, so writing or reading one sample touches one chunk.
+
+    Parameters
+    ----------
+    output_path: path-like
+      HDF5 file to create
+    parameter_names: list of str
+      the "params" dataset
+    sample_count: int
+      number of samples in the sweep
+    compression: str, optional
+      HDF5 compression filter for beamIntensities, None for no compression
+    compression_opts: int, optional
+      compression level
+    resume: bool
+      if True and output_path exists, open it to write the remaining samples
+    """
+
+    def __init__(
+        self,
+        output_path,
+        parameter_names,
+        sample_count,
+        compression="gzip",
+        compression_opts=4,
+        resume=False,
+    ):
+        self.output_path = output_path
+        self.parameter_names = list(parameter_names)
+        self.sample_count = sample_count
+        self.compression = compression
+        self.compression_opts = compression_opts if compression is not None else None
+
+        if resume and Path(output_path).exists():
+            self._h5_file = h5py.File(output_path, mode="r+")
+            self._param_vals = self._h5_file["paramVals"]
+            self._beam_intensities = self._h5_file.get("beamIntensities")
+            existing_parameter_names = [param.decode() for param in self._h5_file["params"]]
+            if existing_parameter_names != self.parameter_names or self._param_vals.shape[0] != sample_count:
+                self._h5_file.close()
+                raise ValueError(
+                    f"can not resume '{output_path}': it has parameters {existing_parameter_names} "
+                    f"and {self._param_vals.shape[0]} samples"
+                )
+        else:
+            self._h5_file = h5py.File(output_path, mode="w")
+            self._h5_file.create_dataset("params", data=self.parameter_names, dtype=h5py.string_dtype())
+            self._param_vals = self._h5_file.create_dataset(
+                "paramVals",
+                shape=(sample_count, len(self.parameter_names)),
+                dtype=np.float64,
+                chunks=(min(max(sample_count, 1), 4096), len(self.parameter_names)),
+            )
+            self._beam_intensities = None
+
+    def write(self, sample_i, parameter_values, intensity_matrix):
+        """
+        Write one sample. Samples may be written in any order.
+        """
+        intensity_matrix = np.asarray(intensity_matrix)
+        if self._beam_intensities is None:
+            self._beam_intensities = self._h5_file.create_dataset(
+                "beamIntensities",
+                shape=(self.sample_count, *intensity_matrix.shape),
+                dtype=intensity_matrix.dtype,
+                chunks=(1, *intensity_matrix.shape),
+                compression=self.compression,
+                compression_opts=self.compression_opts,
+                shuffle=self.compression is not None,
+            )
+        elif intensity_matrix.shape != self._beam_intensities.shape[1:]:
+            raise ValueError(
+                f"sample {sample_i} has intensity matrix shape {intensity_matrix.shape}, "
+                f"expected {self._beam_intensities.shape[1:]}"
+            )
+        self._param_vals[sample_i] = parameter_values
+        self._beam_intensities[sample_i] = intensity_matrix
+
+    def flush(self):
+        """
+        Write buffered data to disk, for example before recording a sample as completed.
+        """
+        self._h5_file.flush()
+
+    def close(self):
+        self._h5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class SweepJournal:
+    """
+    An append-only record of the progress of a sweep.
+
+    Each line of the journal file is a JSON object. The first line identifies the
+    sweep and the others record a completed sample, or a failed attempt and its error:
+
+        {"event": "start", "sweep_key": "...", "sample_count": 5000}
+        {"event": "completed", "sample": 17}
+        {"event": "failed", "sample": 18, "error": "simulation error: ..."}
+
+    Every record is flushed to disk before the method writing it returns, and a
+    sample must be recorded as completed only after it has been written to the output
+    file, so after an interruption the journal never claims a sample that is not on disk.
+    A partially written last line is ignored.
+
+    Parameters
+    ----------
+    journal_path: path-like or None
+      the journal file, None to keep the journal in memory
+    sweep_key: str
+      identifies the sweep, ValueError is raised if an existing journal has a different key
+    sample_count: int
+      number of samples in the sweep
+    """
+
+    def __init__(self, journal_path, sweep_key, sample_count):
+        self.journal_path = journal_path
+        self.sweep_key = sweep_key
+        self.sample_count = sample_count
+        self.completed_samples = set()
+        self.failure_counts = Counter()
+        self.errors = {}
+        self._journal_file = None
+
+        if journal_path is None:
+            return
+
+        if Path(journal_path).exists():
+            self._replay()
+            self._journal_file = open(journal_path, "a")
+        else:
+            self._journal_file = open(journal_path, "w")
+            self._append({"event": "start", "sweep_key": sweep_key, "sample_count": sample_count})
+
+    @property
+    def resumed(self):
+        """
+        True if the journal records earlier progress of this sweep.
+        """
+        return len(self.completed_samples) > 0 or len(self.failure_counts) > 0
+
+    def _replay(self):
+        with open(self.journal_path) as journal_file:
+            journal_lines = journal_file.readlines()
+        for journal_line_i, journal_line in enumerate(journal_lines):
+            try:
+                journal_record = json.loads(journal_line)
+            except json.JSONDecodeError:
+                if journal_line_i == len(journal_lines) - 1:
+                    # interrupted while writing the last line
+                    break
+                raise
+            if journal_record["event"] == "start":
+                if journal_record["sweep_key"] != self.sweep_key:
+                    raise ValueError(
+                        f"journal '{self.journal_path}' belongs to a different sweep, "
+                        f"delete it to start this sweep from the beginning"
+                    )
+            elif journal_record["event"] == "completed":
+                self.completed_samples.add(journal_record["sample"])
+            elif journal_record["event"] == "failed":
+                self.failure_counts[journal_record["sample"]] += 1
+                self.errors[journal_record["sample"]] = journal_record["error"]
+
+        if journal_lines and not journal_lines[-1].endswith("\n"):
+            # drop the partial line so the next record starts on its own line
+            with open(self.journal_path, "w") as journal_file:
+                journal_file.writelines(journal_lines[:-1])
+
+    def _append(self, journal_record):
+        if self._journal_file is None:
+            return
+        self._journal_file.write(json.dumps(journal_record) + "\n")
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+
+    def record_completed(self, sample_i):
+        self.completed_samples.add(sample_i)
+        self._append({"event": "completed", "sample": sample_i})
+
+    def record_failed(self, sample_i, error):
+        self.failure_counts[sample_i] += 1
+        self.errors[sample_i] = str(error)
+        self._append({"event": "failed", "sample": sample_i, "error": str(error)})
+
+    def pending_samples(self, max_attempts):
+        """
+        Return the samples that are not completed and have failed fewer than max_attempts times.
+        """
+        return [
+            sample_i
+            for sample_i in range(self.sample_count)
+            if sample_i not in self.completed_samples and self.failure_counts[sample_i] < max_attempts
+        ]
+
+    def failed_samples(self, max_attempts):
+        """
+        Return the samples that are not completed and have failed max_attempts times.
+        """
+        return [
+            sample_i
+            for sample_i in range(self.sample_count)
+            if sample_i not in self.completed_samples and self.failure_counts[sample_i] >= max_attempts
+        ]
+
+    def close(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def sweep_key(simulation_data, parameter_space, simulation_report):
+    """
+    Return a key identifying a sweep by its simulation, samples, and report.
+    """
+    return canonical_hash(
+        {
+            "simulation": simulation_cache_key(simulation_data, simulation_report),
+            "parameter_space": parameter_space.description(),
+        }
+    )
+
+
+def run_sirepo_sweep(
+    sirepo_session,
+    simulation_data,
+    parameter_space,
+    output_path,
+    simulation_report,
+    simulation_id=None,
+    compression="gzip",
+    journal_path=None,
+    max_attempts=3,
+    **run_simulations_kwargs,
+):
+    """
+    Run a simulation for every sample in parameter_space and stream the results into an HDF5 file.
+
+    Simulations are run with `sirepo_session.run_simulations`, so several run at the
+    same time, and each intensity matrix is written as soon as its simulation
+    completes. Only the simulations in flight are held in memory, however large the sweep.
+
+    A failed simulation does not stop the sweep. It is run again after the other
+    samples, up to `max_attempts` times. With a `journal_path` the progress of the
+    sweep is recorded in a SweepJournal, and running the same sweep again resumes
+    it: completed samples are skipped and failed samples with attempts left are retried.
+
+    Parameters
+    ----------
+    sirepo_session: SirepoGuestSession or SirepoSessionPool
+      a logged-in session, or a pool to spread the sweep over several servers
+    simulation_data: dict
+      simulation data to modify for each sample
+    parameter_space: ParameterSpace
+      the samples, sampling other than "grid" needs a seed to be resumed
+    output_path: path-like
+      HDF5 file to create, or to complete when resuming
+    simulation_report: str
+      report producing the intensity matrix, eg. "watchpointReport6"
+    simulation_id: str, optional
+      id of the simulation on the session's server, by default the id in simulation_data;
+      not used with a SirepoSessionPool
+    compression: str, optional
+      see SweepWriter
+    journal_path: path-like, optional
+      journal file, by default the sweep can not be resumed
+    max_attempts: int
+      number of times a sample is run before it is given up
+    run_simulations_kwargs:
+      passed to `run_simulations`, eg. max_concurrent_simulations
+
+    Returns
+    -------
+    path-like
+      output_path
+
+    Raises
+    ------
+    SirepoSimulationError
+      if some samples failed `max_attempts` times; all other samples have been written
+    """
+    log = logging.getLogger("deep_beamline_simulation.sweep")
+
+    if journal_path is not None and parameter_space.sampling != "grid" and parameter_space.seed is None:
+        raise ValueError(f"'{parameter_space.sampling}' sampling needs a seed to resume a sweep from a journal")
+
+    sweep_journal = SweepJournal(
+        journal_path, sweep_key(simulation_data, parameter_space, simulation_report), len(parameter_space)
+    )
+    with sweep_journal:
+        if sweep_journal.resumed and not Path(output_path).exists():
+            raise ValueError(f"can not resume the sweep in journal '{journal_path}', '{output_path}' is missing")
+        if sweep_journal.resumed:
+            log.info(
+                "resuming sweep with %d of %d samples completed",
+                len(sweep_journal.completed_samples),
+                len(parameter_space),
+            )
+        sweep_writer = SweepWriter(
+            output_path,
+            parameter_space.names,
+            len(parameter_space),
+            compression=compression,
+            resume=sweep_journal.resumed,
+        )
+        with sweep_writer:
+            pending_samples = sweep_journal.pending_samples(max_attempts)
+            while pending_samples:
+                _run_sirepo_sweep_samples(
+                    sirepo_session,
+                    simulation_data,
+                    parameter_space,
+                    pending_samples,
+                    simulation_report,
+                    simulation_id,
+                    sweep_writer,
+                    sweep_journal,
+                    run_simulations_kwargs,
+                )
+                pending_samples = sweep_journal.pending_samples(max_attempts)
+
+        failed_samples = sweep_journal.failed_samples(max_attempts)
+        if failed_samples:
+            raise SirepoSimulationError(
+                f"{len(failed_samples)} of {len(parameter_space)} samples failed {max_attempts} times, "
+                f"for example sample {failed_samples[0]}: {sweep_journal.errors[failed_samples[0]]}"
+            )
+
+    return output_path
+
+
+def _run_sirepo_sweep_samples(
+    sirepo_session,
+    simulation_data,
+    parameter_space,
+    sample_indices,
+    simulation_report,
+    simulation_id,
+    sweep_writer,
+    sweep_journal,
+    run_simulations_kwargs,
+):
+    """
+    Run one attempt of each sample in sample_indices, recording the results in sweep_journal.
+    """
+    log = logging.getLogger("deep_beamline_simulation.sweep")
+
+    simulation_data_list = (
+        apply_parameters(simulation_data, parameter_space.parameters, parameter_space[sample_i])
+        for sample_i in sample_indices
+    )
+    if isinstance(sirepo_session, SirepoSessionPool):
+        run_status_responses = sirepo_session.run_simulations(
+            simulation_data_list,
+            simulation_report=simulation_report,
+            return_exceptions=True,
+            **run_simulations_kwargs,
+        )
+    else:
+        if simulation_id is None:
+            simulation_id = simulation_data["models"]["simulation"]["simulationId"]
+        run_status_responses = sirepo_session.run_simulations(
+            simulation_id,
+            simulation_data_list,
+            simulation_report=simulation_report,
+            return_exceptions=True,
+            **run_simulations_kwargs,
+        )
+
+    for sample_indices_i, run_status_response in run_status_responses:
+        sample_i = sample_indices[sample_indices_i]
+        if isinstance(run_status_response, SirepoSimulationError):
+            sweep_journal.record_failed(sample_i, run_status_response)
+            log.warning(
+                "sample %d failed (attempt %d): %s",
+                sample_i,
+                sweep_journal.failure_counts[sample_i],
+                run_status_response,
+            )
+            continue
+
+        sweep_writer.write(sample_i, parameter_space[sample_i], intensity_matrix(run_status_response.json()))
+        # the sample must be on disk before the journal says it is completed
+        sweep_writer.flush()
+        sweep_journal.record_completed(sample_i)
+        log.info(
+            "wrote sample %d (%d of %d)",
+            sample_i,
+            len(sweep_journal.completed_samples),
+            len(parameter_space),
+        )
@@ -0,0 +1,205 @@
+"""
+Serve preprocessed training data from torch tensors in memory.
+
+A DataLoader over IntensityImageDataset indexes NumPy arrays one sample at a
+time and collates the samples into a batch in Python. For a dataset that fits
+in memory `TensorIntensityImageDataset` converts the images and parameters once
+to contiguous float32 tensors, and `TensorBatchLoader` gathers each batch with a
+single index_select on each tensor, with no per-sample work:
+
+    dataset = TensorIntensityImageDataset.from_h5("preprocessed_results.h5")
+    for correct_images, images, input_params in TensorBatchLoader(dataset, batch_size=10):
+        ...
+
+With pin_memory=True batches are gathered into page-locked memory, so they can
+be copied to a CUDA device with non_blocking=True.
+"""
+import logging
+
+import h5py
+import numpy as np
+import torch
+
+from deep_beamline_simulation.conditioning import SharedInitialImage
+from deep_beamline_simulation.lazy_dataset import contiguous_runs
+
+
+class TensorIntensityImageDataset:
+    """
+    An in-memory dataset of intensity images as float32 torch tensors.
+
+    Items are (image, initial image, parameter values) like IntensityImageDataset,
+    or (image, parameter values) with shared_initial_intensity=True. Indexed with a
+    sequence or tensor of indices the dataset returns a batch of stacked tensors.
+
+    Parameters
+    ----------
+    beam_intensities: array-like
+      (N, H, W) images
+    initial_beam_intensity: array-like
+      (H, W) initial image
+    params: array-like
+      the parameter names
+    param_vals: array-like
+      (N, P) parameter values
+    pin_memory: bool
+      if True gather batches into page-locked memory, only when CUDA is available
+    shared_initial_intensity: bool
+      if True leave the initial image out of the items, it is shared_initial_image
+    """
+
+    def __init__(
+        self,
+        beam_intensities,
+        initial_beam_intensity,
+        params,
+        param_vals,
+        pin_memory=False,
+        shared_initial_intensity=False,
+    ):
+        log = logging.getLogger(self.__class__.__name__)
+
+        self.beam_intensities = torch.from_numpy(
+            np.ascontiguousarray(np.expand_dims(beam_intensities, axis=1), dtype=np.float32)
+        )
+        self.param_vals = torch.from_numpy(np.ascontiguousarray(param_vals, dtype=np.float32))
+        if len(self.beam_intensities) != len(self.param_vals):
+            raise ValueError(
+                f"{len(self.beam_intensities)} images and {len(self.param_vals)} parameter values do not match"
+            )
+        self.params = params
+        self.shared_initial_image = SharedInitialImage(initial_beam_intensity)
+        self.initial_beam_intensity = self.shared_initial_image.image
+        self.shared_initial_intensity = shared_initial_intensity
+
+        if pin_memory and not torch.cuda.is_available():
+            log.warning("pin_memory=True but CUDA is not available, batches will not be pinned")
+            pin_memory = False
+        self.pin_memory = pin_memory
+
+    @classmethod
+    def from_h5(cls, h5_path, indices=None, pin_memory=False, shared_initial_intensity=False):
+        """
+        Read a dataset from a file written by `preprocess_beam_intensities`.
+
+        Parameters
+        ----------
+        h5_path: path-like
+        indices: sequence of int, optional
+          the images in this dataset, by default every image
+        """
+        with h5py.File(h5_path, mode="r") as preprocessed_results:
+            beam_intensities = preprocessed_results["preprocessed_beam_intensities"]
+            param_vals = preprocessed_results["preprocessed_param_vals"]
+            if indices is None:
+                beam_intensities = beam_intensities[()]
+                param_vals = param_vals[()]
+            else:
+                # read each run of consecutive images with a slice, then restore the order of indices
+                indices = np.asarray(indices, dtype=np.int64)
+                unique_indices, inverse = np.unique(indices, return_inverse=True)
+                # an empty slice keeps the shape of an empty selection
+                runs = contiguous_runs(unique_indices) or [(0, 0)]
+                beam_intensities = np.concatenate([beam_intensities[start:stop] for start, stop in runs])[inverse]
+                param_vals = np.concatenate([param_vals[start:stop] for start, stop in runs])[inverse]
+            return cls(
+                beam_intensities=beam_intensities,
+                initial_beam_intensity=preprocessed_results["preprocessed_initial_beam_intensity"][()],
+                params=preprocessed_results["params"][()],
+                param_vals=param_vals,
+                pin_memory=pin_memory,
+                shared_initial_intensity=shared_initial_intensity,
+            )
+
+    def __len__(self):
+        return len(self.beam_intensities)
+
+    def __getitem__(self, index):
+        """
+        Returns the specified intensity image at the index given, or a batch of
+        stacked tensors if index is a sequence or tensor of indices
+        """
+        if np.ndim(index) > 0:
+            return self.gather(index)
+        if self.shared_initial_intensity:
+            return self.beam_intensities[index], self.param_vals[index]
+        return self.beam_intensities[index], self.initial_beam_intensity, self.param_vals[index]
+
+    def gather(self, indices):
+        """
+        Return the images, initial images, and parameter values at indices as stacked tensors,
+        or only the images and parameter values with shared_initial_intensity=True.
+
+        The initial image tensor is a broadcast view of a single image.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        if self.pin_memory:
+            images = torch.empty((len(indices),) + self.beam_intensities.shape[1:]).pin_memory()
+            param_vals = torch.empty((len(indices),) + self.param_vals.shape[1:]).pin_memory()
+            torch.index_select(self.beam_intensities, 0, indices, out=images)
+            torch.index_select(self.param_vals, 0, indices, out=param_vals)
+        else:
+            images = self.beam_intensities.index_select(0, indices)
+            param_vals = self.param_vals.index_select(0, indices)
+        if self.shared_initial_intensity:
+            return images, param_vals
+        return images, self.shared_initial_image.expand(len(indices)), param_vals
+
+    def report(self):
+        """
+        Print information about the current data
+        """
+        print(f"length: {len(self)}")
+        print(f"initial beam intensity.shape:\n{tuple(self.initial_beam_intensity.shape)}\n")
+        print(f"data shape:\n{tuple(self.beam_intensities.shape)}\n")
+        print(f"pinned batches: {self.pin_memory}")
+        print(f"beamline parameters dtype:\n\t{self.params.dtype}\n")
+        print(f"beamline parameters:\n\t{self.params}\n")
+
+
+class TensorBatchLoader:
+    """
+    Iterate over batches of a TensorIntensityImageDataset, in place of a DataLoader.
+
+    Each batch is gathered from the dataset tensors with one index_select on each
+    tensor. There is no collate and there are no worker processes.
+
+    Parameters
+    ----------
+    dataset: TensorIntensityImageDataset
+    batch_size: int
+    shuffle: bool
+      if True the order of the samples is shuffled each epoch
+    drop_last: bool
+      if True do not yield a last batch smaller than batch_size
+    seed: int, optional
+      seed for the shuffled order, the order still changes from epoch to epoch
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, seed=None):
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not {batch_size}")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._generator = torch.Generator()
+        if seed is None:
+            self._generator.seed()
+        else:
+            self._generator.manual_seed(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.dataset), generator=self._generator)
+        else:
+            indices = torch.arange(len(self.dataset))
+        for batch_indices in torch.split(indices, self.batch_size):
+            if self.drop_last and len(batch_indices) < self.batch_size:
+                break
+            yield self.dataset.gather(batch_indices)
@@ -3,6 +3,7 @@ import logging
 import pytest
 
 from deep_beamline_simulation import SirepoGuestSession
+from deep_beamline_simulation.tests.fake_sirepo import FakeSirepoServer
 
 
 # urllib3 generates a lot of DEBUG logging output when
@@ -16,6 +17,18 @@ def sirepo_server_url():
     return "http://localhost:8000"
 
 
+@pytest.fixture
+def fake_sirepo_server():
+    """
+    A FakeSirepoServer running in this process, for tests that do not need SRW.
+
+    Tests may change the server's run_seconds, next_request_seconds, and fail attributes.
+    """
+    fake_sirepo_server_ = FakeSirepoServer().start()
+    yield fake_sirepo_server_
+    fake_sirepo_server_.stop()
+
+
 @pytest.fixture
 def sirepo_guest_session(sirepo_server_url):
     """
@@ -0,0 +1,261 @@
+"""
+A small in-process imitation of the Sirepo HTTP API for offline tests.
+
+Only the endpoints used by deep_beamline_simulation are implemented:
+
+    POST /simulation-list
+    POST /auth-guest-login/<simulation type>
+    GET  /simulation/<simulation type>/<simulation id>/0
+    POST /copy-simulation
+    POST /delete-simulation
+    POST /run-simulation
+    POST /run-status
+
+The simulation-list and simulation responses carry an ETag header and a request
+with a matching If-None-Match header gets a "304 Not Modified" response.
+
+Like Sirepo, a job is identified by simulation id and report, and starting a job
+cancels a running job with the same simulation id and report.
+"""
+import copy
+import hashlib
+import json
+import threading
+import time as ttime
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def aperture_simulation_data(simulation_id, name="Diffraction by an Aperture", folder="/Wavefront Propagation"):
+    return {
+        "models": {
+            "simulation": {
+                "folder": folder,
+                "name": name,
+                "simulationId": simulation_id,
+            },
+            "beamline": [
+                {
+                    "horizontalOffset": 0,
+                    "horizontalSize": 1,
+                    "id": 4,
+                    "position": 25,
+                    "shape": "r",
+                    "title": "Aperture",
+                    "type": "aperture",
+                    "verticalOffset": 0,
+                    "verticalSize": 1,
+                },
+                {"id": 5, "position": 27, "title": "Watchpoint", "type": "watch"},
+            ],
+        },
+        "simulationType": "srw",
+    }
+
+
+def intensity_report(simulation_data, row_count=6, column_count=8):
+    """
+    Return a completed run-status with an intensity matrix computed from the aperture size.
+    """
+    aperture = simulation_data["models"]["beamline"][0]
+    horizontal_size = aperture["horizontalSize"]
+    vertical_size = aperture["verticalSize"]
+    return {
+        "state": "completed",
+        "x_label": "Horizontal Position [m]",
+        "x_range": [-horizontal_size, horizontal_size, column_count],
+        "y_label": "Vertical Position [m]",
+        "y_range": [-vertical_size, vertical_size, row_count],
+        "z_label": "Intensity",
+        "z_matrix": [
+            [horizontal_size * (column_i + 1) + vertical_size * (row_i + 1) for column_i in range(column_count)]
+            for row_i in range(row_count)
+        ],
+    }
+
+
+class FakeSirepoServer:
+    """
+    Serve the fake Sirepo API from a daemon thread.
+
+    Parameters
+    ----------
+    run_seconds: float
+      wall time each simulation "runs" before run-status reports it completed
+    next_request_seconds: float
+      the nextRequestSeconds hint sent to clients
+    """
+
+    def __init__(self, run_seconds=0.05, next_request_seconds=0.01):
+        self.run_seconds = run_seconds
+        self.next_request_seconds = next_request_seconds
+
+        self.lock = threading.Lock()
+        # count of requests by endpoint, eg. request_counts["run-status"]
+        self.request_counts = Counter()
+        # number of jobs running at any time, and the maximum seen
+        self.running_job_count = 0
+        self.max_running_job_count = 0
+        self.simulations = {}
+        self.jobs = {}
+        self.fail = False
+
+        for simulation_data in (
+            aperture_simulation_data("zFJ9LE0c"),
+            aperture_simulation_data(
+                "uaq7GPvv",
+                name="NSLS-II SRX beamline",
+                folder="/Light Source Facilities/NSLS-II/NSLS-II SRX beamline",
+            ),
+        ):
+            self.simulations[simulation_data["models"]["simulation"]["simulationId"]] = simulation_data
+
+        self._http_server = ThreadingHTTPServer(("127.0.0.1", 0), _make_request_handler(self))
+        self.url = f"http://127.0.0.1:{self._http_server.server_address[1]}"
+        self._thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving, for example to imitate a server that has gone down. Calling stop again does nothing.
+        """
+        if self._thread.is_alive():
+            self._http_server.shutdown()
+            self._http_server.server_close()
+
+    def simulation_list(self):
+        return [
+            {
+                "folder": simulation_data["models"]["simulation"]["folder"],
+                "name": simulation_data["models"]["simulation"]["name"],
+                "simulationId": simulation_id,
+            }
+            for simulation_id, simulation_data in self.simulations.items()
+        ]
+
+    def copy_simulation(self, request_json):
+        simulation_data = copy.deepcopy(self.simulations[request_json["simulationId"]])
+        simulation_id = uuid.uuid4().hex[:8]
+        simulation_data["models"]["simulation"].update(
+            simulationId=simulation_id,
+            name=request_json["name"],
+            folder=request_json["folder"],
+        )
+        self.simulations[simulation_id] = simulation_data
+        return simulation_data
+
+    def run_simulation(self, request_json):
+        job_key = (request_json["simulationId"], request_json.get("report"))
+        if job_key in self.jobs and self.jobs[job_key]["state"] == "running":
+            # Sirepo cancels the running job
+            self._finish_job(self.jobs[job_key], "canceled")
+        self.running_job_count += 1
+        self.max_running_job_count = max(self.max_running_job_count, self.running_job_count)
+        job = {
+            "state": "running",
+            "serial": uuid.uuid4().hex,
+            "start_time": ttime.monotonic(),
+            "simulation_data": request_json,
+        }
+        self.jobs[job_key] = job
+        return self._job_status(job_key, job)
+
+    def run_status(self, request_json):
+        job_key = (request_json["simulationId"], request_json.get("report"))
+        job = self.jobs[job_key]
+        if job["serial"] != request_json["computeJobSerial"]:
+            return {"state": "canceled"}
+        return self._job_status(job_key, job)
+
+    def _job_status(self, job_key, job):
+        if job["state"] == "running" and ttime.monotonic() - job["start_time"] >= self.run_seconds:
+            aperture = job["simulation_data"]["models"]["beamline"][0]
+            if self.fail or aperture["horizontalSize"] < 0:
+                self._finish_job(job, "error")
+            else:
+                self._finish_job(job, "completed")
+
+        if job["state"] == "completed":
+            return intensity_report(job["simulation_data"])
+        elif job["state"] == "error":
+            return {"state": "error", "error": "aperture size must be positive"}
+        else:
+            return {
+                "state": "running",
+                "nextRequest": {
+                    "computeJobSerial": job["serial"],
+                    "report": job_key[1],
+                    "simulationId": job_key[0],
+                    "simulationType": "srw",
+                },
+                "nextRequestSeconds": self.next_request_seconds,
+            }
+
+    def _finish_job(self, job, state):
+        job["state"] = state
+        self.running_job_count -= 1
+
+
+def _make_request_handler(fake_sirepo_server):
+    class FakeSirepoRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            # /simulation/<simulation type>/<simulation id>/0
+            _, endpoint, _, simulation_id, _ = self.path.split("/")
+            with fake_sirepo_server.lock:
+                fake_sirepo_server.request_counts[endpoint] += 1
+                simulation_data = fake_sirepo_server.simulations.get(simulation_id)
+                if simulation_data is None:
+                    self._send_json({"state": "error", "error": "not found"}, status=404)
+                else:
+                    self._send_json(simulation_data, etag=True)
+
+        def do_POST(self):
+            endpoint = self.path.split("/")[1]
+            content_length = int(self.headers.get("Content-Length", 0))
+            request_json = json.loads(self.rfile.read(content_length) or b"{}")
+            with fake_sirepo_server.lock:
+                fake_sirepo_server.request_counts[endpoint] += 1
+                if endpoint == "simulation-list":
+                    self._send_json(fake_sirepo_server.simulation_list(), etag=True)
+                elif endpoint == "auth-guest-login":
+                    self._send_json({"state": "ok"})
+                elif endpoint == "copy-simulation":
+                    self._send_json(fake_sirepo_server.copy_simulation(request_json))
+                elif endpoint == "delete-simulation":
+                    del fake_sirepo_server.simulations[request_json["simulationId"]]
+                    self._send_json({"state": "ok"})
+                elif endpoint == "run-simulation":
+                    self._send_json(fake_sirepo_server.run_simulation(request_json))
+                elif endpoint == "run-status":
+                    self._send_json(fake_sirepo_server.run_status(request_json))
+                else:
+                    self._send_json({"state": "error", "error": "not found"}, status=404)
+
+        def _send_json(self, response_json, status=200, etag=False):
+            response_body = json.dumps(response_json).encode()
+            if etag:
+                response_etag = f'"{hashlib.sha1(response_body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == response_etag:
+                    fake_sirepo_server.request_counts["not-modified"] += 1
+                    self.send_response(304)
+                    self.send_header("ETag", response_etag)
+                    self.end_headers()
+                    return
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", response_etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response_body)))
+            self.send_header("Set-Cookie", "sirepo_dev=fake-guest-cookie; Path=/")
+            self.end_headers()
+            self.wfile.write(response_body)
+
+    return FakeSirepoRequestHandler
@@ -0,0 +1,165 @@
+import asyncio
+import copy
+import subprocess
+import sys
+
+import pytest
+
+from deep_beamline_simulation import AsyncSirepoGuestSession, SirepoSimulationError
+
+
+def test_package_import_does_not_import_aiohttp():
+    # AsyncSirepoGuestSession is imported when first used
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, deep_beamline_simulation; assert 'aiohttp' not in sys.modules; "
+            "deep_beamline_simulation.AsyncSirepoGuestSession; assert 'aiohttp' in sys.modules",
+        ],
+        check=True,
+    )
+
+
+def test_simulation_list(fake_sirepo_server):
+    async def simulation_list():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+        ) as sirepo_session:
+            return await sirepo_session.simulation_list()
+
+    simulation_table = asyncio.run(simulation_list())
+    assert "Diffraction by an Aperture" in simulation_table["/Wavefront Propagation"]
+    assert fake_sirepo_server.request_counts["auth-guest-login"] == 1
+
+
+def test_run_simulation(fake_sirepo_server):
+    async def run_simulation():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+        ) as sirepo_session:
+            simulation_table = await sirepo_session.simulation_list()
+            simulation_id = simulation_table["/Wavefront Propagation"][
+                "Diffraction by an Aperture"
+            ]
+            aperture_simulation_data = await sirepo_session.simulation_data(
+                simulation_id=simulation_id
+            )
+            run_simulation_json = await sirepo_session.run_simulation(
+                simulation_id=simulation_id,
+                simulation_data=aperture_simulation_data,
+                simulation_report="watchpointReport5",
+            )
+            return await sirepo_session.wait_for_simulation(run_simulation_json)
+
+    run_status = asyncio.run(run_simulation())
+    assert run_status["state"] == "completed"
+    assert len(run_status["z_matrix"]) == 6
+
+
+def test_run_simulations(fake_sirepo_server):
+    async def run_simulations():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+        ) as sirepo_session:
+            simulation_id = "zFJ9LE0c"
+            aperture_simulation_data = await sirepo_session.simulation_data(
+                simulation_id=simulation_id
+            )
+            aperture_simulation_data_list = []
+            for horizontal_size in range(1, 9):
+                aperture_simulation_data_copy = copy.deepcopy(aperture_simulation_data)
+                aperture = aperture_simulation_data_copy["models"]["beamline"][0]
+                aperture["horizontalSize"] = horizontal_size
+                aperture_simulation_data_list.append(aperture_simulation_data_copy)
+
+            run_statuses = {}
+            async for simulation_i, run_status in sirepo_session.run_simulations(
+                simulation_id=simulation_id,
+                simulation_data_list=aperture_simulation_data_list,
+                simulation_report="watchpointReport5",
+                max_concurrent_simulations=4,
+            ):
+                run_statuses[simulation_i] = run_status
+            return run_statuses
+
+    run_statuses = asyncio.run(run_simulations())
+    assert sorted(run_statuses) == list(range(8))
+    for simulation_i, run_status in run_statuses.items():
+        assert run_status["x_range"][1] == simulation_i + 1
+    assert fake_sirepo_server.max_running_job_count == 4
+    assert fake_sirepo_server.request_counts["delete-simulation"] == 4
+
+
+@pytest.mark.parametrize("return_exceptions", [True, False])
+def test_run_simulations_with_error(fake_sirepo_server, return_exceptions):
+    async def run_simulations():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+        ) as sirepo_session:
+            simulation_id = "zFJ9LE0c"
+            aperture_simulation_data = await sirepo_session.simulation_data(
+                simulation_id=simulation_id
+            )
+            aperture_simulation_data_list = []
+            # the fake server fails simulations with a negative aperture size
+            for horizontal_size in [1, 2, -3, 4, 5, 6]:
+                aperture_simulation_data_copy = copy.deepcopy(aperture_simulation_data)
+                aperture = aperture_simulation_data_copy["models"]["beamline"][0]
+                aperture["horizontalSize"] = horizontal_size
+                aperture_simulation_data_list.append(aperture_simulation_data_copy)
+
+            run_statuses = {}
+            async for simulation_i, run_status in sirepo_session.run_simulations(
+                simulation_id=simulation_id,
+                simulation_data_list=aperture_simulation_data_list,
+                simulation_report="watchpointReport5",
+                max_concurrent_simulations=2,
+                return_exceptions=return_exceptions,
+            ):
+                run_statuses[simulation_i] = run_status
+            return run_statuses
+
+    if return_exceptions:
+        run_statuses = asyncio.run(run_simulations())
+        assert sorted(run_statuses) == list(range(6))
+        assert isinstance(run_statuses[2], SirepoSimulationError)
+        for simulation_i in [0, 1, 3, 4, 5]:
+            assert run_statuses[simulation_i]["x_range"][1] == simulation_i + 1
+    else:
+        with pytest.raises(SirepoSimulationError):
+            asyncio.run(run_simulations())
+    # the scratch simulations are deleted either way
+    assert fake_sirepo_server.request_counts["delete-simulation"] == 2
+
+
+def test_event_loop_is_not_blocked(fake_sirepo_server):
+    """
+    Other tasks run while a simulation is waiting.
+    """
+    fake_sirepo_server.run_seconds = 0.3
+    fake_sirepo_server.next_request_seconds = 0.1
+
+    async def run_simulation_and_count_ticks():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+        ) as sirepo_session:
+            ticker = asyncio.ensure_future(tick())
+            aperture_simulation_data = await sirepo_session.simulation_data("zFJ9LE0c")
+            run_simulation_json = await sirepo_session.run_simulation(
+                simulation_id="zFJ9LE0c",
+                simulation_data=aperture_simulation_data,
+                simulation_report="watchpointReport5",
+            )
+            await sirepo_session.wait_for_simulation(run_simulation_json)
+            ticker.cancel()
+        return len(ticks)
+
+    assert asyncio.run(run_simulation_and_count_ticks()) > 10
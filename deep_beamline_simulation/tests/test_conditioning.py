@@ -0,0 +1,95 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from deep_beamline_simulation.conditioning import ParameterOnlySurrogate, SharedInitialImage, batch_to_device
+from deep_beamline_simulation.network.n02 import build_beamline_model
+from deep_beamline_simulation.tests.test_lazy_dataset import write_preprocessed_results
+from deep_beamline_simulation.u_net import UNet, build_dataloaders
+
+
+def test_shared_initial_image():
+    initial_beam_intensity = np.arange(12, dtype=np.float64).reshape(3, 4)
+    shared_initial_image = SharedInitialImage(initial_beam_intensity)
+    assert shared_initial_image.image.shape == (1, 3, 4)
+    assert shared_initial_image.image.dtype == torch.float32
+
+    images = shared_initial_image.expand(5, "cpu")
+    assert images.shape == (5, 1, 3, 4)
+    # a view of a single copy
+    assert images.stride(0) == 0
+    assert shared_initial_image.to("cpu") is shared_initial_image.to(torch.device("cpu"))
+    np.testing.assert_array_equal(images[4, 0].numpy(), initial_beam_intensity)
+
+    unpickled_shared_initial_image = pickle.loads(pickle.dumps(shared_initial_image))
+    assert unpickled_shared_initial_image._device_images == {}
+    np.testing.assert_array_equal(unpickled_shared_initial_image.image, shared_initial_image.image)
+
+
+def test_batch_to_device():
+    shared_initial_image = SharedInitialImage(np.ones((3, 4)))
+    correct_images = torch.zeros(2, 1, 3, 4)
+    input_params = torch.zeros(2, 5)
+
+    _, images, _ = batch_to_device((correct_images, input_params), "cpu", shared_initial_image)
+    assert images.shape == (2, 1, 3, 4)
+    batch = (correct_images, torch.ones(2, 1, 3, 4), input_params)
+    for batch_tensor, device_tensor in zip(batch, batch_to_device(batch, "cpu")):
+        assert device_tensor is batch_tensor
+
+    with pytest.raises(ValueError):
+        batch_to_device((correct_images, input_params), "cpu")
+
+
+@pytest.mark.parametrize("dataset_type,sampler", [("array", "random"), ("lazy", "random"), ("lazy", "block")])
+def test_shared_initial_intensity_dataloaders(tmp_path, dataset_type, sampler):
+    beam_intensities, _ = write_preprocessed_results(tmp_path / "p.h5", image_count=21)
+    training_dataloader, testing_dataloader = build_dataloaders(
+        tmp_path / "p.h5", batch_size=5, dataset_type=dataset_type, sampler=sampler, shared_initial_intensity=True
+    )
+    batch = next(iter(training_dataloader))
+    assert len(batch) == 2
+    correct_images, images, input_params = batch_to_device(
+        batch, "cpu", training_dataloader.dataset.shared_initial_image
+    )
+    assert correct_images.shape == (5, 1, 8, 8)
+    assert images.shape == (5, 1, 8, 8)
+    assert input_params.shape == (5, 2)
+
+    # the same initial image as the per-sample batches
+    _, unshared_testing_dataloader = build_dataloaders(tmp_path / "p.h5", batch_size=5, dataset_type=dataset_type)
+    _, unshared_images, _ = next(iter(unshared_testing_dataloader))
+    np.testing.assert_array_equal(images.numpy(), unshared_images.numpy())
+
+
+@pytest.mark.parametrize(
+    "model,image_size",
+    [
+        (UNet(16, 16, 2, encoder_mode="fuse"), 16),
+        (UNet(16, 16, 2, encoder_mode="skip"), 16),
+        (build_beamline_model(2), 128),
+    ],
+)
+def test_parameter_only_surrogate(model, image_size):
+    torch.manual_seed(0)
+    initial_beam_intensity = np.random.default_rng(0).uniform(size=(image_size, image_size))
+    surrogate = ParameterOnlySurrogate(model, initial_beam_intensity)
+    assert not surrogate.training and not model.training
+
+    param_vals = torch.rand(3, 2)
+    with torch.no_grad():
+        expected_images = model(
+            torch.as_tensor(initial_beam_intensity, dtype=torch.float32).expand(3, 1, -1, -1), param_vals
+        )
+        torch.testing.assert_close(surrogate(param_vals), expected_images)
+        torch.testing.assert_close(torch.jit.freeze(torch.jit.script(surrogate))(param_vals), expected_images)
+
+    # the features were computed once
+    def fail(*args):
+        raise AssertionError("image features computed again")
+
+    model.image_features = fail
+    with torch.no_grad():
+        torch.testing.assert_close(surrogate(param_vals.numpy()), expected_images)
@@ -0,0 +1,252 @@
+import concurrent.futures
+import json
+import pickle
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import torch
+
+from deep_beamline_simulation.inference import (
+    SurrogateInferenceEngine,
+    export_checkpoint,
+    is_exported_model,
+    load_exported_model,
+    save_checkpoint,
+    serve_http,
+)
+from deep_beamline_simulation.network.n02 import build_beamline_model
+from deep_beamline_simulation.u_net import UNet
+
+
+@pytest.fixture
+def unet_checkpoint_path(tmp_path):
+    torch.manual_seed(0)
+    model = UNet(16, 16, 2)
+    initial_beam_intensity = np.random.default_rng(0).normal(size=(16, 16))
+    save_checkpoint(
+        tmp_path / "unet.pt",
+        model,
+        "unet",
+        {"input_size": 16, "output_size": 16, "parameter_count": 2},
+        initial_beam_intensity,
+        params=["a", "b"],
+    )
+    model.eval()
+    with torch.no_grad():
+        expected_images = model(
+            torch.as_tensor(initial_beam_intensity, dtype=torch.float32).expand(3, 1, 16, 16),
+            torch.arange(6, dtype=torch.float32).reshape(3, 2),
+        )
+    return tmp_path / "unet.pt", expected_images[:, 0].numpy()
+
+
+def test_predict(unet_checkpoint_path):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    engine = SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu", max_batch_size=2)
+    assert engine.params == ["a", "b"]
+    assert engine.image_shape == (16, 16)
+
+    param_vals = np.arange(6).reshape(3, 2)
+    images = engine.predict(param_vals)
+    assert images.shape == (3, 16, 16)
+    np.testing.assert_allclose(images, expected_images, rtol=1e-5, atol=1e-6)
+    # in batches of max_batch_size
+    assert engine.batch_count == 2
+    np.testing.assert_allclose(engine.predict(param_vals[1]), expected_images[1], rtol=1e-5, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        engine.predict([1.0, 2.0, 3.0])
+
+
+def test_submit(unet_checkpoint_path):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    with SurrogateInferenceEngine.from_checkpoint(
+        checkpoint_path, device="cpu", max_batch_size=64, max_latency_s=0.5
+    ) as engine:
+        param_vals = np.arange(6, dtype=np.float32).reshape(3, 2)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = list(executor.map(engine.submit, [param_vals[0], param_vals[1:]]))
+        images = [future.result(timeout=10) for future in futures]
+        np.testing.assert_allclose(images[0], expected_images[0], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(images[1], expected_images[1:], rtol=1e-5, atol=1e-6)
+        # both requests in one batch
+        assert engine.batch_count == 1
+    with pytest.raises(RuntimeError):
+        engine.submit(param_vals[0])
+
+
+def test_n02_model(tmp_path):
+    save_checkpoint(
+        tmp_path / "n02.pt", build_beamline_model(3), "n02", {"parameter_count": 3}, np.ones((128, 128))
+    )
+    engine = SurrogateInferenceEngine.from_checkpoint(tmp_path / "n02.pt", device="cpu")
+    assert engine.predict(np.zeros((2, 3))).shape == (2, 128, 128)
+
+
+def test_serve_http(unet_checkpoint_path):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    with SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu") as engine:
+        http_server = serve_http(engine)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(http_server.server_address[1])
+        try:
+            request_body = json.dumps({"param_vals": [[0.0, 1.0], [2.0, 3.0]]}).encode("utf-8")
+            with urllib.request.urlopen(urllib.request.Request(url + "/predict", data=request_body)) as response:
+                response_json = json.load(response)
+            assert response_json["shape"] == [2, 16, 16]
+            np.testing.assert_allclose(response_json["images"], expected_images[:2], rtol=1e-5, atol=1e-6)
+
+            binary_request = urllib.request.Request(
+                url + "/predict", data=request_body, headers={"Accept": "application/octet-stream"}
+            )
+            with urllib.request.urlopen(binary_request) as response:
+                assert response.headers["X-Image-Shape"] == "2,16,16"
+                images = np.frombuffer(response.read(), dtype="<f4").reshape(2, 16, 16)
+            np.testing.assert_allclose(images, expected_images[:2], rtol=1e-5, atol=1e-6)
+
+            with urllib.request.urlopen(url + "/info") as response:
+                assert json.load(response)["params"] == ["a", "b"]
+
+            bad_request = urllib.request.Request(url + "/predict", data=b'{"param_vals": [[1.0]]}')
+            with pytest.raises(urllib.error.HTTPError) as http_error:
+                urllib.request.urlopen(bad_request)
+            assert http_error.value.code == 400
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+class FailingModel(torch.nn.Module):
+    def forward(self, images, input_params):
+        raise RuntimeError("model failed")
+
+
+def http_error_code(url, request_body):
+    with pytest.raises(urllib.error.HTTPError) as http_error:
+        urllib.request.urlopen(urllib.request.Request(url + "/predict", data=request_body))
+    return http_error.value.code, json.load(http_error.value)["error"]
+
+
+def test_serve_http_errors():
+    engine = SurrogateInferenceEngine(FailingModel(), np.zeros((4, 4)), params=["a"], device="cpu")
+    http_server = serve_http(engine)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(http_server.server_address[1])
+    try:
+        # the model raises
+        status, error = http_error_code(url, b'{"param_vals": [[1.0]]}')
+        assert status == 500 and "model failed" in error
+        # not a JSON object
+        assert http_error_code(url, b"[[1.0]]")[0] == 400
+        assert http_error_code(url, b'"param_vals"')[0] == 400
+        # the engine is closed
+        engine.close()
+        assert http_error_code(url, b'{"param_vals": [[1.0]]}')[0] == 503
+    finally:
+        engine.close()
+        http_server.shutdown()
+        http_server.server_close()
+
+
+@pytest.mark.parametrize("method,freeze", [("script", True), ("script", False), ("trace", True), ("export", True)])
+def test_export_checkpoint(unet_checkpoint_path, method, freeze):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    export_path = checkpoint_path.with_suffix(".ts")
+    export_checkpoint(checkpoint_path, export_path, method=method, freeze=freeze)
+    assert is_exported_model(export_path)
+    assert not is_exported_model(checkpoint_path)
+
+    model, initial_beam_intensity, params = load_exported_model(export_path)
+    assert isinstance(model, torch.nn.Module)
+    assert initial_beam_intensity.shape == (16, 16)
+    assert params == ["a", "b"]
+
+    engine = SurrogateInferenceEngine.from_checkpoint(export_path, device="cpu")
+    np.testing.assert_allclose(engine.predict(np.arange(6).reshape(3, 2)), expected_images, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ["script", "export"])
+def test_export_parameter_only(unet_checkpoint_path, method):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    export_path = checkpoint_path.with_suffix(".pt2")
+    export_checkpoint(checkpoint_path, export_path, method=method, parameter_only=True)
+    model, _, _ = load_exported_model(export_path)
+    with torch.no_grad():
+        assert model(torch.zeros(4, 2)).shape == (4, 1, 16, 16)
+
+    engine = SurrogateInferenceEngine.from_checkpoint(export_path, device="cpu")
+    np.testing.assert_allclose(engine.predict(np.arange(6).reshape(3, 2)), expected_images, rtol=1e-5, atol=1e-6)
+
+
+def test_cache_image_features(unet_checkpoint_path):
+    checkpoint_path, expected_images = unet_checkpoint_path
+    param_vals = np.arange(6).reshape(3, 2)
+    engine = SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu")
+    assert engine._parameter_only_model is not None
+    np.testing.assert_allclose(engine.predict(param_vals), expected_images, rtol=1e-5, atol=1e-6)
+
+    engine = SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu", cache_image_features=False)
+    assert engine._parameter_only_model is None
+    np.testing.assert_allclose(engine.predict(param_vals), expected_images, rtol=1e-5, atol=1e-6)
+
+    engine = SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu", channels_last=True)
+    assert engine.model.upconv512.weight.is_contiguous(memory_format=torch.channels_last)
+    np.testing.assert_allclose(engine.predict(param_vals), expected_images, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ["script", "export"])
+def test_export_n02_model(tmp_path, method):
+    model = build_beamline_model(3).eval()
+    # the model is a module-level class, so it can be pickled
+    model = pickle.loads(pickle.dumps(model))
+    save_checkpoint(tmp_path / "n02.pt", model, "n02", {"parameter_count": 3}, np.ones((128, 128)))
+    export_checkpoint(tmp_path / "n02.pt", tmp_path / "n02.pt2", method=method)
+
+    param_vals = np.random.default_rng(0).normal(size=(2, 3))
+    with torch.no_grad():
+        expected_images = model(torch.ones(2, 1, 128, 128), torch.as_tensor(param_vals, dtype=torch.float32))
+    engine = SurrogateInferenceEngine.from_checkpoint(tmp_path / "n02.pt2", device="cpu")
+    np.testing.assert_allclose(engine.predict(param_vals), expected_images[:, 0].numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_counts_from_many_threads(unet_checkpoint_path):
+    checkpoint_path, _ = unet_checkpoint_path
+    with SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu", max_batch_size=1) as engine:
+        param_vals = np.zeros((2, 2))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(engine.predict, param_vals) for _ in range(4)]
+            futures += [engine.submit(param_vals) for _ in range(4)]
+            for future in futures:
+                future.result(timeout=30)
+        assert engine.prediction_count == 16
+        # max_batch_size=1, so one batch for each parameter vector
+        assert engine.batch_count == 16
+
+
+def test_close_while_submitting(unet_checkpoint_path):
+    checkpoint_path, _ = unet_checkpoint_path
+    engine = SurrogateInferenceEngine.from_checkpoint(checkpoint_path, device="cpu")
+    engine.predict(np.zeros(2))
+    closing_threads = []
+
+    class ClosingQueue(queue.Queue):
+        def put(self, item, *args, **kwargs):
+            if item is not None and not closing_threads:
+                # close the engine between submit's check that it is open and the put
+                closing_threads.append(threading.Thread(target=engine.close))
+                closing_threads[0].start()
+                time.sleep(0.1)
+            super().put(item, *args, **kwargs)
+
+    engine._requests = ClosingQueue()
+    future = engine.submit(np.zeros(2))
+    closing_threads[0].join(timeout=30)
+    # the request was queued before the stop marker, so it is predicted
+    assert future.result(timeout=30).shape == (16, 16)
+    with pytest.raises(RuntimeError):
+        engine.submit(np.zeros(2))
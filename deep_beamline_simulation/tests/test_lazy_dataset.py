@@ -0,0 +1,183 @@
+import pickle
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from torch.utils.data import DataLoader
+
+from deep_beamline_simulation.lazy_dataset import (
+    BlockShuffleBatchSampler,
+    LazyH5Array,
+    LazyIntensityImageDataset,
+    build_lazy_dataloader,
+    contiguous_runs,
+)
+from deep_beamline_simulation.u_net import build_dataloaders
+
+
+def write_preprocessed_results(preprocessed_results_path, image_count=20, chunks=None, compression=None):
+    rng = np.random.default_rng(0)
+    beam_intensities = rng.normal(size=(image_count, 8, 8)).astype(np.float32)
+    param_vals = rng.normal(size=(image_count, 2)).astype(np.float32)
+    with h5py.File(preprocessed_results_path, mode="w") as preprocessed_results:
+        preprocessed_results.create_dataset(
+            "preprocessed_initial_beam_intensity", data=rng.normal(size=(8, 8)), dtype=np.float32
+        )
+        preprocessed_results.create_dataset("params", data=np.array([b"a", b"b"]))
+        preprocessed_results.create_dataset("preprocessed_param_vals", data=param_vals)
+        preprocessed_results.create_dataset(
+            "preprocessed_beam_intensities", data=beam_intensities, chunks=chunks, compression=compression
+        )
+    return beam_intensities, param_vals
+
+
+@pytest.mark.parametrize("chunks,compression", [(None, None), ((1, 8, 8), "gzip")])
+def test_lazy_h5_array(tmp_path, chunks, compression):
+    beam_intensities, _ = write_preprocessed_results(tmp_path / "p.h5", chunks=chunks, compression=compression)
+
+    lazy_array = LazyH5Array(tmp_path / "p.h5", "preprocessed_beam_intensities", block_size=3, cache_blocks=2)
+    assert len(lazy_array) == 20
+    assert lazy_array.shape == (20, 8, 8)
+    np.testing.assert_array_equal(lazy_array[4], beam_intensities[4])
+    np.testing.assert_array_equal(lazy_array[-1], beam_intensities[-1])
+    np.testing.assert_array_equal(lazy_array[5:9], beam_intensities[5:9])
+    # only contiguous, uncompressed datasets are memory-mapped
+    assert lazy_array.memory_mapped == (chunks is None)
+
+    # blocks 1 and 6 are cached, reading block 0 evicts the least recently used block
+    lazy_array[19]
+    lazy_array[4]
+    assert list(lazy_array._block_cache) == [6, 1]
+    lazy_array[0]
+    assert list(lazy_array._block_cache) == [1, 0]
+
+    # read_rows takes the rows from cached blocks, reading block 2 evicts block 1
+    np.testing.assert_array_equal(lazy_array.read_rows([7, 1, 2, 6]), beam_intensities[[7, 1, 2, 6]])
+    assert list(lazy_array._block_cache) == [0, 2]
+
+    with pytest.raises(IndexError):
+        lazy_array[20]
+
+    # a copy in another process opens the file again
+    unpickled_lazy_array = pickle.loads(pickle.dumps(lazy_array))
+    assert unpickled_lazy_array._array is None
+    np.testing.assert_array_equal(unpickled_lazy_array[7], beam_intensities[7])
+    lazy_array.close()
+
+
+def test_lazy_intensity_image_dataset(tmp_path):
+    beam_intensities, param_vals = write_preprocessed_results(tmp_path / "p.h5")
+    dataset = LazyIntensityImageDataset(tmp_path / "p.h5", indices=np.arange(5, 15), cache_blocks=1, block_size=4)
+    assert len(dataset) == 10
+
+    image, initial_image, image_param_vals = dataset[2]
+    np.testing.assert_array_equal(image, beam_intensities[7][None])
+    assert initial_image.shape == (1, 8, 8)
+    np.testing.assert_array_equal(image_param_vals, param_vals[7])
+
+    # DataLoader worker processes read the file themselves
+    batches = list(DataLoader(dataset, batch_size=4, shuffle=False, num_workers=2))
+    images = torch.cat([batch_images for batch_images, _, _ in batches])
+    np.testing.assert_array_equal(images.numpy(), beam_intensities[5:15, None])
+
+
+def test_build_lazy_dataloaders(tmp_path):
+    write_preprocessed_results(tmp_path / "p.h5", image_count=21)
+    for dataset_type in ("array", "lazy"):
+        training_dataloader, testing_dataloader = build_dataloaders(
+            tmp_path / "p.h5", batch_size=5, dataset_type=dataset_type
+        )
+        assert len(training_dataloader.dataset) == 14
+        assert len(testing_dataloader.dataset) == 7
+        correct_images, images, input_params = next(iter(training_dataloader))
+        assert correct_images.shape == (5, 1, 8, 8)
+        assert images.shape == (5, 1, 8, 8)
+        assert input_params.shape == (5, 2)
+        assert input_params.dtype == torch.float32
+
+    with pytest.raises(ValueError):
+        build_dataloaders(tmp_path / "p.h5", batch_size=5, dataset_type="sparse")
+    with pytest.raises(ValueError):
+        build_dataloaders(tmp_path / "p.h5", batch_size=5, dataset_type="array", sampler="block")
+
+    training_dataloader, _ = build_dataloaders(
+        tmp_path / "p.h5", batch_size=5, dataset_type="lazy", sampler="block"
+    )
+    assert sum(len(batch_images) for batch_images, _, _ in training_dataloader) == 14
+
+
+def test_contiguous_runs():
+    assert contiguous_runs([]) == []
+    assert contiguous_runs([3]) == [(3, 4)]
+    assert contiguous_runs([0, 1, 2, 5, 6, 9]) == [(0, 3), (5, 7), (9, 10)]
+
+
+def test_block_shuffle_batch_sampler():
+    batch_sampler = BlockShuffleBatchSampler(23, batch_size=4, block_size=8, seed=1)
+    assert len(batch_sampler) == 6
+    batches = list(batch_sampler)
+    assert sorted(len(batch) for batch in batches) == [3, 4, 4, 4, 4, 4]
+    # every index once
+    assert sorted(index for batch in batches for index in batch) == list(range(23))
+    # each batch comes from at most two blocks
+    for batch in batches:
+        assert len({index // 8 for index in batch}) <= 2
+    # the order changes from epoch to epoch
+    assert list(batch_sampler) != batches
+
+    assert len(list(BlockShuffleBatchSampler(23, batch_size=4, drop_last=True))) == 5
+
+
+def test_read_batch(tmp_path, monkeypatch):
+    beam_intensities, param_vals = write_preprocessed_results(tmp_path / "p.h5", chunks=(1, 8, 8))
+    dataset = LazyIntensityImageDataset(tmp_path / "p.h5", indices=np.arange(2, 20))
+
+    batch_indices = [7, 3, 4, 5, 12, 4]
+    images, initial_images, batch_param_vals = dataset[batch_indices]
+    image_indices = np.array(batch_indices) + 2
+    np.testing.assert_array_equal(images.numpy(), beam_intensities[image_indices, None])
+    np.testing.assert_array_equal(batch_param_vals.numpy(), param_vals[image_indices])
+    assert initial_images.shape == (6, 1, 8, 8)
+
+    # one read for each run of consecutive images: 5 to 7, 9, and 14
+    dataset.beam_intensities._open()
+    slice_reads = []
+    h5_dataset = dataset.beam_intensities._array
+
+    class CountingDataset:
+        def __getitem__(self, index):
+            slice_reads.append(index)
+            return h5_dataset[index]
+
+    monkeypatch.setattr(dataset.beam_intensities, "_array", CountingDataset())
+    dataset[batch_indices]
+    assert slice_reads == [slice(5, 8), slice(9, 10), slice(14, 15)]
+
+    samples = dataset.__getitems__([0, 1])
+    assert len(samples) == 2
+    np.testing.assert_array_equal(samples[1][0].numpy(), beam_intensities[3][None])
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_block_dataloader(tmp_path, num_workers):
+    beam_intensities, param_vals = write_preprocessed_results(tmp_path / "p.h5")
+    dataset = LazyIntensityImageDataset(tmp_path / "p.h5")
+
+    dataloader = build_lazy_dataloader(
+        dataset, batch_size=6, sampler="block", block_size=4, num_workers=num_workers
+    )
+    batches = list(dataloader)
+    assert [len(batch_images) for batch_images, _, _ in batches] == [6, 6, 6, 2]
+    images = torch.cat([batch_images for batch_images, _, _ in batches])
+    all_param_vals = torch.cat([batch_param_vals for _, _, batch_param_vals in batches])
+    order = np.argsort(all_param_vals[:, 0].numpy())
+    np.testing.assert_array_equal(images.numpy()[order], beam_intensities[np.argsort(param_vals[:, 0]), None])
+
+    # the default sampler reads each batch with read_batch too, and does not collate it again
+    correct_images, images, input_params = next(iter(build_lazy_dataloader(dataset, batch_size=6, seed=0)))
+    assert correct_images.shape == (6, 1, 8, 8)
+    assert images.shape == (6, 1, 8, 8)
+    # the initial images are still a view of one image
+    assert images.stride(0) == 0
@@ -0,0 +1,130 @@
+import asyncio
+import time as ttime
+
+from deep_beamline_simulation import AsyncSirepoGuestSession, SirepoGuestSession
+from deep_beamline_simulation.metadata_cache import SirepoMetadataCache
+
+APERTURE_FOLDER = "/Wavefront Propagation"
+APERTURE_NAME = "Diffraction by an Aperture"
+
+
+def test_metadata_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ttime, "monotonic", lambda: now[0])
+
+    metadata_cache = SirepoMetadataCache(ttl_seconds=10.0)
+    metadata_cache.put(("simulation-list", "url", "srw"), ["a"], etag='"1"')
+    assert metadata_cache.get(("simulation-list", "url", "srw")) == (["a"], '"1"', True)
+
+    now[0] += 10.0
+    assert metadata_cache.get(("simulation-list", "url", "srw")) == (["a"], '"1"', False)
+
+    metadata_cache.revalidate(("simulation-list", "url", "srw"))
+    assert metadata_cache.get(("simulation-list", "url", "srw")) == (["a"], '"1"', True)
+
+
+def test_metadata_cache_invalidate():
+    metadata_cache = SirepoMetadataCache()
+    metadata_cache.put(SirepoMetadataCache.simulation_data_key("url1", "srw", "a"), {})
+    metadata_cache.put(SirepoMetadataCache.simulation_data_key("url1", "srw", "b"), {})
+    metadata_cache.put(SirepoMetadataCache.simulation_data_key("url2", "srw", "a"), {})
+    metadata_cache.put(SirepoMetadataCache.simulation_list_key("url1", "srw"), [])
+
+    metadata_cache.invalidate_prefix("simulation", "url1", "srw")
+    assert len(metadata_cache) == 2
+    assert metadata_cache.get(SirepoMetadataCache.simulation_list_key("url1", "srw")) is not None
+
+    metadata_cache.invalidate_server("url1")
+    assert len(metadata_cache) == 1
+
+    metadata_cache.invalidate()
+    assert len(metadata_cache) == 0
+
+
+def test_shared_metadata_cache_fake_sirepo(fake_sirepo_server):
+    metadata_cache = SirepoMetadataCache()
+    with SirepoGuestSession(fake_sirepo_server.url, "srw", metadata_cache=metadata_cache) as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        simulation_id = simulation_table[APERTURE_FOLDER][APERTURE_NAME]
+        simulation_data = sirepo_session.simulation_data(simulation_id)
+
+    request_counts = dict(fake_sirepo_server.request_counts)
+    assert request_counts == {"simulation-list": 1, "auth-guest-login": 1, "simulation": 1}
+
+    # a second session logs in as the same guest user without asking the server
+    with SirepoGuestSession(fake_sirepo_server.url, "srw", metadata_cache=metadata_cache) as sirepo_session:
+        assert sirepo_session.simulation_list() == simulation_table
+        cached_simulation_data = sirepo_session.simulation_data(simulation_id)
+        assert cached_simulation_data == simulation_data
+        # callers may change the simulation data they are given
+        cached_simulation_data["models"]["beamline"][0]["horizontalSize"] = 2
+        assert sirepo_session.simulation_data(simulation_id) == simulation_data
+        assert sirepo_session._session.cookies.get("sirepo_dev") == "fake-guest-cookie"
+
+    assert dict(fake_sirepo_server.request_counts) == request_counts
+
+
+def test_metadata_cache_revalidation_fake_sirepo(fake_sirepo_server):
+    metadata_cache = SirepoMetadataCache(ttl_seconds=0.0)
+    with SirepoGuestSession(fake_sirepo_server.url, "srw", metadata_cache=metadata_cache) as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        assert fake_sirepo_server.request_counts["not-modified"] == 1
+
+        # the simulation list has not changed so the stale entry is revalidated
+        assert sirepo_session.simulation_list() == simulation_table
+        assert fake_sirepo_server.request_counts["simulation-list"] == 3
+        assert fake_sirepo_server.request_counts["not-modified"] == 2
+
+        # a new simulation changes the simulation list
+        sirepo_session.copy_simulation(
+            simulation_table[APERTURE_FOLDER][APERTURE_NAME], name="copy", folder="/copies"
+        )
+        assert sirepo_session.simulation_list()["/copies"].keys() == {"copy"}
+        assert fake_sirepo_server.request_counts["not-modified"] == 2
+
+
+def test_metadata_cache_invalidation_fake_sirepo(fake_sirepo_server):
+    with SirepoGuestSession(fake_sirepo_server.url, "srw") as sirepo_session:
+        simulation_id = sirepo_session.simulation_list()[APERTURE_FOLDER][APERTURE_NAME]
+
+        copy_simulation_data = sirepo_session.copy_simulation(simulation_id, name="copy", folder="/copies")
+        copy_simulation_id = copy_simulation_data["models"]["simulation"]["simulationId"]
+        assert sirepo_session.simulation_list()["/copies"] == {"copy": copy_simulation_id}
+        sirepo_session.simulation_data(copy_simulation_id)
+
+        sirepo_session.delete_simulation(copy_simulation_id)
+        assert "/copies" not in sirepo_session.simulation_list()
+        assert (
+            sirepo_session.metadata_cache.get(
+                SirepoMetadataCache.simulation_data_key(fake_sirepo_server.url, "srw", copy_simulation_id)
+            )
+            is None
+        )
+
+        simulation_list_count = fake_sirepo_server.request_counts["simulation-list"]
+        sirepo_session.simulation_list(refresh=True)
+        assert fake_sirepo_server.request_counts["simulation-list"] == simulation_list_count + 1
+
+
+def test_async_shared_metadata_cache_fake_sirepo(fake_sirepo_server):
+    metadata_cache = SirepoMetadataCache()
+
+    async def simulation_metadata():
+        async with AsyncSirepoGuestSession(
+            fake_sirepo_server.url, "srw", metadata_cache=metadata_cache
+        ) as sirepo_session:
+            simulation_table = await sirepo_session.simulation_list()
+            simulation_id = simulation_table[APERTURE_FOLDER][APERTURE_NAME]
+            return simulation_table, await sirepo_session.simulation_data(simulation_id)
+
+    simulation_table, simulation_data = asyncio.run(simulation_metadata())
+    request_counts = dict(fake_sirepo_server.request_counts)
+    assert request_counts == {"simulation-list": 1, "auth-guest-login": 1, "simulation": 1}
+
+    assert asyncio.run(simulation_metadata()) == (simulation_table, simulation_data)
+    assert dict(fake_sirepo_server.request_counts) == request_counts
+
+    # the sync and async sessions share the guest login
+    with SirepoGuestSession(fake_sirepo_server.url, "srw", metadata_cache=metadata_cache) as sirepo_session:
+        assert sirepo_session.simulation_list() == simulation_table
+    assert dict(fake_sirepo_server.request_counts) == request_counts
@@ -64,3 +64,39 @@ def test_predictions():
         optimizer.step()
 
     assert predictions.size != 0
+
+
+def test_unet_encoder_modes():
+    """
+    "skip" predicts what "legacy" predicts, from a "legacy" state_dict,
+    and "fuse" predictions depend on the input image
+    """
+    torch.manual_seed(0)
+    legacy_model = UNet(16, 16, 2).eval()
+    skip_model = UNet(16, 16, 2, encoder_mode="skip").eval()
+    skip_model.load_state_dict(legacy_model.state_dict())
+    assert not hasattr(skip_model, "conv_inx64")
+    assert not hasattr(skip_model, "conv1024")
+    assert sum(p.numel() for p in skip_model.parameters()) < sum(p.numel() for p in legacy_model.parameters()) / 2
+
+    images = torch.rand(3, 1, 16, 16)
+    parameters = torch.rand(3, 2)
+    with torch.no_grad():
+        torch.testing.assert_close(skip_model(images, parameters), legacy_model(images, parameters))
+        # the scripted model leaves the encoder out too
+        scripted_model = torch.jit.script(skip_model)
+        torch.testing.assert_close(scripted_model(images, parameters), legacy_model(images, parameters))
+
+    fuse_model = UNet(16, 16, 2, encoder_mode="fuse").eval()
+    # the encoder and decoder weights load from "legacy", the fuse layer does not
+    with pytest.raises(RuntimeError):
+        fuse_model.load_state_dict(legacy_model.state_dict())
+    fuse_model.load_state_dict(legacy_model.state_dict(), strict=False)
+    with torch.no_grad():
+        fused_predictions = fuse_model(images, parameters)
+        assert fused_predictions.shape == (3, 1, 16, 16)
+        assert not torch.allclose(fuse_model(torch.rand(3, 1, 16, 16), parameters), fused_predictions)
+        torch.testing.assert_close(torch.jit.script(fuse_model)(images, parameters), fused_predictions)
+
+    with pytest.raises(ValueError):
+        UNet(16, 16, 2, encoder_mode="none")
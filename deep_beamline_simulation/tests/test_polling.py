@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from deep_beamline_simulation import (
+    AsyncSirepoGuestSession,
+    DeadlinePolling,
+    ExponentialBackoffPolling,
+    FixedPolling,
+    ServerHintedPolling,
+    SirepoGuestSession,
+    SirepoSimulationError,
+    SirepoSimulationTimeout,
+)
+
+
+def test_fixed_polling():
+    polling_strategy = FixedPolling(interval_seconds=0.5)
+    assert polling_strategy.next_delay(0, 0.0, 2) == 0.5
+    assert polling_strategy.next_delay(10, 100.0, 2) == 0.5
+
+
+def test_server_hinted_polling():
+    polling_strategy = ServerHintedPolling()
+    assert polling_strategy.next_delay(0, 0.0, 2) == 2
+    assert polling_strategy.next_delay(10, 100.0, 3) == 3
+
+
+def test_exponential_backoff_polling():
+    polling_strategy = ExponentialBackoffPolling(
+        initial_seconds=0.01, factor=2.0, max_seconds=1.0, use_server_hint=False
+    )
+    delays = [polling_strategy.next_delay(i, 0.0, 0.5) for i in range(10)]
+    assert delays[:4] == [0.01, 0.02, 0.04, 0.08]
+    assert delays[-1] == 1.0
+
+    # the server hint caps the delay
+    polling_strategy.use_server_hint = True
+    assert polling_strategy.next_delay(9, 0.0, 0.5) == 0.5
+
+
+def test_deadline_polling():
+    polling_strategy = DeadlinePolling(timeout_seconds=10.0, polling_strategy=FixedPolling(3.0))
+    assert polling_strategy.next_delay(0, 0.0, 1) == 3.0
+    # never wait past the deadline
+    assert polling_strategy.next_delay(3, 9.0, 1) == pytest.approx(1.0)
+    assert polling_strategy.next_delay(4, 10.0, 1) is None
+
+
+def _run_aperture_simulation(sirepo_session, **wait_for_simulation_kwargs):
+    aperture_simulation_data = sirepo_session.simulation_data("zFJ9LE0c")
+    run_simulation_response = sirepo_session.run_simulation(
+        simulation_id="zFJ9LE0c",
+        simulation_data=aperture_simulation_data,
+        simulation_report="watchpointReport5",
+    )
+    return sirepo_session.wait_for_simulation(run_simulation_response, **wait_for_simulation_kwargs)
+
+
+def test_short_simulation_detected_quickly(fake_sirepo_server):
+    # Sirepo suggests waiting much longer than the simulation runs
+    fake_sirepo_server.run_seconds = 0.05
+    fake_sirepo_server.next_request_seconds = 2
+
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+    ) as sirepo_session:
+        run_status_response = _run_aperture_simulation(sirepo_session)
+
+    simulation_stats = run_status_response.simulation_stats
+    assert run_status_response.json()["state"] == "completed"
+    assert simulation_stats.elapsed_seconds < 0.5
+    assert simulation_stats.status_call_count == len(simulation_stats.status_call_seconds)
+    assert simulation_stats.status_call_count == fake_sirepo_server.request_counts["run-status"]
+
+
+def test_simulation_error(fake_sirepo_server):
+    fake_sirepo_server.fail = True
+
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+    ) as sirepo_session:
+        with pytest.raises(SirepoSimulationError):
+            _run_aperture_simulation(sirepo_session)
+
+
+def test_simulation_timeout(fake_sirepo_server):
+    fake_sirepo_server.run_seconds = 10
+
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+    ) as sirepo_session:
+        with pytest.raises(SirepoSimulationTimeout):
+            _run_aperture_simulation(sirepo_session, polling_strategy=DeadlinePolling(timeout_seconds=0.2))
+
+        with pytest.raises(SirepoSimulationTimeout):
+            _run_aperture_simulation(sirepo_session, max_status_calls=3)
+
+
+def test_async_simulation_stats(fake_sirepo_server):
+    async def run_simulation():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url,
+            simulation_type="srw",
+            polling_strategy=FixedPolling(interval_seconds=0.01),
+        ) as sirepo_session:
+            aperture_simulation_data = await sirepo_session.simulation_data("zFJ9LE0c")
+            run_simulation_json = await sirepo_session.run_simulation(
+                simulation_id="zFJ9LE0c",
+                simulation_data=aperture_simulation_data,
+                simulation_report="watchpointReport5",
+            )
+            return await sirepo_session.wait_for_simulation(run_simulation_json)
+
+    run_status = asyncio.run(run_simulation())
+    assert run_status["state"] == "completed"
+    assert run_status.simulation_stats.status_call_count >= 1
+    assert run_status.simulation_stats.sleep_seconds == pytest.approx(
+        0.01 * run_status.simulation_stats.status_call_count
+    )
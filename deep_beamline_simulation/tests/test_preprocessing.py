@@ -0,0 +1,179 @@
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from deep_beamline_simulation.preprocessing import (
+    PreprocessingConfig,
+    RunningStatistics,
+    preprocess_beam_intensities,
+    preprocess_initial_beam_intensity,
+    resize_images,
+)
+
+
+def write_results(results_path, image_count=11, blank_image_indices=(2, 7), chunks=None):
+    rng = np.random.default_rng(0)
+    beam_intensities = rng.uniform(0.0, 1e12, size=(image_count, 30, 40))
+    for image_i in blank_image_indices:
+        beam_intensities[image_i] = 0.0
+    with h5py.File(results_path, mode="w") as results:
+        results.create_dataset("params", data=np.array([b"Aperture_horizontalSize", b"Aperture_verticalSize"]))
+        results.create_dataset("paramVals", data=rng.uniform(0.5, 2.0, size=(image_count, 2)))
+        results.create_dataset("beamIntensities", data=beam_intensities, chunks=chunks)
+    return beam_intensities
+
+
+def test_running_statistics():
+    values = np.random.default_rng(1).normal(1e3, 5.0, size=(17, 9))
+    running_statistics = RunningStatistics()
+    for chunk in np.array_split(values, 5):
+        running_statistics.update(chunk)
+    running_statistics.update(np.empty((0, 9)))
+
+    assert running_statistics.count == values.size
+    assert running_statistics.mean == pytest.approx(np.mean(values), rel=1e-12)
+    assert running_statistics.std == pytest.approx(np.std(values), rel=1e-12)
+
+    merged_statistics = RunningStatistics.from_values(values[:4]).merge(RunningStatistics.from_values(values[4:]))
+    assert merged_statistics.std == pytest.approx(np.std(values), rel=1e-12)
+    assert np.isnan(RunningStatistics().std)
+
+
+@pytest.mark.parametrize("chunk_size,chunks", [(3, None), (64, None), (4, (2, 30, 40))])
+def test_preprocess_beam_intensities(tmp_path, chunk_size, chunks):
+    beam_intensities = write_results(tmp_path / "results.h5", chunks=chunks)
+    initial_beam_intensity = np.random.default_rng(2).uniform(0.0, 1.0, size=(50, 60))
+
+    preprocessing_result = preprocess_beam_intensities(
+        tmp_path / "results.h5",
+        tmp_path / "preprocessed_results.h5",
+        initial_beam_intensity=initial_beam_intensity,
+        config=PreprocessingConfig(crop_box=(5, 25, 10, 30), image_size=(16, 12)),
+        chunk_size=chunk_size,
+    )
+    assert preprocessing_result.parameter_count == 2
+    assert preprocessing_result.image_count == 11
+    assert preprocessing_result.rejected_image_indices.tolist() == [2, 7]
+
+    # the same steps on the whole dataset at once
+    log_cropped_beam_intensities = np.log(beam_intensities[:, 5:25, 10:30] + 1e-10)
+    normalized_log_cropped_beam_intensities = (
+        log_cropped_beam_intensities - np.mean(log_cropped_beam_intensities)
+    ) / np.std(log_cropped_beam_intensities)
+    good_image_indices = preprocessing_result.good_image_indices
+    expected_images = resize_images(normalized_log_cropped_beam_intensities[good_image_indices], (16, 12))
+
+    with h5py.File(tmp_path / "preprocessed_results.h5", mode="r") as preprocessed_results:
+        preprocessed_beam_intensities = preprocessed_results["preprocessed_beam_intensities"][()]
+        assert preprocessed_beam_intensities.shape == (9, 16, 12)
+        np.testing.assert_allclose(preprocessed_beam_intensities, expected_images, rtol=1e-5, atol=1e-5)
+
+        assert preprocessed_results["preprocessed_param_vals"].shape == (9, 2)
+        assert preprocessed_results["params"][()].tolist() == [
+            b"Aperture_horizontalSize",
+            b"Aperture_verticalSize",
+        ]
+        np.testing.assert_allclose(
+            preprocessed_results["preprocessed_initial_beam_intensity"][()],
+            preprocess_initial_beam_intensity(initial_beam_intensity, (16, 12)),
+            rtol=1e-6,
+        )
+        assert json.loads(preprocessed_results.attrs["preprocessing_config"])["crop_box"] == [5, 25, 10, 30]
+
+    # diagnostics are computed only on request
+    assert preprocessing_result.diagnostics is None
+
+
+def test_preprocessing_config():
+    config = PreprocessingConfig.centered_crop((30, 60), normalization="per_image", image_size=(8, 8))
+    assert config.crop_box == (10, 20, 20, 40)
+    assert PreprocessingConfig.from_dict(json.loads(json.dumps(config.to_dict()))) == config
+    assert config != PreprocessingConfig()
+
+    with pytest.raises(ValueError):
+        PreprocessingConfig(normalization="median")
+    with pytest.raises(ValueError):
+        PreprocessingConfig(crop_box=(0, 10))
+
+
+@pytest.mark.parametrize("normalization", ["global", "per_image", "none"])
+def test_preprocessing_diagnostics(tmp_path, normalization):
+    beam_intensities = write_results(tmp_path / "results.h5")
+    config = PreprocessingConfig(crop_box=(None, None, None, None), normalization=normalization, image_size=(8, 8))
+
+    preprocessing_result = preprocess_beam_intensities(
+        tmp_path / "results.h5",
+        tmp_path / "preprocessed_results.h5",
+        config=config,
+        chunk_size=4,
+        diagnostics=True,
+    )
+    assert preprocessing_result.rejected_image_indices.tolist() == [2, 7]
+
+    log_beam_intensities = np.log(beam_intensities + 1e-10)
+    good_log_beam_intensities = log_beam_intensities[preprocessing_result.good_image_indices]
+    if normalization == "global":
+        normalized_images = (
+            good_log_beam_intensities - np.mean(log_beam_intensities)
+        ) / np.std(log_beam_intensities)
+    elif normalization == "per_image":
+        normalized_images = (
+            good_log_beam_intensities - np.mean(good_log_beam_intensities, axis=(1, 2), keepdims=True)
+        ) / np.std(good_log_beam_intensities, axis=(1, 2), keepdims=True)
+    else:
+        normalized_images = good_log_beam_intensities
+
+    diagnostics = preprocessing_result.diagnostics
+    assert diagnostics.log_intensity_statistics.mean == pytest.approx(np.mean(log_beam_intensities))
+    assert diagnostics.log_intensity_range == (np.min(log_beam_intensities), np.max(log_beam_intensities))
+    # every written intensity falls in the histogram
+    assert diagnostics.histogram_counts.sum() == normalized_images.size
+    assert diagnostics.histogram_bin_edges[0] == pytest.approx(np.min(normalized_images))
+    assert diagnostics.histogram_bin_edges[-1] == pytest.approx(np.max(normalized_images))
+    assert diagnostics.to_dict()["log_intensity_count"] == log_beam_intensities.size
+
+    with h5py.File(tmp_path / "preprocessed_results.h5", mode="r") as preprocessed_results:
+        np.testing.assert_allclose(
+            preprocessed_results["preprocessed_beam_intensities"][()],
+            resize_images(normalized_images, (8, 8)),
+            rtol=1e-5,
+            atol=1e-5,
+        )
+
+
+@pytest.mark.parametrize("normalization", ["global", "per_image"])
+def test_parallel_preprocessing(tmp_path, normalization):
+    write_results(tmp_path / "results.h5", image_count=23, blank_image_indices=(0, 5, 6, 22), chunks=(1, 30, 40))
+    initial_beam_intensity = np.random.default_rng(2).uniform(0.0, 1.0, size=(50, 60))
+    config = PreprocessingConfig(crop_box=(5, 25, 10, 30), normalization=normalization, image_size=(16, 12))
+
+    preprocessing_results = {}
+    for workers in (1, 3):
+        preprocessing_results[workers] = preprocess_beam_intensities(
+            tmp_path / "results.h5",
+            tmp_path / f"preprocessed_results_{workers}.h5",
+            initial_beam_intensity=initial_beam_intensity,
+            config=config,
+            chunk_size=2,
+            diagnostics=True,
+            workers=workers,
+        )
+
+    serial_result, parallel_result = preprocessing_results[1], preprocessing_results[3]
+    assert parallel_result.rejected_image_indices.tolist() == [0, 5, 6, 22]
+    assert parallel_result.log_intensity_statistics.mean == serial_result.log_intensity_statistics.mean
+    assert parallel_result.log_intensity_statistics.m2 == serial_result.log_intensity_statistics.m2
+    np.testing.assert_array_equal(
+        parallel_result.diagnostics.histogram_counts, serial_result.diagnostics.histogram_counts
+    )
+
+    # the preprocessed files are bit-identical
+    with h5py.File(tmp_path / "preprocessed_results_1.h5", mode="r") as serial_results, h5py.File(
+        tmp_path / "preprocessed_results_3.h5", mode="r"
+    ) as parallel_results:
+        assert set(parallel_results.keys()) == set(serial_results.keys())
+        for dataset_name in serial_results:
+            np.testing.assert_array_equal(parallel_results[dataset_name][()], serial_results[dataset_name][()])
+        assert dict(parallel_results.attrs) == dict(serial_results.attrs)
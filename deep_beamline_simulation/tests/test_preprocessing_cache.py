@@ -0,0 +1,87 @@
+import os
+
+import h5py
+import numpy as np
+
+from deep_beamline_simulation.preprocessing import PreprocessingConfig
+from deep_beamline_simulation.preprocessing_cache import PreprocessingCache
+from deep_beamline_simulation.tests.test_preprocessing import write_results
+
+
+def test_preprocessing_cache(tmp_path, monkeypatch):
+    results_path = tmp_path / "results.h5"
+    write_results(results_path)
+    initial_beam_intensity = np.random.default_rng(2).uniform(0.0, 1.0, size=(50, 60))
+    config = PreprocessingConfig(crop_box=(5, 25, 10, 30), image_size=(16, 12))
+    preprocessing_cache = PreprocessingCache(cache_directory=tmp_path / "cache")
+
+    preprocessing_result = preprocessing_cache.preprocess(
+        results_path, initial_beam_intensity=initial_beam_intensity, config=config
+    )
+    assert preprocessing_result.preprocessed_results_path.parent == tmp_path / "cache"
+    with h5py.File(preprocessing_result.preprocessed_results_path, mode="r") as preprocessed_results:
+        preprocessed_beam_intensities = preprocessed_results["preprocessed_beam_intensities"][()]
+        assert preprocessed_beam_intensities.shape == (9, 16, 12)
+
+    # the same input is not preprocessed or even read again
+    def fail(*args, **kwargs):
+        raise AssertionError("preprocessed again")
+
+    monkeypatch.setattr("deep_beamline_simulation.preprocessing_cache.preprocess_beam_intensities", fail)
+    monkeypatch.setattr("deep_beamline_simulation.preprocessing_cache.file_digest", fail)
+    cached_result = preprocessing_cache.preprocess(
+        results_path, initial_beam_intensity=initial_beam_intensity, config=config
+    )
+    assert cached_result.preprocessed_results_path == preprocessing_result.preprocessed_results_path
+    assert cached_result.rejected_image_indices.tolist() == [2, 7]
+    assert cached_result.log_intensity_statistics.std == preprocessing_result.log_intensity_statistics.std
+    assert cached_result.config == config
+    monkeypatch.undo()
+
+    # a different config, initial intensity, or results.h5 is a different entry
+    key = preprocessing_cache.key(results_path, config, initial_beam_intensity)
+    assert preprocessing_cache.key(results_path, PreprocessingConfig(), initial_beam_intensity) != key
+    assert preprocessing_cache.key(results_path, config, initial_beam_intensity * 2) != key
+    with h5py.File(results_path, mode="a") as results:
+        results["beamIntensities"][0, 0, 0] = 1.0
+    os.utime(results_path, ns=(0, 0))
+    assert preprocessing_cache.key(results_path, config, initial_beam_intensity) != key
+
+
+def test_preprocessing_cache_diagnostics(tmp_path):
+    write_results(tmp_path / "results.h5")
+    config = PreprocessingConfig(crop_box=(5, 25, 10, 30), image_size=(16, 12))
+    preprocessing_cache = PreprocessingCache(cache_directory=tmp_path / "cache")
+
+    preprocessing_cache.preprocess(tmp_path / "results.h5", config=config)
+    key = preprocessing_cache.key(tmp_path / "results.h5", config)
+    # the entry has no diagnostics
+    assert preprocessing_cache.get(key, diagnostics=True) is None
+
+    preprocessing_result = preprocessing_cache.preprocess(tmp_path / "results.h5", config=config, diagnostics=True)
+    cached_diagnostics = preprocessing_cache.get(key, diagnostics=True).diagnostics
+    np.testing.assert_array_equal(
+        cached_diagnostics.histogram_counts, preprocessing_result.diagnostics.histogram_counts
+    )
+    np.testing.assert_array_equal(cached_diagnostics.image_stds, preprocessing_result.diagnostics.image_stds)
+
+
+def test_preprocessing_cache_eviction(tmp_path):
+    write_results(tmp_path / "results.h5")
+    preprocessing_cache = PreprocessingCache(cache_directory=tmp_path / "cache")
+
+    configs = [PreprocessingConfig(crop_box=(5, 25, 10, 30), image_size=(size, size)) for size in (8, 9, 10)]
+    preprocessing_cache.preprocess(tmp_path / "results.h5", config=configs[0])
+    entry_size = preprocessing_cache.size_bytes
+
+    # room for about two entries
+    preprocessing_cache.max_size_bytes = int(2.5 * entry_size)
+    for config in configs[1:]:
+        preprocessing_cache.preprocess(tmp_path / "results.h5", config=config)
+
+    keys = [preprocessing_cache.key(tmp_path / "results.h5", config) for config in configs]
+    assert keys[0] not in preprocessing_cache
+    assert keys[1] in preprocessing_cache
+    assert keys[2] in preprocessing_cache
+    assert not (tmp_path / "cache" / f"{keys[0]}.h5").exists()
+    assert preprocessing_cache.size_bytes <= preprocessing_cache.max_size_bytes
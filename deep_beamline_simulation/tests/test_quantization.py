@@ -0,0 +1,91 @@
+import json
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from deep_beamline_simulation.conditioning import ParameterOnlySurrogate
+from deep_beamline_simulation.inference import SurrogateInferenceEngine, save_checkpoint
+from deep_beamline_simulation.network.n02 import build_beamline_model
+from deep_beamline_simulation.quantization import accuracy_report, main, quantize_checkpoint, quantize_model
+from deep_beamline_simulation.tests.test_lazy_dataset import write_preprocessed_results
+from deep_beamline_simulation.u_net import UNet
+
+
+@pytest.mark.parametrize(
+    "model,image_size",
+    [
+        (UNet(16, 16, 2, encoder_mode="fuse"), 16),
+        (build_beamline_model(2), 128),
+    ],
+)
+def test_quantize_model(model, image_size):
+    torch.manual_seed(0)
+    model.eval()
+    rng = np.random.default_rng(0)
+    initial_beam_intensity = rng.uniform(size=(image_size, image_size))
+    param_vals = rng.uniform(size=(20, 2))
+    state_dict = {key: value.clone() for key, value in model.state_dict().items()}
+
+    quantized_model = quantize_model(model, initial_beam_intensity, param_vals, batch_size=8)
+    module_types = {type(module) for module in quantized_model.modules()}
+    assert torch.ao.nn.quantized.Conv2d in module_types
+    assert torch.ao.nn.quantized.dynamic.Linear in module_types
+    assert torch.nn.Conv2d not in module_types
+    # the model is unchanged
+    for key, value in model.state_dict().items():
+        torch.testing.assert_close(value, state_dict[key])
+
+    report = accuracy_report(ParameterOnlySurrogate(model, initial_beam_intensity), quantized_model, param_vals)
+    assert report["image_count"] == 20
+    assert report["relative_difference"] < 0.05
+    assert report["quantized_model_bytes"] < report["float_model_bytes"]
+
+    dynamic_only_model = quantize_model(
+        model, initial_beam_intensity, param_vals, static_convolutions=False, channels_last=False
+    )
+    assert torch.ao.nn.quantized.Conv2d not in {type(module) for module in dynamic_only_model.modules()}
+
+
+def test_quantize_checkpoint(tmp_path):
+    write_preprocessed_results(tmp_path / "p.h5", image_count=30)
+    with h5py.File(tmp_path / "p.h5", mode="r") as preprocessed_results:
+        initial_beam_intensity = preprocessed_results["preprocessed_initial_beam_intensity"][()]
+    torch.manual_seed(0)
+    save_checkpoint(
+        tmp_path / "unet.pt",
+        UNet(8, 8, 2, encoder_mode="skip"),
+        "unet",
+        {"input_size": 8, "output_size": 8, "parameter_count": 2, "encoder_mode": "skip"},
+        initial_beam_intensity,
+        params=["a", "b"],
+    )
+
+    quantized_model, report = quantize_checkpoint(
+        tmp_path / "unet.pt", tmp_path / "p.h5", export_path=tmp_path / "unet_int8.pt", calibration_count=8
+    )
+    # on the last third of the images
+    assert report["image_count"] == 10
+    assert "quantized_mean_squared_error" in report
+
+    param_vals = np.random.default_rng(0).normal(size=(3, 2)).astype(np.float32)
+    with torch.no_grad():
+        expected_images = quantized_model(torch.from_numpy(param_vals))[:, 0].numpy()
+    engine = SurrogateInferenceEngine.from_checkpoint(tmp_path / "unet_int8.pt", device="cpu")
+    assert engine.params == ["a", "b"]
+    np.testing.assert_allclose(engine.predict(param_vals), expected_images, rtol=1e-5, atol=1e-6)
+
+    main(
+        [
+            str(tmp_path / "unet.pt"),
+            str(tmp_path / "p.h5"),
+            str(tmp_path / "unet_int8_cli.pt"),
+            "--calibration-count=8",
+            "--report",
+            str(tmp_path / "report.json"),
+        ]
+    )
+    with open(tmp_path / "report.json") as report_file:
+        assert json.load(report_file)["image_count"] == 10
+    assert (tmp_path / "unet_int8_cli.pt").exists()
@@ -0,0 +1,169 @@
+import copy
+import threading
+
+import pytest
+import requests
+
+from deep_beamline_simulation import (
+    SirepoGuestSession,
+    SirepoServerUnavailable,
+    SirepoSessionPool,
+    SirepoSimulationError,
+)
+from deep_beamline_simulation.tests.fake_sirepo import FakeSirepoServer
+
+
+@pytest.fixture
+def fake_sirepo_servers():
+    fake_sirepo_servers_ = [FakeSirepoServer().start() for _ in range(3)]
+    yield fake_sirepo_servers_
+    for fake_sirepo_server in fake_sirepo_servers_:
+        fake_sirepo_server.stop()
+
+
+def aperture_simulation_data_list(sirepo_server_url, horizontal_sizes):
+    with SirepoGuestSession(sirepo_server_url=sirepo_server_url, simulation_type="srw") as sirepo_session:
+        simulation_id = sirepo_session.simulation_list()["/Wavefront Propagation"]["Diffraction by an Aperture"]
+        aperture_simulation_data = sirepo_session.simulation_data(simulation_id=simulation_id)
+
+    simulation_data_list = []
+    for horizontal_size in horizontal_sizes:
+        aperture_simulation_data_copy = copy.deepcopy(aperture_simulation_data)
+        aperture_simulation_data_copy["models"]["beamline"][0]["horizontalSize"] = horizontal_size
+        simulation_data_list.append(aperture_simulation_data_copy)
+    return simulation_data_list
+
+
+def test_run_simulations_session_pool(fake_sirepo_servers):
+    simulation_data_list = aperture_simulation_data_list(fake_sirepo_servers[0].url, range(1, 19))
+
+    with SirepoSessionPool(
+        [fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers],
+        simulation_type="srw",
+        max_jobs_per_server=2,
+    ) as sirepo_session_pool:
+        run_status_responses = dict(
+            sirepo_session_pool.run_simulations(simulation_data_list, simulation_report="watchpointReport5")
+        )
+
+        assert sorted(run_status_responses) == list(range(18))
+        for simulation_i, run_status_response in run_status_responses.items():
+            # the fake server puts the aperture size in the x range
+            assert run_status_response.json()["x_range"][1] == simulation_i + 1
+
+        completed_counts = sirepo_session_pool.completed_counts
+        assert sum(completed_counts.values()) == 18
+        assert set(sirepo_session_pool.in_flight_counts.values()) == {0}
+
+    for fake_sirepo_server in fake_sirepo_servers:
+        assert completed_counts[fake_sirepo_server.url] > 0
+        assert fake_sirepo_server.max_running_job_count <= 2
+        # the scratch simulations were deleted
+        assert len(fake_sirepo_server.simulations) == 2
+
+
+def test_session_pool_threads_do_not_share_sessions(fake_sirepo_servers, monkeypatch):
+    # requests.Session object id -> ids of the threads that used it
+    session_thread_ids = {}
+    request = requests.Session.request
+
+    def recording_request(session, *args, **kwargs):
+        session_thread_ids.setdefault(id(session), set()).add(threading.get_ident())
+        return request(session, *args, **kwargs)
+
+    simulation_data_list = aperture_simulation_data_list(fake_sirepo_servers[0].url, range(1, 13))
+    login_counts = [
+        fake_sirepo_server.request_counts["auth-guest-login"] for fake_sirepo_server in fake_sirepo_servers
+    ]
+    monkeypatch.setattr(requests.Session, "request", recording_request)
+    with SirepoSessionPool(
+        [fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers],
+        simulation_type="srw",
+        max_jobs_per_server=2,
+    ) as sirepo_session_pool:
+        run_status_responses = dict(
+            sirepo_session_pool.run_simulations(simulation_data_list, simulation_report="watchpointReport5")
+        )
+    assert sorted(run_status_responses) == list(range(12))
+    # one session for each worker thread on each server, plus one for each server's login
+    assert len(session_thread_ids) > len(fake_sirepo_servers)
+    assert all(len(thread_ids) == 1 for thread_ids in session_thread_ids.values())
+    # the threads use the guest login rather than logging in again
+    for fake_sirepo_server, login_count in zip(fake_sirepo_servers, login_counts):
+        assert fake_sirepo_server.request_counts["auth-guest-login"] == login_count + 1
+
+
+def test_run_simulation_least_loaded_session_pool(fake_sirepo_servers):
+    simulation_data_list = aperture_simulation_data_list(fake_sirepo_servers[0].url, range(1, 4))
+
+    with SirepoSessionPool(
+        [fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers], simulation_type="srw"
+    ) as sirepo_session_pool:
+        run_simulation_responses = [
+            sirepo_session_pool.run_simulation(simulation_data, simulation_report="watchpointReport5")
+            for simulation_data in simulation_data_list
+        ]
+        # one job on each server
+        assert {run_simulation_response.server_url for run_simulation_response in run_simulation_responses} == {
+            fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers
+        }
+        assert set(sirepo_session_pool.in_flight_counts.values()) == {1}
+
+        for run_simulation_response in run_simulation_responses:
+            sirepo_session_pool.wait_for_simulation(run_simulation_response)
+        assert set(sirepo_session_pool.in_flight_counts.values()) == {0}
+
+
+def test_session_pool_removes_failing_server(fake_sirepo_servers):
+    simulation_data_list = aperture_simulation_data_list(fake_sirepo_servers[0].url, range(1, 13))
+
+    with SirepoSessionPool(
+        [fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers],
+        simulation_type="srw",
+        max_jobs_per_server=2,
+        max_consecutive_errors=1,
+    ) as sirepo_session_pool:
+        run_status_responses = {}
+        for simulation_i, run_status_response in sirepo_session_pool.run_simulations(
+            simulation_data_list, simulation_report="watchpointReport5"
+        ):
+            run_status_responses[simulation_i] = run_status_response
+            if len(run_status_responses) == 2:
+                fake_sirepo_servers[2].stop()
+
+        # every simulation completed on the remaining servers
+        assert sorted(run_status_responses) == list(range(12))
+        assert sirepo_session_pool.servers == [fake_sirepo_servers[0].url, fake_sirepo_servers[1].url]
+        assert sirepo_session_pool.removed_servers == [fake_sirepo_servers[2].url]
+
+        assert sirepo_session_pool.health_check(include_removed=True) == {
+            fake_sirepo_server.url: fake_sirepo_server is not fake_sirepo_servers[2]
+            for fake_sirepo_server in fake_sirepo_servers
+        }
+
+
+def test_session_pool_no_servers(fake_sirepo_server):
+    fake_sirepo_server.stop()
+    with pytest.raises(SirepoServerUnavailable):
+        with SirepoSessionPool([fake_sirepo_server.url], simulation_type="srw"):
+            pass
+
+
+def test_session_pool_simulation_error(fake_sirepo_servers):
+    simulation_data_list = aperture_simulation_data_list(fake_sirepo_servers[0].url, [1, -1, 2])
+
+    with SirepoSessionPool(
+        [fake_sirepo_server.url for fake_sirepo_server in fake_sirepo_servers], simulation_type="srw"
+    ) as sirepo_session_pool:
+        with pytest.raises(SirepoSimulationError):
+            list(sirepo_session_pool.run_simulations(simulation_data_list, simulation_report="watchpointReport5"))
+        # a failed simulation is not a failed server
+        assert len(sirepo_session_pool.servers) == 3
+
+        run_status_responses = dict(
+            sirepo_session_pool.run_simulations(
+                simulation_data_list, simulation_report="watchpointReport5", return_exceptions=True
+            )
+        )
+        assert isinstance(run_status_responses[1], SirepoSimulationError)
+        assert run_status_responses[2].json()["x_range"][1] == 2
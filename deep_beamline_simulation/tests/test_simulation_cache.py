@@ -0,0 +1,165 @@
+import asyncio
+import copy
+import os
+
+import numpy as np
+
+from deep_beamline_simulation import (
+    AsyncSirepoGuestSession,
+    SimulationResultCache,
+    SirepoGuestSession,
+    simulation_cache_key,
+)
+from deep_beamline_simulation.disk_cache import canonical_hash
+from deep_beamline_simulation.tests.fake_sirepo import aperture_simulation_data, intensity_report
+
+
+def test_simulation_cache_key():
+    simulation_data = aperture_simulation_data("zFJ9LE0c")
+    key = simulation_cache_key(simulation_data, "watchpointReport5")
+
+    # dictionary order does not matter
+    reordered_simulation_data = {"simulationType": "srw", "models": {}}
+    for model_name in reversed(list(simulation_data["models"])):
+        reordered_simulation_data["models"][model_name] = simulation_data["models"][model_name]
+    assert simulation_cache_key(reordered_simulation_data, "watchpointReport5") == key
+
+    # neither do float formatting or the identity of the simulation
+    equivalent_simulation_data = copy.deepcopy(simulation_data)
+    equivalent_simulation_data["models"]["beamline"][0]["horizontalSize"] = 0.1 + 0.9
+    equivalent_simulation_data["models"]["simulation"]["simulationId"] = "abcdefgh"
+    equivalent_simulation_data["models"]["simulation"]["name"] = "a copy"
+    assert simulation_cache_key(equivalent_simulation_data, "watchpointReport5") == key
+
+    # the report and the parameters do
+    assert simulation_cache_key(simulation_data, "intensityReport") != key
+    different_simulation_data = copy.deepcopy(simulation_data)
+    different_simulation_data["models"]["beamline"][0]["horizontalSize"] = 1.001
+    assert simulation_cache_key(different_simulation_data, "watchpointReport5") != key
+
+
+def test_canonical_hash_numbers():
+    assert canonical_hash({"a": [1, 2.5]}) == canonical_hash({"a": (1.0, np.float64(2.5))})
+    # integers are exact however many digits they have
+    assert canonical_hash({"seed": 10**13}) != canonical_hash({"seed": 10**13 + 1})
+    assert canonical_hash({"seed": np.int64(10**13 + 1)}) == canonical_hash({"seed": 10**13 + 1})
+    # floats are rounded
+    assert canonical_hash(0.1 + 0.2) == canonical_hash(0.3)
+
+
+def test_put_get(tmp_path):
+    result_cache = SimulationResultCache(cache_directory=tmp_path)
+    run_status = intensity_report(aperture_simulation_data("zFJ9LE0c"))
+
+    assert result_cache.get("a") is None
+    result_cache.put("a", run_status)
+    assert "a" in result_cache
+    assert result_cache.get("a") == run_status
+    np.testing.assert_array_equal(result_cache.get_intensity_matrix("a"), run_status["z_matrix"])
+
+    result_cache.invalidate("a")
+    assert result_cache.get("a") is None
+
+
+def test_least_recently_used_eviction(tmp_path):
+    result_cache = SimulationResultCache(cache_directory=tmp_path)
+    run_status = intensity_report(aperture_simulation_data("zFJ9LE0c"))
+    result_cache.put("a", run_status)
+    entry_size = result_cache.size_bytes
+
+    # room for two entries
+    result_cache.max_size_bytes = 2 * entry_size
+    result_cache.put("b", run_status)
+    # make "a" the most recently used entry
+    os.utime(tmp_path / "b.json", (0, 0))
+    assert result_cache.get("a") is not None
+    result_cache.put("c", run_status)
+
+    assert "a" in result_cache
+    assert "b" not in result_cache
+    assert "c" in result_cache
+    assert result_cache.size_bytes <= 2 * entry_size
+
+
+def _run_aperture_simulation(sirepo_session, bypass_cache=False):
+    simulation_data = sirepo_session.simulation_data("zFJ9LE0c")
+    run_simulation_response = sirepo_session.run_simulation(
+        simulation_id="zFJ9LE0c",
+        simulation_data=simulation_data,
+        simulation_report="watchpointReport5",
+        bypass_cache=bypass_cache,
+    )
+    return sirepo_session.wait_for_simulation(run_simulation_response)
+
+
+def test_session_result_cache(fake_sirepo_server, tmp_path):
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url,
+        simulation_type="srw",
+        result_cache=SimulationResultCache(cache_directory=tmp_path),
+    ) as sirepo_session:
+        run_status_response = _run_aperture_simulation(sirepo_session)
+        assert not run_status_response.from_cache
+        assert fake_sirepo_server.request_counts["run-simulation"] == 1
+
+        cached_run_status_response = _run_aperture_simulation(sirepo_session)
+        assert cached_run_status_response.from_cache
+        assert cached_run_status_response.json() == run_status_response.json()
+        assert fake_sirepo_server.request_counts["run-simulation"] == 1
+
+        bypassed_run_status_response = _run_aperture_simulation(sirepo_session, bypass_cache=True)
+        assert not bypassed_run_status_response.from_cache
+        assert fake_sirepo_server.request_counts["run-simulation"] == 2
+
+
+def test_run_simulations_result_cache(fake_sirepo_server, tmp_path):
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url,
+        simulation_type="srw",
+        result_cache=SimulationResultCache(cache_directory=tmp_path),
+    ) as sirepo_session:
+        simulation_data = sirepo_session.simulation_data("zFJ9LE0c")
+        simulation_data_list = []
+        for horizontal_size in (1, 2, 3, 1):
+            simulation_data_copy = copy.deepcopy(simulation_data)
+            simulation_data_copy["models"]["beamline"][0]["horizontalSize"] = horizontal_size
+            simulation_data_list.append(simulation_data_copy)
+
+        first_run_statuses = dict(
+            sirepo_session.run_simulations(
+                "zFJ9LE0c", simulation_data_list[:3], "watchpointReport5", max_concurrent_simulations=3
+            )
+        )
+        assert fake_sirepo_server.request_counts["run-simulation"] == 3
+
+        # every simulation is cached, including the repeated one
+        second_run_statuses = dict(
+            sirepo_session.run_simulations("zFJ9LE0c", simulation_data_list, "watchpointReport5")
+        )
+        assert fake_sirepo_server.request_counts["run-simulation"] == 3
+        assert fake_sirepo_server.request_counts["copy-simulation"] == 3
+        assert all(run_status_response.from_cache for run_status_response in second_run_statuses.values())
+        assert second_run_statuses[3].json() == first_run_statuses[0].json()
+
+
+def test_async_session_result_cache(fake_sirepo_server, tmp_path):
+    async def run_simulation_twice():
+        async with AsyncSirepoGuestSession(
+            sirepo_server_url=fake_sirepo_server.url,
+            simulation_type="srw",
+            result_cache=SimulationResultCache(cache_directory=tmp_path),
+        ) as sirepo_session:
+            simulation_data = await sirepo_session.simulation_data("zFJ9LE0c")
+            run_statuses = []
+            for _ in range(2):
+                run_simulation_json = await sirepo_session.run_simulation(
+                    "zFJ9LE0c", simulation_data, "watchpointReport5"
+                )
+                run_statuses.append(await sirepo_session.wait_for_simulation(run_simulation_json))
+            return run_statuses
+
+    run_status, cached_run_status = asyncio.run(run_simulation_twice())
+    assert not run_status.from_cache
+    assert cached_run_status.from_cache
+    assert cached_run_status == run_status
+    assert fake_sirepo_server.request_counts["run-simulation"] == 1
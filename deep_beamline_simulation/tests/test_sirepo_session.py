@@ -1,3 +1,7 @@
+import copy
+
+import pytest
+
 from deep_beamline_simulation import SirepoGuestSession
 
 
@@ -71,3 +75,100 @@ def test_run_simulation(sirepo_server_url):
             simulation_data=aperture_simulation_data,
         )
         sirepo_session.wait_for_simulation(run_simulation_response)
+
+
+def test_run_simulations(sirepo_server_url):
+    with SirepoGuestSession(
+        sirepo_server_url=sirepo_server_url, simulation_type="srw"
+    ) as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        # pick a known simulation
+        simulation_id = simulation_table["/Wavefront Propagation"][
+            "Diffraction by an Aperture"
+        ]
+        aperture_simulation_data = sirepo_session.simulation_data(
+            simulation_id=simulation_id
+        )
+
+        aperture_simulation_data_list = []
+        for horizontal_size in (0.5, 1.0, 1.5):
+            aperture_simulation_data_copy = copy.deepcopy(aperture_simulation_data)
+            aperture = aperture_simulation_data_copy["models"]["beamline"][0]
+            aperture["horizontalSize"] = horizontal_size
+            aperture_simulation_data_list.append(aperture_simulation_data_copy)
+
+        completed_simulation_indices = []
+        for simulation_i, run_status_response in sirepo_session.run_simulations(
+            simulation_id=simulation_id,
+            simulation_data_list=aperture_simulation_data_list,
+            simulation_report="watchpointReport6",
+            max_concurrent_simulations=2,
+        ):
+            assert run_status_response.json()["state"] == "completed"
+            completed_simulation_indices.append(simulation_i)
+
+        assert sorted(completed_simulation_indices) == [0, 1, 2]
+
+        # the scratch copies have been deleted
+        assert sirepo_session.simulation_list() == simulation_table
+
+
+def test_run_simulations_fake_sirepo(fake_sirepo_server):
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+    ) as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        simulation_id = simulation_table["/Wavefront Propagation"][
+            "Diffraction by an Aperture"
+        ]
+        aperture_simulation_data = sirepo_session.simulation_data(
+            simulation_id=simulation_id
+        )
+
+        aperture_simulation_data_list = []
+        for horizontal_size in range(1, 11):
+            aperture_simulation_data_copy = copy.deepcopy(aperture_simulation_data)
+            aperture = aperture_simulation_data_copy["models"]["beamline"][0]
+            aperture["horizontalSize"] = horizontal_size
+            aperture_simulation_data_list.append(aperture_simulation_data_copy)
+
+        run_status_responses = dict(
+            sirepo_session.run_simulations(
+                simulation_id=simulation_id,
+                simulation_data_list=aperture_simulation_data_list,
+                simulation_report="watchpointReport5",
+                max_concurrent_simulations=3,
+            )
+        )
+
+        assert sorted(run_status_responses) == list(range(10))
+        for simulation_i, run_status_response in run_status_responses.items():
+            # the fake server puts the aperture size in the x range
+            assert run_status_response.json()["x_range"][1] == simulation_i + 1
+
+        assert fake_sirepo_server.max_running_job_count == 3
+        assert fake_sirepo_server.request_counts["copy-simulation"] == 3
+        assert sirepo_session.simulation_list() == simulation_table
+
+
+def test_run_simulations_error_fake_sirepo(fake_sirepo_server):
+    with SirepoGuestSession(
+        sirepo_server_url=fake_sirepo_server.url, simulation_type="srw"
+    ) as sirepo_session:
+        simulation_id = "zFJ9LE0c"
+        aperture_simulation_data = sirepo_session.simulation_data(
+            simulation_id=simulation_id
+        )
+        # the fake server fails simulations with a negative aperture size
+        aperture_simulation_data["models"]["beamline"][0]["horizontalSize"] = -1
+
+        with pytest.raises(Exception):
+            list(
+                sirepo_session.run_simulations(
+                    simulation_id=simulation_id,
+                    simulation_data_list=[aperture_simulation_data],
+                )
+            )
+
+        # the scratch copy is deleted after the error
+        assert fake_sirepo_server.request_counts["delete-simulation"] == 1
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from deep_beamline_simulation.splits import (
+    SplitConfig,
+    load_split,
+    make_split,
+    parameter_space_regions,
+    split_indices,
+    split_path,
+)
+from deep_beamline_simulation.tests.test_lazy_dataset import write_preprocessed_results
+from deep_beamline_simulation.u_net import build_dataloaders
+
+
+def assert_partition(split, image_count):
+    all_indices = np.concatenate([split.training, split.validation, split.test])
+    np.testing.assert_array_equal(np.sort(all_indices), np.arange(image_count))
+
+
+@pytest.mark.parametrize("method", SplitConfig.methods)
+def test_make_split(method):
+    param_vals = np.random.default_rng(0).uniform(size=(200, 2))
+    config = SplitConfig(method=method, validation_fraction=0.2, test_fraction=0.25, seed=3, bins=3)
+    split = make_split(200, config, param_vals=param_vals)
+    assert_partition(split, 200)
+    if method in ("ordered", "random"):
+        assert (len(split.validation), len(split.test)) == (40, 50)
+    elif method == "stratified":
+        # to within one image in each of the 9 regions
+        assert abs(len(split.validation) - 40) <= 9
+        assert abs(len(split.test) - 50) <= 9
+    elif method == "blocked":
+        # the subsets are filled a whole region at a time
+        assert len(split.validation) >= 40
+        assert len(split.test) >= 50
+    # deterministic
+    np.testing.assert_array_equal(make_split(200, config, param_vals=param_vals).test, split.test)
+
+
+def test_kfold_split():
+    config_dict = SplitConfig(method="kfold", fold_count=4, test_fraction=0.2).to_dict()
+    splits = [make_split(50, SplitConfig.from_dict({**config_dict, "fold": fold})) for fold in range(4)]
+    # the folds share the test subset and cover the rest once
+    for split in splits:
+        np.testing.assert_array_equal(split.test, splits[0].test)
+        assert_partition(split, 50)
+    validation = np.concatenate([split.validation for split in splits])
+    np.testing.assert_array_equal(np.sort(validation), np.setdiff1d(np.arange(50), splits[0].test))
+
+
+def test_parameter_space_splits():
+    # a 10 x 10 grid of two parameters
+    param_vals = np.stack(np.meshgrid(np.arange(10.0), np.arange(10.0)), axis=-1).reshape(-1, 2)
+    regions = parameter_space_regions(param_vals, bins=2)
+    assert len(np.unique(regions)) == 4
+
+    stratified_split = make_split(100, SplitConfig(method="stratified", bins=2, test_fraction=0.2), param_vals)
+    # every region gives its share of test images
+    assert np.bincount(regions[stratified_split.test]).tolist() == [5, 5, 5, 5]
+
+    blocked_split = make_split(100, SplitConfig(method="blocked", bins=2, test_fraction=0.2), param_vals)
+    # test images are in regions without training images
+    assert not set(regions[blocked_split.test]) & set(regions[blocked_split.training])
+    assert len(blocked_split.test) == 25
+
+    with pytest.raises(ValueError):
+        make_split(100, SplitConfig(method="blocked"))
+
+
+def test_load_split(tmp_path, monkeypatch):
+    write_preprocessed_results(tmp_path / "p.h5", image_count=30)
+    config = SplitConfig(method="stratified", bins=2, parameters=["b"], validation_fraction=0.2)
+    split = load_split(tmp_path / "p.h5", config)
+    assert split_path(tmp_path / "p.h5", config).exists()
+    assert split.config == config
+    assert_partition(split, 30)
+
+    # read, not computed again
+    def fail(*args, **kwargs):
+        raise AssertionError("split computed again")
+
+    monkeypatch.setattr("deep_beamline_simulation.splits.make_split", fail)
+    loaded_split = load_split(tmp_path / "p.h5", config)
+    np.testing.assert_array_equal(loaded_split.validation, split.validation)
+    monkeypatch.undo()
+
+    # new parameter values, a new split
+    write_preprocessed_results(tmp_path / "p.h5", image_count=33)
+    assert_partition(load_split(tmp_path / "p.h5", config), 33)
+
+    with pytest.raises(ValueError):
+        load_split(tmp_path / "p.h5", SplitConfig(method="blocked", parameters=["c"]))
+
+
+def test_split_dataloaders(tmp_path):
+    write_preprocessed_results(tmp_path / "p.h5", image_count=21)
+    training_indices, testing_indices = split_indices(tmp_path / "p.h5")
+    np.testing.assert_array_equal(training_indices, np.arange(14))
+    np.testing.assert_array_equal(testing_indices, np.arange(14, 21))
+
+    config = SplitConfig(method="kfold", fold_count=3, test_fraction=0.0)
+    split = load_split(tmp_path / "p.h5", config)
+    for dataset_type in ("array", "tensor", "lazy"):
+        training_dataloader, testing_dataloader = build_dataloaders(
+            tmp_path / "p.h5", batch_size=5, dataset_type=dataset_type, split=config, testing_subset="validation"
+        )
+        assert len(training_dataloader.dataset) == len(split.training) == 14
+        assert len(testing_dataloader.dataset) == len(split.validation) == 7
+
+    with pytest.raises(ValueError):
+        build_dataloaders(tmp_path / "p.h5", batch_size=5, split=config, testing_subset="training")
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+from deep_beamline_simulation.srw_io import read_srw_header, read_srw_intensity, sidecar_path
+
+SRW_HEADER = """#C-aligned Intensity (inner loop is vs photon energy, outer loop vs vertical position)
+#1000.0 #Initial Photon Energy [eV]
+#1000.0 #Final Photon Energy [eV]
+#1 #Number of points vs Photon Energy
+#-0.001 #Initial Horizontal Position [m]
+#0.001 #Final Horizontal Position [m]
+#{nx} #Number of points vs Horizontal Position
+#-0.0005 #Initial Vertical Position [m]
+#0.0005 #Final Vertical Position [m]
+#{ny} #Number of points vs Vertical Position
+"""
+
+
+def write_srw_file(srw_file_path, intensity, value_count=None):
+    ny, nx = intensity.shape
+    with open(srw_file_path, "w") as srw_file:
+        srw_file.write(SRW_HEADER.format(nx=nx, ny=ny))
+        for value in intensity.ravel()[:value_count]:
+            srw_file.write(f"{value:.6e}\n")
+
+
+def test_read_srw_header(tmp_path):
+    write_srw_file(tmp_path / "res_int_pr_se.dat", np.zeros((3, 4)))
+    header = read_srw_header(tmp_path / "res_int_pr_se.dat")
+
+    assert header.title.startswith("C-aligned Intensity")
+    assert header.photon_energy == 1000.0
+    assert header.horizontal_range == (-0.001, 0.001, 4)
+    assert header.vertical_extent == (-0.0005, 0.0005)
+    assert header.shape == (3, 4)
+    assert header.units[:2] == ["eV", "eV"]
+    assert header.labels[5] == "Number of points vs Horizontal Position"
+    assert header.header_line_count == 10
+
+
+def test_read_srw_intensity(tmp_path):
+    intensity = np.random.default_rng(0).uniform(0.0, 1e12, size=(5, 7))
+    write_srw_file(tmp_path / "res_int_pr_se.dat", intensity)
+
+    srw_intensity, header = read_srw_intensity(tmp_path / "res_int_pr_se.dat", return_header=True)
+    assert srw_intensity.dtype == np.float32
+    assert srw_intensity.shape == header.shape == (5, 7)
+    # the rows are vertical positions
+    expected_intensity = np.array([float(f"{value:.6e}") for value in intensity.ravel()]).reshape(5, 7)
+    np.testing.assert_array_equal(srw_intensity, expected_intensity.astype(np.float32))
+
+    srw_intensity = read_srw_intensity(tmp_path / "res_int_pr_se.dat", dtype=np.float64)
+    np.testing.assert_array_equal(srw_intensity, expected_intensity)
+
+
+def test_read_srw_intensity_sidecar(tmp_path):
+    srw_file_path = tmp_path / "res_int_pr_se.dat"
+    write_srw_file(srw_file_path, np.arange(12.0).reshape(3, 4))
+
+    srw_intensity = read_srw_intensity(srw_file_path, sidecar=True)
+    assert sidecar_path(srw_file_path).exists()
+    assert not isinstance(srw_intensity, np.memmap)
+
+    sidecar_intensity = read_srw_intensity(srw_file_path, sidecar=True)
+    assert isinstance(sidecar_intensity, np.memmap)
+    np.testing.assert_array_equal(sidecar_intensity, srw_intensity)
+
+    # a rewritten .dat file is read again and its sidecar replaced
+    write_srw_file(srw_file_path, np.arange(12.0).reshape(3, 4) * 2)
+    sidecar_stat = sidecar_path(srw_file_path).stat()
+    os.utime(srw_file_path, (sidecar_stat.st_atime + 10, sidecar_stat.st_mtime + 10))
+    srw_intensity = read_srw_intensity(srw_file_path, sidecar=True)
+    assert not isinstance(srw_intensity, np.memmap)
+    np.testing.assert_array_equal(srw_intensity, np.arange(12.0).reshape(3, 4) * 2)
+    np.testing.assert_array_equal(read_srw_intensity(srw_file_path, sidecar=True), srw_intensity)
+
+
+def test_read_srw_intensity_value_count(tmp_path):
+    write_srw_file(tmp_path / "res_int_pr_se.dat", np.ones((3, 4)), value_count=10)
+    with pytest.raises(ValueError, match="has 10 values"):
+        read_srw_intensity(tmp_path / "res_int_pr_se.dat")
@@ -0,0 +1,98 @@
+import os
+import time as ttime
+
+import pytest
+
+from deep_beamline_simulation.srw_runner import (
+    TaskFailed,
+    TaskTimeout,
+    default_worker_count,
+    run_tasks,
+)
+
+
+def sleep_and_square(x, sleep_seconds):
+    ttime.sleep(sleep_seconds)
+    return x * x
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("three is not allowed")
+    return x
+
+
+def exit_on_three(x):
+    if x == 3:
+        os._exit(7)
+    return x
+
+
+def test_default_worker_count():
+    assert default_worker_count(0) == 1
+    assert default_worker_count(1) == 1
+    assert 1 <= default_worker_count() <= max(os.cpu_count() - 1, 1)
+
+
+def test_run_tasks():
+    task_progresses = []
+    results = dict(
+        run_tasks(
+            sleep_and_square,
+            [(x, 0.0) for x in range(10)],
+            max_workers=3,
+            progress_callback=lambda task_progress: task_progresses.append(task_progress.finished_count),
+        )
+    )
+    assert results == {x: x * x for x in range(10)}
+    assert task_progresses == list(range(1, 11))
+
+    assert list(run_tasks(sleep_and_square, [], max_workers=3)) == []
+
+
+def test_run_tasks_load_balancing():
+    # one slow task and many fast tasks, the fast tasks are not held up by the slow one
+    task_arguments = [(0, 1.0)] + [(x, 0.05) for x in range(1, 13)]
+    start_time = ttime.monotonic()
+    completed_tasks = [task_i for task_i, _ in run_tasks(sleep_and_square, task_arguments, max_workers=2)]
+    elapsed_seconds = ttime.monotonic() - start_time
+
+    # the slow task finishes last, after the other worker ran every fast task
+    assert completed_tasks[-1] == 0
+    assert sorted(completed_tasks) == list(range(13))
+    # a static split into two slices would take at least 1.0 + 0.05 * 6 seconds
+    assert elapsed_seconds < 1.0 + 0.05 * 6
+
+
+def test_run_tasks_timeout():
+    results = dict(
+        run_tasks(
+            sleep_and_square,
+            [(1, 0.0), (2, 10.0), (3, 0.0), (4, 0.0)],
+            max_workers=2,
+            task_timeout_seconds=0.5,
+            return_exceptions=True,
+        )
+    )
+    assert isinstance(results.pop(1), TaskTimeout)
+    assert results == {0: 1, 2: 9, 3: 16}
+
+    with pytest.raises(TaskTimeout):
+        list(run_tasks(sleep_and_square, [(2, 10.0)], task_timeout_seconds=0.2))
+
+
+@pytest.mark.parametrize("task_function", [fail_on_three, exit_on_three])
+def test_run_tasks_failure(task_function):
+    results = dict(run_tasks(task_function, [(x,) for x in range(6)], max_workers=2, return_exceptions=True))
+    task_failed = results.pop(3)
+    assert isinstance(task_failed, TaskFailed)
+    assert task_failed.task_i == 3
+    if task_function is fail_on_three:
+        assert "three is not allowed" in str(task_failed)
+    else:
+        assert "exited with code 7" in str(task_failed)
+    # the other tasks completed on the remaining and replacement workers
+    assert results == {x: x for x in (0, 1, 2, 4, 5)}
+
+    with pytest.raises(TaskFailed):
+        list(run_tasks(task_function, [(x,) for x in range(6)], max_workers=2))
@@ -0,0 +1,225 @@
+import h5py
+import numpy as np
+import pytest
+
+from deep_beamline_simulation import SirepoGuestSession, SirepoSessionPool, SirepoSimulationError
+from deep_beamline_simulation.sweep import (
+    ParameterSpace,
+    SweepJournal,
+    SweepParameter,
+    SweepWriter,
+    apply_parameters,
+    run_sirepo_sweep,
+    sweep_key,
+)
+from deep_beamline_simulation.tests.fake_sirepo import aperture_simulation_data
+
+
+def aperture_parameters(count=None):
+    return [
+        SweepParameter("Aperture", "horizontalSize", 1.0, 2.0, count=count),
+        SweepParameter("Aperture", "verticalSize", 0.5, 1.5, count=count),
+    ]
+
+
+def test_grid_parameter_space():
+    parameter_space = ParameterSpace(
+        [
+            SweepParameter("Aperture", "horizontalSize", 1.0, 2.0, count=3),
+            SweepParameter("Aperture", "verticalSize", 0.5, 1.5, count=2),
+        ]
+    )
+    assert parameter_space.names == ["Aperture_horizontalSize", "Aperture_verticalSize"]
+    assert len(parameter_space) == 6
+
+    samples = np.array(list(parameter_space))
+    assert samples.tolist() == [[1.0, 0.5], [1.0, 1.5], [1.5, 0.5], [1.5, 1.5], [2.0, 0.5], [2.0, 1.5]]
+    for sample_i, sample_values in enumerate(samples):
+        np.testing.assert_array_equal(parameter_space[sample_i], sample_values)
+
+    with pytest.raises(ValueError):
+        ParameterSpace(aperture_parameters(count=None))
+
+
+@pytest.mark.parametrize("sampling", ["latin_hypercube", "random", "sobol"])
+def test_sampled_parameter_space(sampling):
+    if sampling == "sobol":
+        pytest.importorskip("scipy")
+
+    parameter_space = ParameterSpace(aperture_parameters(), sampling=sampling, sample_count=16, seed=3)
+    samples = np.array(list(parameter_space))
+    assert samples.shape == (16, 2)
+    assert np.all(samples >= [1.0, 0.5]) and np.all(samples <= [2.0, 1.5])
+    np.testing.assert_array_equal(parameter_space[5], samples[5])
+
+    # the same seed gives the same samples
+    same_parameter_space = ParameterSpace(aperture_parameters(), sampling=sampling, sample_count=16, seed=3)
+    np.testing.assert_array_equal(np.array(list(same_parameter_space)), samples)
+
+    if sampling == "latin_hypercube":
+        # one sample in each stratum of each parameter
+        strata = np.floor((samples - [1.0, 0.5]) * 16).astype(int)
+        for parameter_i in range(2):
+            assert sorted(strata[:, parameter_i]) == list(range(16))
+
+    with pytest.raises(ValueError):
+        ParameterSpace(aperture_parameters(), sampling=sampling)
+
+
+def test_apply_parameters():
+    simulation_data = aperture_simulation_data("zFJ9LE0c")
+    simulation_data_copy = apply_parameters(simulation_data, aperture_parameters(), [1.25, 0.75])
+
+    assert simulation_data_copy["models"]["beamline"][0]["horizontalSize"] == 1.25
+    assert simulation_data_copy["models"]["beamline"][0]["verticalSize"] == 0.75
+    # the original is unchanged
+    assert simulation_data["models"]["beamline"][0]["horizontalSize"] == 1
+
+    with pytest.raises(KeyError):
+        apply_parameters(simulation_data, [SweepParameter("Mirror", "size", 0, 1)], [0.5])
+
+
+@pytest.mark.parametrize("use_pool", [False, True])
+def test_run_sirepo_sweep(fake_sirepo_server, tmp_path, use_pool):
+    parameter_space = ParameterSpace(aperture_parameters(), sampling="latin_hypercube", sample_count=10, seed=1)
+
+    if use_pool:
+        sirepo_session = SirepoSessionPool([fake_sirepo_server.url], simulation_type="srw", max_jobs_per_server=3)
+    else:
+        sirepo_session = SirepoGuestSession(sirepo_server_url=fake_sirepo_server.url, simulation_type="srw")
+
+    with sirepo_session:
+        if use_pool:
+            simulation_data = aperture_simulation_data("zFJ9LE0c")
+            run_simulations_kwargs = {}
+        else:
+            simulation_table = sirepo_session.simulation_list()
+            simulation_id = simulation_table["/Wavefront Propagation"]["Diffraction by an Aperture"]
+            simulation_data = sirepo_session.simulation_data(simulation_id)
+            run_simulations_kwargs = {"max_concurrent_simulations": 3}
+
+        run_sirepo_sweep(
+            sirepo_session,
+            simulation_data=simulation_data,
+            parameter_space=parameter_space,
+            output_path=tmp_path / "results.h5",
+            simulation_report="watchpointReport5",
+            **run_simulations_kwargs,
+        )
+
+    with h5py.File(tmp_path / "results.h5") as results:
+        assert [param.decode() for param in results["params"]] == parameter_space.names
+        np.testing.assert_array_equal(results["paramVals"][()], np.array(list(parameter_space)))
+
+        beam_intensities = results["beamIntensities"]
+        assert beam_intensities.shape == (10, 6, 8)
+        assert beam_intensities.chunks == (1, 6, 8)
+        assert beam_intensities.compression == "gzip"
+        for sample_i, (horizontal_size, vertical_size) in enumerate(parameter_space):
+            # the fake server computes the intensity from the aperture size
+            assert beam_intensities[sample_i, 0, 0] == pytest.approx(horizontal_size + vertical_size)
+
+
+def test_sweep_journal(tmp_path):
+    journal_path = tmp_path / "sweep.journal"
+    with SweepJournal(journal_path, sweep_key="abc", sample_count=4) as sweep_journal:
+        assert not sweep_journal.resumed
+        sweep_journal.record_completed(0)
+        sweep_journal.record_failed(1, "simulation error")
+        sweep_journal.record_completed(2)
+
+    # imitate an interruption while a record was written
+    with open(journal_path, "a") as journal_file:
+        journal_file.write('{"event": "compl')
+
+    with SweepJournal(journal_path, sweep_key="abc", sample_count=4) as sweep_journal:
+        assert sweep_journal.resumed
+        assert sweep_journal.completed_samples == {0, 2}
+        assert sweep_journal.pending_samples(max_attempts=2) == [1, 3]
+        sweep_journal.record_failed(1, "simulation error")
+        assert sweep_journal.pending_samples(max_attempts=2) == [3]
+        assert sweep_journal.failed_samples(max_attempts=2) == [1]
+
+    with SweepJournal(journal_path, sweep_key="abc", sample_count=4) as sweep_journal:
+        assert sweep_journal.failure_counts[1] == 2
+        assert sweep_journal.errors[1] == "simulation error"
+
+    with pytest.raises(ValueError):
+        SweepJournal(journal_path, sweep_key="def", sample_count=4)
+
+
+def test_resume_sirepo_sweep(fake_sirepo_server, tmp_path, monkeypatch):
+    parameter_space = ParameterSpace(aperture_parameters(), sampling="random", sample_count=10, seed=2)
+    sweep_kwargs = dict(
+        parameter_space=parameter_space,
+        output_path=tmp_path / "results.h5",
+        simulation_report="watchpointReport5",
+        journal_path=tmp_path / "results.journal",
+        max_concurrent_simulations=2,
+    )
+
+    write = SweepWriter.write
+    write_count = 0
+
+    def interrupted_write(sweep_writer, *args):
+        nonlocal write_count
+        if write_count == 4:
+            raise KeyboardInterrupt()
+        write_count += 1
+        write(sweep_writer, *args)
+
+    with SirepoGuestSession(sirepo_server_url=fake_sirepo_server.url, simulation_type="srw") as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        simulation_id = simulation_table["/Wavefront Propagation"]["Diffraction by an Aperture"]
+        simulation_data = sirepo_session.simulation_data(simulation_id)
+
+        monkeypatch.setattr(SweepWriter, "write", interrupted_write)
+        with pytest.raises(KeyboardInterrupt):
+            run_sirepo_sweep(sirepo_session, simulation_data=simulation_data, **sweep_kwargs)
+        monkeypatch.setattr(SweepWriter, "write", write)
+
+        run_simulation_count = fake_sirepo_server.request_counts["run-simulation"]
+        run_sirepo_sweep(sirepo_session, simulation_data=simulation_data, **sweep_kwargs)
+        # only the samples that were not written are run again
+        assert fake_sirepo_server.request_counts["run-simulation"] - run_simulation_count == 6
+
+    with h5py.File(tmp_path / "results.h5") as results:
+        np.testing.assert_array_equal(results["paramVals"][()], np.array(list(parameter_space)))
+        for sample_i, (horizontal_size, vertical_size) in enumerate(parameter_space):
+            assert results["beamIntensities"][sample_i, 0, 0] == pytest.approx(horizontal_size + vertical_size)
+
+
+def test_sirepo_sweep_failed_samples(fake_sirepo_server, tmp_path):
+    # the fake server fails simulations with a negative aperture size
+    parameter_space = ParameterSpace(
+        [
+            SweepParameter("Aperture", "horizontalSize", -1.0, 1.0, count=5),
+            SweepParameter("Aperture", "verticalSize", 1.0, 1.0, count=1),
+        ]
+    )
+    journal_path = tmp_path / "results.journal"
+
+    with SirepoGuestSession(sirepo_server_url=fake_sirepo_server.url, simulation_type="srw") as sirepo_session:
+        simulation_table = sirepo_session.simulation_list()
+        simulation_id = simulation_table["/Wavefront Propagation"]["Diffraction by an Aperture"]
+        simulation_data = sirepo_session.simulation_data(simulation_id)
+
+        with pytest.raises(SirepoSimulationError, match="2 of 5 samples failed 2 times"):
+            run_sirepo_sweep(
+                sirepo_session,
+                simulation_data=simulation_data,
+                parameter_space=parameter_space,
+                output_path=tmp_path / "results.h5",
+                simulation_report="watchpointReport5",
+                journal_path=journal_path,
+                max_attempts=2,
+            )
+
+    assert fake_sirepo_server.request_counts["run-simulation"] == 3 + 2 * 2
+    with SweepJournal(
+        journal_path, sweep_key(simulation_data, parameter_space, "watchpointReport5"), sample_count=5
+    ) as sweep_journal:
+        assert sweep_journal.completed_samples == {2, 3, 4}
+        assert sweep_journal.failed_samples(max_attempts=2) == [0, 1]
+    with h5py.File(tmp_path / "results.h5") as results:
+        assert results["beamIntensities"][4, 0, 0] == pytest.approx(2.0)
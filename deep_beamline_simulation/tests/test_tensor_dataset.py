@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from deep_beamline_simulation.tensor_dataset import TensorBatchLoader, TensorIntensityImageDataset
+from deep_beamline_simulation.tests.test_lazy_dataset import write_preprocessed_results
+from deep_beamline_simulation.u_net import build_dataloaders
+
+
+def test_tensor_intensity_image_dataset(tmp_path):
+    beam_intensities, param_vals = write_preprocessed_results(tmp_path / "p.h5")
+    dataset = TensorIntensityImageDataset.from_h5(tmp_path / "p.h5", indices=[9, 3, 4, 3])
+    assert len(dataset) == 4
+    assert dataset.beam_intensities.dtype == torch.float32
+    assert dataset.beam_intensities.is_contiguous()
+
+    image, initial_image, image_param_vals = dataset[0]
+    np.testing.assert_array_equal(image.numpy(), beam_intensities[9][None])
+    assert initial_image.shape == (1, 8, 8)
+    np.testing.assert_array_equal(image_param_vals.numpy(), param_vals[9])
+
+    images, initial_images, batch_param_vals = dataset[[2, 0, 3]]
+    np.testing.assert_array_equal(images.numpy(), beam_intensities[[4, 9, 3], None])
+    np.testing.assert_array_equal(batch_param_vals.numpy(), param_vals[[4, 9, 3]])
+    assert initial_images.shape == (3, 1, 8, 8)
+
+    assert len(TensorIntensityImageDataset.from_h5(tmp_path / "p.h5", indices=[])) == 0
+    # without CUDA batches are not pinned
+    if not torch.cuda.is_available():
+        assert not TensorIntensityImageDataset.from_h5(tmp_path / "p.h5", pin_memory=True).pin_memory
+
+
+def test_tensor_batch_loader(tmp_path):
+    beam_intensities, param_vals = write_preprocessed_results(tmp_path / "p.h5")
+    dataset = TensorIntensityImageDataset.from_h5(tmp_path / "p.h5", shared_initial_intensity=True)
+
+    batch_loader = TensorBatchLoader(dataset, batch_size=6, seed=0)
+    assert len(batch_loader) == 4
+    batches = list(batch_loader)
+    assert [len(batch_images) for batch_images, _ in batches] == [6, 6, 6, 2]
+    images = torch.cat([batch_images for batch_images, _ in batches])
+    all_param_vals = torch.cat([batch_param_vals for _, batch_param_vals in batches])
+    order = np.argsort(all_param_vals[:, 0].numpy())
+    np.testing.assert_array_equal(images.numpy()[order], beam_intensities[np.argsort(param_vals[:, 0]), None])
+    # a new order each epoch
+    assert not torch.equal(torch.cat([batch_images for batch_images, _ in batch_loader]), images)
+
+    batch_loader = TensorBatchLoader(dataset, batch_size=6, shuffle=False, drop_last=True)
+    assert len(batch_loader) == 3
+    images = torch.cat([batch_images for batch_images, _ in batch_loader])
+    np.testing.assert_array_equal(images.numpy(), beam_intensities[:18, None])
+
+
+def test_build_tensor_dataloaders(tmp_path):
+    write_preprocessed_results(tmp_path / "p.h5", image_count=21)
+    training_dataloader, testing_dataloader = build_dataloaders(
+        tmp_path / "p.h5", batch_size=5, dataset_type="tensor"
+    )
+    assert len(training_dataloader.dataset) == 14
+    assert len(testing_dataloader.dataset) == 7
+    correct_images, images, input_params = next(iter(training_dataloader))
+    assert correct_images.shape == (5, 1, 8, 8)
+    assert images.shape == (5, 1, 8, 8)
+    assert input_params.shape == (5, 2)
+
+    with pytest.raises(ValueError):
+        build_dataloaders(tmp_path / "p.h5", batch_size=5, dataset_type="tensor", sampler="block")
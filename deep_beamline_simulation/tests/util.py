@@ -1,10 +1,16 @@
 from deep_beamline_simulation import SirepoGuestSession
+from deep_beamline_simulation.metadata_cache import SirepoMetadataCache
 from deep_beamline_simulation.ophyd import build_sirepo_simulation
 
+# share the guest login and simulation metadata between tests
+_metadata_cache = SirepoMetadataCache()
+
 
 def get_srx_sirepo_simulation(sirepo_server_url="http://localhost:8000"):
     with SirepoGuestSession(
-        sirepo_server_url=sirepo_server_url, simulation_type="srw"
+        sirepo_server_url=sirepo_server_url,
+        simulation_type="srw",
+        metadata_cache=_metadata_cache,
     ) as sirepo_session:
         simulation_table = sirepo_session.simulation_list()
         # pick a known simulation
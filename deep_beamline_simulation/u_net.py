@@ -2,7 +2,6 @@ import os
 import cv2
 import h5py
 from pathlib import Path
-import matplotlib.pyplot as plt
 from torch.utils.data import Dataset
 import numpy as np
 import pandas as pd
@@ -23,6 +22,12 @@ from torch.nn import (
 )
 from torchvision.transforms import CenterCrop
 
+from deep_beamline_simulation.conditioning import SharedInitialImage
+from deep_beamline_simulation.lazy_dataset import LazyIntensityImageDataset, build_lazy_dataloader
+from deep_beamline_simulation.preprocessing import preprocess_beam_intensities, read_initial_beam_intensity_csv
+from deep_beamline_simulation.splits import split_indices
+from deep_beamline_simulation.tensor_dataset import TensorBatchLoader, TensorIntensityImageDataset
+
 
 class ImageProcessing:
     """
@@ -69,14 +74,38 @@ class ImageProcessing:
 
     def loss_crop(self, image, x1, x2):
         # crop images to recompute the loss to avoid all of th extra empty space
-        cropped_image = []
-        for row in image:
-            crop = row[x1:x2]
-            cropped_image.append(crop)
-        cropped_image = np.asarray(cropped_image)
-        return cropped_image
-
-    def preprocess(self, filename):
+        return np.asarray(image)[..., x1:x2]
+
+    def preprocess(
+        self, filename, config=None, chunk_size=64, diagnostics=False, workers=1, preprocessing_cache=None
+    ):
+        """
+        Preprocess a results.h5 file into preprocessed_results.h5, a chunk of images at a time.
+
+        See `deep_beamline_simulation.preprocessing.preprocess_beam_intensities`.
+
+        Parameters
+        ----------
+        filename: str
+          a results.h5 file relative to the repository
+        config: PreprocessingConfig, optional
+          the preprocessing steps, by default crop columns 400 to 650 and resize to 128x128
+        chunk_size: int
+          number of images read at a time
+        diagnostics: bool
+          if True compute a PreprocessingDiagnostics, available as `result.diagnostics`
+        workers: int
+          number of processes preprocessing chunks of images
+        preprocessing_cache: PreprocessingCache, optional
+          if given, reuse the cached preprocessed file for the same results.h5 and config,
+          `result.preprocessed_results_path` is then in the cache directory instead of the
+          working directory
+
+        Returns
+        -------
+        (int, PreprocessingResult)
+          the number of beamline parameters and a summary of the preprocessed images
+        """
         dbs_path = Path(deep_beamline_simulation.__file__)
 
         dbs_repository = dbs_path.parent.parent
@@ -85,147 +114,89 @@ class ImageProcessing:
         # example: filename = "NSLS-II-TES-beamline-rsOptExport-2/rsopt350/datasets/results.h5"
         train_file = dbs_repository / filename
 
-        # read the results.h5 file
-        with h5py.File(train_file) as f:
-            beam_intensities = f['beamIntensities']
-            self.image_list = beam_intensities
-            min_height, min_length = self.smallest_image_size()
-
-            # identify parameter shapes and counts
-            print(f"Parameter Shape: {f['params'].shape}" )
-            _parameter_count = f["params"].shape[0]
-
-            cropped_beam_intensities = []
-            for image in beam_intensities:
-                cropped_beam_intensities.append(self.loss_crop(image, 400, 650))
-
-            fig, axs = plt.subplots(nrows=1, ncols=2)
-            axs[0].imshow(beam_intensities[0], aspect='auto')
-            axs[0].set_title('Uncropped Image')
-            axs[1].imshow(cropped_beam_intensities[0], aspect='auto')
-            axs[1].set_title('Cropped Image')
-
-            cropped_beam_intensities = np.array(cropped_beam_intensities)
-            log_cropped_beam_intensities = np.log(cropped_beam_intensities + 1e-10)
-            plt.figure()
-            plt.hist(log_cropped_beam_intensities.flatten(), bins=100)
-            plt.title("log transformed cropped image data")
-            plt.show()
-
-            normalized_log_cropped_beam_intensities = (log_cropped_beam_intensities - np.mean(
-            log_cropped_beam_intensities)) / np.std(log_cropped_beam_intensities)
-            fig, axs = plt.subplots(nrows=1, ncols=2)
-            axs[0].hist(normalized_log_cropped_beam_intensities.flatten(), bins=300)
-            axs[0].set_title("Normalized Log Transformed Cropped Image Data")
-
-            axs[1].hist(np.std(normalized_log_cropped_beam_intensities, axis=(1, 2)), bins=300)
-            axs[1].set_title("STD")
-            plt.show()
-
-            # determine if blank images occur and remove them
-            bad_image_indices = []
-            good_image_indices = []
-            resized_images = []
-
-            for i in range(normalized_log_cropped_beam_intensities.shape[0]):
-                std = np.std(normalized_log_cropped_beam_intensities[i])
-                if 1e-10 < std:
-                    good_image_indices.append(i)
-                else:
-                    print(f"rejecting image {i} with std {std:.3e}")
-                    bad_image_indices.append(i)
-                resized_images.append(
-                    self.resize(
-                        normalized_log_cropped_beam_intensities[i],
-                        height=128 + 3,
-                        length=128 + 1
-                    )
-                )
-
-            print(f"bad image count: {len(bad_image_indices)}")
-
-            # this is the input image or the intial intensity
-            initial_beam_intensity_csv_path = dbs_repository / "NSLS-II-TES-beamline-rsOptExport-2/tes_init.csv"
-
-            initial_beam_intensity = pd.read_csv(initial_beam_intensity_csv_path, skiprows=1).to_numpy()
-            min_initial_beam_intensity = np.min(initial_beam_intensity)
-            print(f"min initial beam intensity {min_initial_beam_intensity}")
-
-            if min_initial_beam_intensity > 0:
-                e = 0.0
-            elif min_initial_beam_intensity == 0.0:
-                e = 1e-10
-            else:
-                e = 1e-10 + np.abs(min_initial_beam_intensity)
-
-            log_initial_beam_intensity = np.log(
-                initial_beam_intensity + e
+        # this is the input image or the intial intensity
+        initial_beam_intensity_csv_path = dbs_repository / "NSLS-II-TES-beamline-rsOptExport-2/tes_init.csv"
+        initial_beam_intensity = read_initial_beam_intensity_csv(initial_beam_intensity_csv_path)
+
+        if preprocessing_cache is None:
+            preprocessing_result = preprocess_beam_intensities(
+                train_file,
+                "preprocessed_results.h5",
+                initial_beam_intensity=initial_beam_intensity,
+                config=config,
+                chunk_size=chunk_size,
+                diagnostics=diagnostics,
+                workers=workers,
             )
-            plt.figure()
-            plt.hist(log_initial_beam_intensity.flatten(), bins=100)
-            plt.title("log_initial_beam_intensity")
-            plt.show()
-
-            normalized_initial_beam_intensity = (log_initial_beam_intensity - np.mean(log_initial_beam_intensity)) / np.std(
-                log_initial_beam_intensity)
-            resized_initial_beam_intensity = self.resize(
-                normalized_initial_beam_intensity,
-                height=128 + 3,
-                length=128 + 1
+        else:
+            preprocessing_result = preprocessing_cache.preprocess(
+                train_file,
+                initial_beam_intensity=initial_beam_intensity,
+                config=config,
+                chunk_size=chunk_size,
+                diagnostics=diagnostics,
+                workers=workers,
             )
 
-            with h5py.File("preprocessed_results.h5", mode="w") as preprocessed_results:
-                good_image_count = len(good_image_indices)
-
-                pi_ds = preprocessed_results.create_dataset(
-                    "preprocessed_initial_beam_intensity",
-                    (128, 128)
-                )
-                pi_ds[:] = resized_initial_beam_intensity
-
-                params_ds = preprocessed_results.create_dataset_like("params", f["params"])
-                for i, param in enumerate(f["params"]):
-                    params_ds[i] = param
-
-                pbi_ds = preprocessed_results.create_dataset(
-                    "preprocessed_beam_intensities",
-                    (good_image_count, 128, 128)
-                )
-
-                normalized_param_vals_ds = preprocessed_results.create_dataset(
-                    "preprocessed_param_vals",
-                    (good_image_count, f["paramVals"].shape[1])
-                )
-
-                normalized_param_vals = (f["paramVals"] - np.mean(f["paramVals"])) / np.std(f["paramVals"])
-
-                for i, good_i in enumerate(good_image_indices):
-                    normalized_param_vals_ds[i] = normalized_param_vals[good_i]
-                    pbi_ds[i] = resized_images[good_i]
-
-            with h5py.File("preprocessed_results.h5", mode="r") as preprocessed_results:
-                print(preprocessed_results.keys())
-                print(preprocessed_results["params"])
-                print(preprocessed_results["params"][:])
-                print(preprocessed_results["preprocessed_param_vals"])
-
-        return _parameter_count, resized_images
+        return preprocessing_result.parameter_count, preprocessing_result
 
 
 class UNet(Module):
     """
     Defines the UNet architecture
+
+    The decoder is conditioned on the parameter embedding. With encoder_mode "legacy"
+    the encoder also runs over the input image, but its output is discarded, so the
+    image does not change the prediction. "skip" leaves out the encoder, and the layers
+    "legacy" defines but never uses, and gives the same predictions as "legacy" for a
+    fraction of the computation. A "legacy" state_dict loads into a "skip" model.
+    "fuse" adds the encoder features, averaged over the image, to the parameter embedding.
+    forward is image_features followed by predict_from_features, so the features of a
+    fixed initial intensity can be computed once, see conditioning.ParameterOnlySurrogate.
+
+    Parameters
+    ----------
+    input_size: int
+      height of the output images
+    output_size: int
+      width of the output images
+    parameter_count: int
+      length of the parameter vectors
+    encoder_mode: str
+      "legacy", "skip", or "fuse"
     """
 
-    def __init__(self, input_size, output_size, parameter_count):
+    encoder_modes = ("legacy", "skip", "fuse")
+
+    # layers of "legacy" that no other encoder_mode defines
+    _legacy_only_layers = ("upconv1024", "conv1024", "conv512_1", "conv1024_1")
+    _encoder_layers = (
+        "input_layer",
+        "conv_inx64",
+        "conv_64x128",
+        "conv_128x256",
+        "conv_256x512",
+        "conv64",
+        "conv128",
+        "conv256",
+        "conv512",
+    )
+
+    def __init__(self, input_size, output_size, parameter_count, encoder_mode="legacy"):
         super().__init__()
-        # define input layer
-        self.input_layer = Conv2d(in_channels = 1, out_channels = 1, kernel_size=3, stride=1, padding=1)
-        # for going down the U
-        self.conv_inx64 = Conv2d(in_channels = 1, out_channels = 64, kernel_size=3, stride=1, padding=1)
-        self.conv_64x128 = Conv2d(in_channels = 64, out_channels = 128, kernel_size=3, stride=1, padding=1)
-        self.conv_128x256 = Conv2d(in_channels = 128, out_channels = 256, kernel_size=3, stride=1, padding=1)
-        self.conv_256x512 = Conv2d(in_channels = 256, out_channels = 512, kernel_size=3, stride=1, padding=1)
+        if encoder_mode not in self.encoder_modes:
+            raise ValueError(f"encoder_mode must be one of {self.encoder_modes}, not '{encoder_mode}'")
+        self.parameter_count = parameter_count
+        self.encoder_mode = encoder_mode
+
+        if encoder_mode != "skip":
+            # define input layer
+            self.input_layer = Conv2d(in_channels = 1, out_channels = 1, kernel_size=3, stride=1, padding=1)
+            # for going down the U
+            self.conv_inx64 = Conv2d(in_channels = 1, out_channels = 64, kernel_size=3, stride=1, padding=1)
+            self.conv_64x128 = Conv2d(in_channels = 64, out_channels = 128, kernel_size=3, stride=1, padding=1)
+            self.conv_128x256 = Conv2d(in_channels = 128, out_channels = 256, kernel_size=3, stride=1, padding=1)
+            self.conv_256x512 = Conv2d(in_channels = 256, out_channels = 512, kernel_size=3, stride=1, padding=1)
 
         self.relu = ReLU()
 
@@ -237,24 +208,30 @@ class UNet(Module):
         self.upsample_final = Upsample(size=(input_size, output_size))
 
         # for going up the U
-        self.upconv1024 = ConvTranspose2d(in_channels = 1024, out_channels = 512, kernel_size=3, stride=1, padding=1)
+        if encoder_mode == "legacy":
+            self.upconv1024 = ConvTranspose2d(
+                in_channels = 1024, out_channels = 512, kernel_size=3, stride=1, padding=1
+            )
         self.upconv512 = ConvTranspose2d(in_channels = 512, out_channels = 256, kernel_size=3, stride=1, padding=1)
         self.upconv256 = ConvTranspose2d(in_channels = 256, out_channels = 128, kernel_size=3, stride=1, padding=1)
         self.upconv128 = ConvTranspose2d(in_channels = 128, out_channels = 64, kernel_size=3, stride=1, padding=1)
 
         # used for down blocks
-        self.conv64 = Conv2d(in_channels = 64, out_channels = 64, kernel_size=3, stride=1, padding=1)
-        self.conv128 = Conv2d(in_channels = 128, out_channels = 128, kernel_size=3, stride=1, padding=1)
-        self.conv256 = Conv2d(in_channels = 256, out_channels = 256, kernel_size=3, stride=1, padding=1)
-        self.conv512 = Conv2d(in_channels = 512, out_channels = 512, kernel_size=3, stride=1, padding=1)
-        self.conv1024 = Conv2d(in_channels = 1024, out_channels = 1024, kernel_size=3, stride=1, padding=1)
+        if encoder_mode != "skip":
+            self.conv64 = Conv2d(in_channels = 64, out_channels = 64, kernel_size=3, stride=1, padding=1)
+            self.conv128 = Conv2d(in_channels = 128, out_channels = 128, kernel_size=3, stride=1, padding=1)
+            self.conv256 = Conv2d(in_channels = 256, out_channels = 256, kernel_size=3, stride=1, padding=1)
+            self.conv512 = Conv2d(in_channels = 512, out_channels = 512, kernel_size=3, stride=1, padding=1)
+        if encoder_mode == "legacy":
+            self.conv1024 = Conv2d(in_channels = 1024, out_channels = 1024, kernel_size=3, stride=1, padding=1)
 
         # used for up blocks
         self.conv64_1 = Conv2d(in_channels = 64, out_channels = 64, kernel_size=3, stride=1, padding=1)
         self.conv128_1 = Conv2d(in_channels = 128, out_channels = 128, kernel_size=3, stride=1, padding=1)
         self.conv256_1 = Conv2d(in_channels = 256, out_channels = 256, kernel_size=3, stride=1, padding=1)
-        self.conv512_1 = Conv2d(in_channels = 512, out_channels = 512, kernel_size=3, stride=1, padding=1)
-        self.conv1024_1 = Conv2d(in_channels = 1024, out_channels = 1024, kernel_size=3, stride=1, padding=1)
+        if encoder_mode == "legacy":
+            self.conv512_1 = Conv2d(in_channels = 512, out_channels = 512, kernel_size=3, stride=1, padding=1)
+            self.conv1024_1 = Conv2d(in_channels = 1024, out_channels = 1024, kernel_size=3, stride=1, padding=1)
 
         # define output layer
         self.output_layer = Conv2d(in_channels = 64, out_channels = 1, kernel_size=3, stride=1, padding=1)
@@ -265,7 +242,29 @@ class UNet(Module):
         self.param_layer_256 = torch.nn.Linear(128, 256)
         self.param_layer_512 = torch.nn.Linear(256, 512)
 
-    def forward(self, inputs, input_params):
+        if encoder_mode == "fuse":
+            # mixes the averaged encoder features into the parameter embedding
+            self.encoder_fuse_layer = torch.nn.Linear(512 + 512, 512)
+
+    def load_state_dict(self, state_dict, strict=True, assign=False):
+        """
+        Load a state_dict, ignoring the layers this encoder_mode leaves out, so a "legacy"
+        state_dict loads into a "skip" model.
+        """
+        left_out_layers = [
+            layer_name
+            for layer_name in self._legacy_only_layers + self._encoder_layers
+            if not hasattr(self, layer_name)
+        ]
+        state_dict = {
+            key: value for key, value in state_dict.items() if key.split(".", 1)[0] not in left_out_layers
+        }
+        return super().load_state_dict(state_dict, strict=strict, assign=assign)
+
+    def encode(self, inputs):
+        """
+        Return the (N, 512, H/8, W/8) encoder features of (N, 1, H, W) images.
+        """
         # down
         # encoder block 1
         x = self.input_layer(inputs)
@@ -294,13 +293,34 @@ class UNet(Module):
         x = self.dropout(x)
         x = self.relu(x)
         x = self.conv512(x)
-
+        return x
+
+    def image_features(self, inputs):
+        """
+        Return the (N, F) features of (N, 1, H, W) images that predict_from_features uses.
+
+        F is 0 unless encoder_mode is "fuse". Images that do not change, like the initial
+        intensity, need their features computed only once.
+        """
+        if hasattr(self, "encoder_fuse_layer"):
+            return self.encode(inputs).mean(dim=(2, 3))
+        return inputs.new_zeros((inputs.shape[0], 0))
+
+    def predict_from_features(self, image_features, input_params):
+        """
+        Return the (N, 1, H, W) images predicted from image_features and (N, P) parameter values.
+        """
         # the aperature horizonal/vertical position
-        parameters = torch.tensor(input_params)
+        # as_tensor does not copy a tensor that already has the right dtype and device
+        parameters = torch.as_tensor(input_params, dtype=image_features.dtype, device=image_features.device)
         parameters = self.param_layer(parameters)
 
         x = self.param_layer_256(parameters)
         x = self.param_layer_512(x)
+
+        # hasattr is resolved when the model is scripted
+        if hasattr(self, "encoder_fuse_layer"):
+            x = self.encoder_fuse_layer(torch.cat((x, image_features), dim=1))
         x = x[:, :, None, None]
 
         # up
@@ -331,21 +351,36 @@ class UNet(Module):
         output = self.output_layer(x)
         return output
 
+    def forward(self, inputs, input_params):
+        if hasattr(self, "conv_inx64") and not hasattr(self, "encoder_fuse_layer"):
+            # "legacy" runs the encoder and discards its output
+            self.encode(inputs)
+        return self.predict_from_features(self.image_features(inputs), input_params)
+
 
 class IntensityImageDataset:
     '''
     Create dataloaders for training and testing on intensity image data
+
+    With shared_initial_intensity=True items are (image, parameter values) and the
+    initial image, the same for every item, is shared_initial_image, see `batch_to_device`.
     '''
-    def __init__(self, beam_intensities, initial_beam_intensity, params, param_vals):
+    def __init__(
+        self, beam_intensities, initial_beam_intensity, params, param_vals, shared_initial_intensity=False
+    ):
         self.beam_intensities = np.expand_dims(beam_intensities, axis = 1)
         self.initial_beam_intensity = np.expand_dims(initial_beam_intensity, axis=0)
         self.params = params 
         self.param_vals = param_vals.astype("float32")
+        self.shared_initial_intensity = shared_initial_intensity
+        self.shared_initial_image = SharedInitialImage(self.initial_beam_intensity)
 
     def __getitem__(self, index):
         '''
         Returns the specified intensity image at the index given
         '''
+        if self.shared_initial_intensity:
+            return self.beam_intensities[index], self.param_vals[index]
         return self.beam_intensities[index], self.initial_beam_intensity, self.param_vals[index]
 
     def __len__(self):
@@ -363,11 +398,128 @@ class IntensityImageDataset:
         print(f'beamline parameters:\n\t{self.params}\n')
 
 
-def build_dataloaders(data_path, batch_size):
+def build_dataloaders(
+    data_path,
+    batch_size,
+    dataset_type="array",
+    block_size=64,
+    cache_blocks=0,
+    num_workers=0,
+    sampler="random",
+    shared_initial_intensity=False,
+    pin_memory=False,
+    split=None,
+    testing_subset="test",
+):
+    """
+    Parse the results that have been preprocessed and make datasets and dataloaders
+
+    Parameters
+    ----------
+    data_path: path-like
+      a preprocessed_results.h5 file
+    batch_size: int
+      batch size of both dataloaders
+    dataset_type: str
+      "array" to read every image into memory first, "tensor" to read every image into
+      float32 tensors and gather batches without a DataLoader, see `TensorBatchLoader`,
+      or "lazy" to read images from the file as they are needed with a LazyIntensityImageDataset
+    block_size: int
+      for "lazy", number of images read at a time when blocks are cached, and the
+      number of consecutive images in each block shuffled by the "block" sampler
+    cache_blocks: int
+      for "lazy", number of blocks of images kept in memory by each process
+    num_workers: int
+      number of DataLoader worker processes
+    sampler: str
+      "random" to shuffle single images, or for "lazy" also "block" to shuffle blocks of
+      consecutive images and read each batch with a few slices, see `build_lazy_dataloader`
+    shared_initial_intensity: bool
+      if True batches are (correct images, parameter values) and the initial image is
+      the datasets' shared_initial_image, see `batch_to_device`
+    pin_memory: bool
+      for "tensor", if True gather batches into page-locked memory for faster copies to CUDA
+    split: SplitConfig or DatasetSplit, optional
+      the training and testing images, see `load_split`, by default the first two thirds
+      of the images in file order are for training and the rest for testing
+    testing_subset: str
+      "test" or "validation", the subset of split in the testing dataloader
+
+    Returns
+    -------
+    (DataLoader, DataLoader)
+      the training dataloader and the testing dataloader, TensorBatchLoaders for "tensor"
+    """
+    training_indices, testing_indices = split_indices(data_path, split=split, testing_subset=testing_subset)
+    if dataset_type == "lazy":
+        training_intensity_dataset = LazyIntensityImageDataset(
+            data_path,
+            indices=training_indices,
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        testing_intensity_dataset = LazyIntensityImageDataset(
+            data_path,
+            indices=testing_indices,
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        training_intensity_dataloader = build_lazy_dataloader(
+            training_intensity_dataset, batch_size, sampler=sampler, block_size=block_size, num_workers=num_workers
+        )
+        testing_intensity_dataloader = build_lazy_dataloader(
+            testing_intensity_dataset, batch_size, sampler=sampler, block_size=block_size, num_workers=num_workers
+        )
+        return training_intensity_dataloader, testing_intensity_dataloader
+    elif dataset_type == "tensor":
+        if sampler != "random":
+            raise ValueError(f"the '{sampler}' sampler needs dataset_type 'lazy'")
+        training_intensity_dataset = TensorIntensityImageDataset.from_h5(
+            data_path,
+            indices=training_indices,
+            pin_memory=pin_memory,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        testing_intensity_dataset = TensorIntensityImageDataset.from_h5(
+            data_path,
+            indices=testing_indices,
+            pin_memory=pin_memory,
+            shared_initial_intensity=shared_initial_intensity,
+        )
+        return (
+            TensorBatchLoader(training_intensity_dataset, batch_size),
+            TensorBatchLoader(testing_intensity_dataset, batch_size),
+        )
+    elif dataset_type == "array":
+        if sampler != "random":
+            raise ValueError(f"the '{sampler}' sampler needs dataset_type 'lazy'")
+        training_intensity_dataset, testing_intensity_dataset = _build_array_datasets(
+            data_path, training_indices, testing_indices, shared_initial_intensity=shared_initial_intensity
+        )
+    else:
+        raise ValueError(f"dataset_type must be 'array', 'tensor', or 'lazy', not '{dataset_type}'")
+
+    training_intensity_dataloader = DataLoader(
+        training_intensity_dataset,
+        batch_size = batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        )
+
+    testing_intensity_dataloader = DataLoader(
+        testing_intensity_dataset,
+        batch_size = batch_size,
+        shuffle = True,
+        num_workers=num_workers,
+        )
+
+    return training_intensity_dataloader, testing_intensity_dataloader
+
+
+def _build_array_datasets(data_path, training_indices, testing_indices, shared_initial_intensity=False):
     with h5py.File(data_path, mode='r') as preprocessed_results:
-        '''
-        Parse the results that have been preprocessed and make datasets and dataloaders
-        '''
         initial_beam_intensity_ds = preprocessed_results['preprocessed_initial_beam_intensity']
         initial_beam_intensity = np.zeros_like(initial_beam_intensity_ds)
         initial_beam_intensity[:] = initial_beam_intensity_ds[:]
@@ -384,34 +536,20 @@ def build_dataloaders(data_path, batch_size):
         beam_param_values = np.zeros_like(beam_param_values_ds)
         beam_param_values[:] = beam_param_values_ds[:]
 
-        # get two thirds of the data to use for training
-        training_size = 2 * (beam_intensities.shape[0] // 3)
-
-        training_intensity_dataset = IntensityImageDataset(
-            beam_intensities= beam_intensities[:training_size],
-            initial_beam_intensity=initial_beam_intensity,
-            params = beam_parameters,
-            param_vals = beam_param_values[:training_size]
-            )
-
-        training_intensity_dataloader = DataLoader(
-            training_intensity_dataset,
-            batch_size = batch_size,
-            shuffle=True
-            )
-
-        testing_intensity_dataset = IntensityImageDataset(
-            beam_intensities = beam_intensities[training_size:],
-            initial_beam_intensity=initial_beam_intensity,
-            params=beam_parameters,
-            param_vals = beam_param_values[training_size:]
-            )
-
-        testing_intensity_dataloader = DataLoader(
-            testing_intensity_dataset,
-            batch_size = batch_size,
-            shuffle = True
-            )
+    training_intensity_dataset = IntensityImageDataset(
+        beam_intensities= beam_intensities[training_indices],
+        initial_beam_intensity=initial_beam_intensity,
+        params = beam_parameters,
+        param_vals = beam_param_values[training_indices],
+        shared_initial_intensity=shared_initial_intensity,
+        )
 
-    return training_intensity_dataloader, testing_intensity_dataloader
+    testing_intensity_dataset = IntensityImageDataset(
+        beam_intensities = beam_intensities[testing_indices],
+        initial_beam_intensity=initial_beam_intensity,
+        params=beam_parameters,
+        param_vals = beam_param_values[testing_indices],
+        shared_initial_intensity=shared_initial_intensity,
+        )
 
+    return training_intensity_dataset, testing_intensity_dataset
@@ -5,23 +5,28 @@ import pandas
 import numpy as np
 from pathlib import Path
 from torchinfo import summary
-import matplotlib
-matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
 from torch.utils.data import DataLoader
 from u_net import UNet, ImageProcessing, build_dataloaders
 from torchinfo import summary
+from preprocessing_cache import PreprocessingCache
+from conditioning import batch_to_device
+from inference import save_checkpoint
+import h5py
 
 # process the images with image processing class
 ip = ImageProcessing([])
 filename = "NSLS-II-TES-beamline-rsOptExport-2/rsopt50/datasets/results.h5"
-param_count, resized_images = ip.preprocess(filename)
+# reuse the preprocessed file while results.h5 and the preprocessing settings are unchanged
+param_count, preprocessing_result = ip.preprocess(filename, preprocessing_cache=PreprocessingCache())
 
-# dataloaders and dataset
-training_intensity_dataloader, testing_intensity_dataloader = build_dataloaders('preprocessed_results.h5', 10)
+# dataloaders and dataset, the initial image is the same for every sample so it is sent to the device once
+training_intensity_dataloader, testing_intensity_dataloader = build_dataloaders(
+    preprocessing_result.preprocessed_results_path, 10, shared_initial_intensity=True
+)
 
-# define model
-model = UNet(128, 128, param_count)
+# define model, the encoder output does not reach the decoder, so leave it out
+model = UNet(128, 128, param_count, encoder_mode="skip")
 
 # get model summary with 128x128 size images
 summary(model, input_data = (torch.ones(2, 1, 128, 128), torch.ones(2, param_count)),
@@ -54,10 +59,11 @@ def train(model, optimizer, loss_function, train_dataloader, test_dataloader, ep
     for e in range(0, epochs):
         training_loss = 0.0 
         model.train()
-        for correct_images, images, input_params in train_dataloader:
+        for batch in train_dataloader:
             optimizer.zero_grad()
-            images = images.to(device)
-            correct_images = correct_images.to(device)
+            correct_images, images, input_params = batch_to_device(
+                batch, device, train_dataloader.dataset.shared_initial_image
+            )
 
             predicted_images  = model(images, input_params)
 
@@ -71,9 +77,10 @@ def train(model, optimizer, loss_function, train_dataloader, test_dataloader, ep
         testing_loss = 0.0
         model.eval()
 
-        for correct_images, images, input_params in test_dataloader:
-            images = images.to(device)
-            correct_images = correct_images.to(device)
+        for batch in test_dataloader:
+            correct_images, images, input_params = batch_to_device(
+                batch, device, test_dataloader.dataset.shared_initial_image
+            )
             predicted_images = model(images, input_params)
             loss = loss_function(predicted_images, correct_images)
             testing_loss += loss.data.item()
@@ -101,7 +108,7 @@ def train(model, optimizer, loss_function, train_dataloader, test_dataloader, ep
             count += 1
     return train_loss, test_loss
 
-sim_count = len(resized_images)
+sim_count = preprocessing_result.image_count
 beamline = 'TES'
 
 epoch_count = 301
@@ -118,6 +125,17 @@ train_loss, test_loss = train(
     epochs = epoch_count
     )
 
+# save the model for SurrogateInferenceEngine
+with h5py.File(preprocessing_result.preprocessed_results_path, mode="r") as preprocessed_results:
+    save_checkpoint(
+        "unet_checkpoint.pt",
+        model,
+        "unet",
+        {"input_size": 128, "output_size": 128, "parameter_count": param_count, "encoder_mode": "skip"},
+        preprocessed_results["preprocessed_initial_beam_intensity"][()],
+        params=preprocessed_results["params"][()],
+    )
+
 plt.figure()
 plt.plot(train_loss)
 plt.title(f"{beamline} {sim_count} Simulations Training Loss")